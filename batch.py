@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+import argparse
+import base64
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from steganography import SAVE_PROFILES, CarrierCache, StegoError, StegoImage, encodeMessage
+
+################################################################################
+# Batch encoding and decoding
+#
+#   Runs encode/decode over many images in one process pool, so interpreter
+#   and Pillow startup is paid once per worker instead of once per file.
+#
+#       steganography.py encode-batch <dir|glob|manifest> -m <message>
+#       steganography.py decode-batch <dir|glob|manifest>
+#
+#   A manifest is a .csv file with a header row, or a .jsonl file with one
+#   object per line, using the keys "image", "message" and "output". Results
+#   are streamed as one JSON object per line, in the order jobs finish.
+################################################################################
+
+# Decoded carriers of each worker process, for manifests that stamp many
+# messages into the same few images
+CARRIERS = CarrierCache()
+
+def main(argv):
+    ''' Entry point for the encode-batch and decode-batch subcommands
+
+        Input: argv <list>, starting at the subcommand name
+        Output: exit status, 0 if every file succeeded
+    '''
+    command = argv[0]
+    parser = argparse.ArgumentParser(prog="steganography.py " + command)
+    parser.add_argument("source", help="Directory, glob pattern, or .csv/.jsonl manifest", type=str)
+    if command == "encode-batch":
+        parser.add_argument("-m", "--message", help="Message for images the manifest gives none",
+                                              type=str)
+        parser.add_argument("-o", "--output_dir", help="Directory for encoded images", type=str,
+                                              default="encodedImages")
+        parser.add_argument("--profile", help="PNG save profile", choices=list(SAVE_PROFILES),
+                                              default="balanced")
+    parser.add_argument("-j", "--workers", help="Number of worker processes", type=int,
+                                          default=os.cpu_count())
+    parser.add_argument("-r", "--results", help="File to write JSONL results to, - for stdout",
+                                          type=str, default="-")
+    args = parser.parse_args(argv[1:])
+
+    jobs = collectJobs(args.source)
+    if command == "encode-batch":
+        os.makedirs(args.output_dir, exist_ok=True)
+        for job in jobs:
+            job.setdefault("message", args.message)
+            job.setdefault("output", os.path.join(args.output_dir, os.path.basename(job["image"])))
+            job.setdefault("profile", args.profile)
+        worker = encodeJob
+    else:
+        worker = decodeJob
+
+    results = sys.stdout if args.results == "-" else open(args.results, "w")
+    failures = 0
+    try:
+        for result in runJobs(worker, jobs, args.workers):
+            failures += result["status"] != "ok"
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+    finally:
+        if results is not sys.stdout:
+            results.close()
+
+    return 1 if failures else 0
+
+
+def collectJobs(source):
+    ''' Builds the job list from a directory, glob pattern, or manifest
+
+        Input: source <path or pattern>
+        Output: jobs [dict], each with at least an "image" key
+    '''
+    if os.path.isdir(source):
+        return [{"image": path} for path in sorted(glob.glob(os.path.join(source, "*.png")))]
+
+    if source.endswith(".csv"):
+        with open(source, newline="") as manifest:
+            return [{key: value for key, value in row.items() if value}
+                    for row in csv.DictReader(manifest)]
+
+    if source.endswith(".jsonl"):
+        with open(source) as manifest:
+            return [json.loads(line) for line in manifest if line.strip()]
+
+    return [{"image": path} for path in sorted(glob.glob(source))]
+
+
+def runJobs(worker, jobs, workers):
+    ''' Spreads jobs over a process pool, yielding results as they finish
+
+        Input: worker <function>, jobs [dict], workers <int>
+        Output: generator of results <dict>
+    '''
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker, job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def encodeJob(job):
+    ''' Encodes one image, recording any error instead of raising it
+
+        Input: job <dict> with "image", "message", "output" and "profile" keys
+        Output: result <dict>
+    '''
+    result = {"image": job["image"], "output": job.get("output")}
+    start = time.perf_counter()
+    try:
+        if job.get("message") is None:
+            raise StegoError("No message given")
+        report = encodeMessage(job["image"], job["output"], job["message"],
+                               profile=job.get("profile", "balanced"), cache=CARRIERS)
+        result["bytes"] = report["bytes"]
+        result["status"] = "ok"
+    except Exception as err:
+        result["status"] = "error"
+        result["error"] = "{}: {}".format(type(err).__name__, err)
+    result["seconds"] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def decodeJob(job):
+    ''' Decodes one image, recording any error instead of raising it. Text
+        messages are reported as "message", anything else as base64.
+
+        Input: job <dict> with an "image" key
+        Output: result <dict>
+    '''
+    result = {"image": job["image"]}
+    start = time.perf_counter()
+    try:
+        payload = StegoImage.fromFile(job["image"]).extract()
+        try:
+            result["message"] = payload.decode(encoding="utf-8")
+        except UnicodeDecodeError:
+            result["payload_base64"] = base64.b64encode(payload).decode(encoding="ascii")
+        result["status"] = "ok"
+    except Exception as err:
+        result["status"] = "error"
+        result["error"] = "{}: {}".format(type(err).__name__, err)
+    result["seconds"] = round(time.perf_counter() - start, 6)
+    return result
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import PIL
+from PIL import Image
+import metrics
+from steganography import (EMBED_BACKENDS, SAVE_PROFILES, StegoError, containerSegments,
+                           extractPayload, payloadCapacity, saveImage)
+
+################################################################################
+# Benchmarks for encoding and decoding
+#
+#   Times each phase of an encode (open, embed, serialize, save) and decode
+#   (open, extract) over synthetic carriers of several sizes and modes, and
+#   the bundled example images, with empty, 1 KB and near capacity payloads.
+#
+#       ./benchmark.py run -o before.json
+#       ./benchmark.py run -o after.json
+#       ./benchmark.py compare before.json after.json --threshold 0.1
+#
+#   Every case runs in a fresh process, so the peak RSS reported is that of
+#   the case alone. Carriers are generated from a fixed seed, so runs on the
+#   same machine are comparable.
+################################################################################
+
+# Synthetic carrier sizes, as (width, height)
+SIZES = {"256": (256, 256), "2k": (2048, 1080), "8k": (7680, 4320)}
+
+# Real world carriers shipped with the repository
+EXAMPLE_IMAGES = [os.path.join(sys.path[0], "images", name) for name in ("castle.png", "lime.png")]
+
+PAYLOADS = ["empty", "1k", "full"]
+
+SEED = 1234
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run the benchmarks and save results as JSON")
+    run.add_argument("-o", "--output", help="Results file", type=str, default="benchmark.json")
+    run.add_argument("--sizes", help="Synthetic carrier sizes", type=str, default=",".join(SIZES))
+    run.add_argument("--modes", help="Synthetic carrier modes", type=str, default="RGB,RGBA")
+    run.add_argument("--payloads", help="Payload sizes", type=str, default=",".join(PAYLOADS))
+    run.add_argument("--repeat", help="Runs per case, the median is kept", type=int, default=3)
+    run.add_argument("--backend", help="Embedding backend", choices=sorted(EMBED_BACKENDS),
+                                  default="numpy")
+    run.add_argument("--profile", help="PNG save profile", choices=list(SAVE_PROFILES),
+                                  default="balanced")
+    run.add_argument("--threads", help="PNG compression threads", type=int, default=1)
+    run.add_argument("--no-examples", help="Skip the bundled example images",
+                                  action="store_true")
+
+    compare = commands.add_parser("compare", help="Compare two results files")
+    compare.add_argument("baseline", help="Results of the earlier run", type=str)
+    compare.add_argument("current", help="Results of the later run", type=str)
+    compare.add_argument("-t", "--threshold", help="Allowed slowdown, e.g. 0.1 for 10%%",
+                                      type=float, default=0.1)
+    compare.add_argument("--min-seconds", help="Ignore changes smaller than this, as noise",
+                                      type=float, default=0.001)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        runBenchmarks(args)
+    else:
+        exit(compareResults(args.baseline, args.current, args.threshold, args.min_seconds))
+
+
+def runBenchmarks(args):
+    ''' Generates the carriers, times every case and saves the results
+
+        Input: parsed command line arguments
+        Output: None
+    '''
+    results = {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                        "pillow": PIL.__version__, "platform": platform.platform(),
+                        "backend": args.backend, "repeat": args.repeat,
+                        "profile": args.profile, "threads": args.threads,
+                        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+               "cases": []}
+
+    with tempfile.TemporaryDirectory() as workDirectory:
+        carriers = []
+        for size in args.sizes.split(","):
+            for mode in args.modes.split(","):
+                name = "{}-{}".format(size, mode)
+                path = os.path.join(workDirectory, name + ".png")
+                makeCarrier(path, SIZES[size], mode)
+                carriers.append((name, path))
+        if not args.no_examples:
+            carriers += [(os.path.basename(path), path) for path in EXAMPLE_IMAGES]
+
+        # A fresh process for every case keeps peak RSS separate
+        context = multiprocessing.get_context("spawn")
+        for name, path in carriers:
+            for payload in args.payloads.split(","):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    case = executor.submit(runCase, path, payload, args.repeat, args.backend,
+                                           args.profile, args.threads, workDirectory).result()
+                case["name"] = "{}/{}".format(name, payload)
+                results["cases"].append(case)
+                print(formatCase(case))
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print("Saved results as \"{}\"".format(args.output))
+
+
+def makeCarrier(path, size, mode):
+    ''' Writes a synthetic carrier, a noisy gradient so PNG compression has
+        some work to do without being unrealistically fast
+
+        Input: path <path>, size (width, height), mode <"RGB" or "RGBA">
+        Output: None
+    '''
+    width, height = size
+    rng = np.random.default_rng(SEED)
+    channels = len(mode)
+    gradient = (np.arange(width, dtype=np.uint16)[None, :, None] * 255 // max(width - 1, 1)
+                + np.arange(height, dtype=np.uint16)[:, None, None] * 255 // max(height - 1, 1)) // 2
+    noise = rng.integers(0, 16, size=(height, width, channels), dtype=np.uint16)
+    pixels = np.minimum(gradient + noise, 255).astype(np.uint8)
+    Image.fromarray(pixels, mode).save(path, "PNG")
+
+
+def makePayload(name, image):
+    ''' Builds a payload of the requested size for a carrier
+
+        Input: name <"empty", "1k" or "full">, image <Image>
+        Output: payload <bytes>
+    '''
+    if name == "empty":
+        return b""
+    if name == "1k":
+        return np.random.default_rng(SEED).bytes(1024)
+    return np.random.default_rng(SEED).bytes(payloadCapacity(image))
+
+
+def runCase(path, payloadName, repeat, backend, profile, threads, workDirectory):
+    ''' Times one carrier/payload combination, keeping the median of each
+        phase over the repeats
+
+        Input: carrier path, payload name, repeat count, embedding backend,
+               PNG save profile, compression threads, directory for output files
+        Output: case results <dict>
+    '''
+    phases = {}
+    outputFile = os.path.join(workDirectory, "output-{}.png".format(os.getpid()))
+    roundTrip = True
+
+    for run in range(repeat):
+        timings = {}
+
+        start = time.perf_counter()
+        image = Image.open(path)
+        image.load()
+        timings["open"] = time.perf_counter() - start
+
+        payload = makePayload(payloadName, image)
+
+        start = time.perf_counter()
+        encodedImage = EMBED_BACKENDS[backend](image, containerSegments(image, payload))
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        saveImage(image, encodedImage, buffer, profile, threads)
+        timings["serialize"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(outputFile, "wb") as output:
+            output.write(buffer.getbuffer())
+        timings["save"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decodedImage = Image.open(outputFile)
+        decodedImage.load()
+        timings["decode_open"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            roundTrip &= extractPayload(decodedImage) == payload
+        except StegoError:
+            roundTrip = False
+        timings["extract"] = time.perf_counter() - start
+
+        for phase, seconds in timings.items():
+            phases.setdefault(phase, []).append(seconds)
+
+    os.remove(outputFile)
+
+    rawBytes = image.size[0] * image.size[1] * len(image.getbands())
+    seconds = {phase: statistics.median(runs) for phase, runs in phases.items()}
+    return {"size": list(image.size), "mode": image.mode, "payload_bytes": len(payload),
+            "png_bytes": buffer.getbuffer().nbytes, "round_trip": roundTrip,
+            "seconds": seconds,
+            "mb_per_s": {phase: rawBytes / 1e6 / max(value, 1e-9) for phase, value in seconds.items()},
+            "peak_rss_mb": peakRSS()}
+
+
+def peakRSS():
+    ''' Peak resident set size of this process in MB
+
+        Input: None
+        Output: megabytes <float>
+    '''
+    return metrics.peakRSS() / 2**20
+
+
+def formatCase(case):
+    ''' One line summary of a case for the terminal
+
+        Input: case results <dict>
+        Output: string
+    '''
+    phases = "  ".join("{} {:.4f}s".format(phase, seconds)
+                       for phase, seconds in case["seconds"].items())
+    return "{:<24} {}  peak {:.0f} MB{}".format(case["name"], phases, case["peak_rss_mb"],
+                                               "" if case["round_trip"] else "  ROUND TRIP FAILED")
+
+
+def compareResults(baselineFile, currentFile, threshold, minSeconds=0.001):
+    ''' Prints the change in every phase of every case two runs share, and
+        flags phases that slowed down by more than the threshold, and by more
+        than minSeconds
+
+        Input: baseline results file, current results file, threshold <float>,
+               minSeconds <float>
+        Output: exit status, 1 if anything regressed
+    '''
+    with open(baselineFile) as baseline, open(currentFile) as current:
+        baselineCases = {case["name"]: case for case in json.load(baseline)["cases"]}
+        currentCases = {case["name"]: case for case in json.load(current)["cases"]}
+
+    regressions = 0
+    for name in baselineCases:
+        if name not in currentCases:
+            continue
+        for phase, before in baselineCases[name]["seconds"].items():
+            after = currentCases[name]["seconds"].get(phase)
+            if after is None:
+                continue
+            change = (after - before) / max(before, 1e-9)
+            regressed = change > threshold and after - before > minSeconds
+            regressions += regressed
+            print("{:<24} {:<12} {:9.4f}s -> {:9.4f}s  {:+7.1%}{}".format(
+                name, phase, before, after, change, "  REGRESSION" if regressed else ""))
+
+    print("{} regression(s) above {:.0%}".format(regressions, threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    main()
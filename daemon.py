@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import steganography
+from steganography import (CarrierCache, StegoError, StegoImage, buildParser, encodeMessage,
+                           inspectImage, runCommand)
+from stegoclient import SOCKET_PATH
+
+################################################################################
+# Steganography daemon
+#
+#   Keeps a pool of worker processes with NumPy and Pillow already imported,
+#   and serves jobs over a Unix socket, so many small calls don't each pay for
+#   interpreter startup.
+#
+#       steganography.py serve [--socket PATH] [-j WORKERS] [-q QUEUE]
+#
+#   Requests and responses are JSON objects, one per line. A request has an
+#   "op" and an optional "id", echoed in the response:
+#
+#       encode   "image" path or "image_data" base64, "message" text or
+#                "payload_data" base64, and "output" path; without an output
+#                the encoded PNG comes back as "image_data"
+#       decode   "image" or "image_data"; the payload comes back as "message"
+#                if it is text, else as "payload_data"
+#       inspect  "image" or "image_data"; the report comes back as "report"
+#       cli      "argv", "cwd" and optional "stdin" base64, an encode or
+#                decode command line run as steganography.py would; used by
+#                stegoclient.py
+#
+#   Encode and decode take the command line options as keys too, e.g.
+#   "bits_per_channel", "use_alpha", "passphrase" or "compress". Every
+#   response has a "status" of "ok", "error" or "busy", and "timing" with the
+#   seconds spent queued, running and in total. Only workers + queue jobs are
+#   accepted at once; past that, requests wait up to --queue-timeout for a
+#   slot, then get "busy" so the client can back off.
+################################################################################
+
+# Decoded carriers of each worker process, so images encoded again and again
+# by path are only decoded once
+CARRIERS = CarrierCache()
+
+def main(argv):
+    ''' Entry point for the serve subcommand
+
+        Input: argv <list>, starting at the subcommand name
+        Output: exit status
+    '''
+    parser = argparse.ArgumentParser(prog="steganography.py " + argv[0])
+    parser.add_argument("--socket", help="Unix socket to listen on", type=str, default=SOCKET_PATH)
+    parser.add_argument("-j", "--workers", help="Number of worker processes", type=int,
+                                          default=os.cpu_count())
+    parser.add_argument("-q", "--queue", help="Jobs accepted beyond those running", type=int,
+                                          default=None)
+    parser.add_argument("--queue-timeout", help="Seconds a request waits for a queue slot "
+                                          "before the daemon answers busy", type=float, default=1.0)
+    args = parser.parse_args(argv[1:])
+    queueSize = 2 * args.workers if args.queue is None else args.queue
+
+    try:
+        server = StegoServer(args.socket, args.workers, queueSize, args.queue_timeout)
+    except StegoError as err:
+        print(err)
+        return err.exitCode
+    print("Listening on \"{}\" with {} workers".format(args.socket, args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+def warmWorker():
+    ''' Worker initializer, so the first job doesn't pay for lazy imports
+
+        Input: None
+        Output: None
+    '''
+    carrier, encoded = io.BytesIO(), io.BytesIO()
+    steganography.Image.new("RGB", (64, 64)).save(carrier, "PNG")
+    carrier.seek(0)
+    encodeMessage(carrier, encoded, "warm")
+    encoded.seek(0)
+    StegoImage.fromFile(encoded).extract()
+
+
+class StegoServer(socketserver.ThreadingUnixStreamServer):
+    # Accepts connections on a thread each, and runs their jobs on the pool
+
+    # Input: socket path, number of workers, queue size, queue timeout <seconds>
+    # Output: None
+
+    daemon_threads = True
+
+    def __init__(self, socketPath, workers, queueSize, queueTimeout):
+        # A socket file left by a daemon that died can go, a live one can't
+        if os.path.exists(socketPath):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(socketPath) == 0:
+                    raise StegoError("A daemon is already listening on \"{}\"".format(socketPath))
+            os.remove(socketPath)
+
+        socketserver.ThreadingUnixStreamServer.__init__(self, socketPath, RequestHandler)
+        self.socketPath = socketPath
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=warmWorker)
+        self.slots = threading.BoundedSemaphore(workers + queueSize)
+        self.queueTimeout = queueTimeout
+
+    def runJob(self, job):
+        ''' Runs a job on the pool, if a slot frees up in time
+
+            Input: job <dict>
+            Output: response <dict>
+        '''
+        received = time.time()
+        if not self.slots.acquire(timeout=self.queueTimeout):
+            waited = round(time.time() - received, 6)
+            return {"id": job.get("id"), "status": "busy", "error": "Queue full, try again later",
+                    "timing": {"queued": waited, "run": 0.0, "total": waited}}
+        try:
+            response = self.executor.submit(runJob, job, received).result()
+        except Exception as err:
+            # The pool itself failed, e.g. a worker died or the job couldn't be sent to it
+            response = {"id": job.get("id"), "status": "error",
+                        "error": "{}: {}".format(type(err).__name__, err),
+                        "timing": {"queued": 0.0, "run": round(time.time() - received, 6)}}
+        finally:
+            self.slots.release()
+        response["timing"]["total"] = round(time.time() - received, 6)
+        return response
+
+    def close(self):
+        ''' Stops the pool and removes the socket file
+
+            Input: None
+            Output: None
+        '''
+        self.server_close()
+        self.executor.shutdown(cancel_futures=True)
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # Reads requests from a connection one line at a time, answering each in turn
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                job = json.loads(line)
+            except ValueError:
+                job = None
+            if isinstance(job, dict):
+                response = self.server.runJob(job)
+            else:
+                response = {"status": "error", "error": "Requests must be one JSON object per line",
+                            "timing": {"queued": 0.0, "run": 0.0, "total": 0.0}}
+            self.wfile.write(json.dumps(response).encode(encoding="utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def runJob(job, received):
+    ''' Runs one job in a worker process, recording any error instead of
+        raising it
+
+        Input: job <dict>, time the job was received <time.time()>
+        Output: response <dict>
+    '''
+    started = time.time()
+    response = {"id": job.get("id")}
+    try:
+        response.update(JOBS[job["op"]](job))
+        response["status"] = "ok"
+    except KeyError as err:
+        response["status"] = "error"
+        response["error"] = "Missing or unknown key: {}".format(err)
+    except Exception as err:
+        # Bad option values surface as all sorts of errors, none may take the daemon down
+        response["status"] = "error"
+        response["error"] = "{}: {}".format(type(err).__name__, err)
+    response["timing"] = {"queued": round(started - received, 6),
+                          "run": round(time.time() - started, 6)}
+    return response
+
+
+def jobImage(job):
+    ''' The image a job names, as a path or an in-memory file
+
+        Input: job <dict> with "image" or "image_data"
+        Output: path or binary file object
+    '''
+    if "image_data" in job:
+        return io.BytesIO(base64.b64decode(job["image_data"]))
+    return job["image"]
+
+
+def encodeJob(job):
+    ''' Encodes a message or payload into an image
+
+        Input: job <dict>
+        Output: response fields <dict>
+    '''
+    if "payload_data" in job:
+        payload = base64.b64decode(job["payload_data"])
+    else:
+        payload = job["message"]
+    output = job.get("output") or io.BytesIO()
+
+    report = encodeMessage(jobImage(job), output, payload, backend=job.get("backend", "numpy"),
+                           legacy=job.get("legacy", False),
+                           bitsPerChannel=job.get("bits_per_channel", 1),
+                           useAlpha=job.get("use_alpha", False),
+                           convertPalette=job.get("convert_palette", False),
+                           profile=job.get("profile", "balanced"), threads=job.get("threads", 1),
+                           passphrase=job.get("passphrase"), codec=job.get("compress"),
+                           cache=CARRIERS)
+
+    result = {"bytes": report["bytes"], "save_seconds": round(report["seconds"], 6)}
+    if isinstance(output, io.BytesIO):
+        result["image_data"] = base64.b64encode(output.getvalue()).decode(encoding="ascii")
+    return result
+
+
+def decodeJob(job):
+    ''' Extracts the payload of an image, as text if it is valid UTF-8
+
+        Input: job <dict>
+        Output: response fields <dict>
+    '''
+    payload = StegoImage.fromFile(jobImage(job)).extract(job.get("passphrase"),
+                                                         job.get("backend", "numpy"))
+    try:
+        return {"message": payload.decode(encoding="utf-8")}
+    except UnicodeDecodeError:
+        return {"payload_data": base64.b64encode(payload).decode(encoding="ascii")}
+
+
+def inspectJob(job):
+    ''' Reports what an image can carry
+
+        Input: job <dict>
+        Output: response fields <dict>
+    '''
+    return {"report": inspectImage(jobImage(job))}
+
+
+def cliJob(job):
+    ''' Runs a steganography.py encode or decode command line, with its
+        relative paths taken from the client's working directory, capturing
+        what it prints. Subcommands are refused.
+
+        Input: job <dict> with "argv", "cwd" and optional "stdin"
+        Output: response fields <dict>
+    '''
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8", write_through=True)
+    stderr = io.TextIOWrapper(io.BytesIO(), encoding="utf-8", write_through=True)
+    stdin = io.TextIOWrapper(io.BytesIO(base64.b64decode(job.get("stdin", ""))), encoding="utf-8")
+
+    savedStdin = sys.stdin
+    sys.stdin = stdin
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            parser = buildParser()
+            parser.prog = "stegoclient.py"
+            parser.epilog = None
+            try:
+                if job["argv"][:1] and job["argv"][0] in steganography.SUBCOMMANDS:
+                    parser.error("the {} subcommand isn't run by the daemon, run it with "
+                                 "steganography.py".format(job["argv"][0]))
+                args = parser.parse_args(job["argv"])
+            except SystemExit as err:
+                status = err.code
+            else:
+                for name in ("input_image", "output_filename", "payload_file"):
+                    path = getattr(args, name)
+                    if path is not None and path != "-":
+                        setattr(args, name, os.path.join(job["cwd"], path))
+                status = runCommand(args)
+    finally:
+        sys.stdin = savedStdin
+
+    return {"exit_status": status or 0,
+            "stdout": base64.b64encode(stdout.buffer.getvalue()).decode(encoding="ascii"),
+            "stderr": base64.b64encode(stderr.buffer.getvalue()).decode(encoding="ascii")}
+
+
+# Jobs the daemon runs, by "op"
+JOBS = {"encode": encodeJob, "decode": decodeJob, "inspect": inspectJob, "cli": cliJob}
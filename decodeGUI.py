@@ -2,9 +2,32 @@
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-from steganography import extractMessage
-from PIL import Image
-import sys, os
+from steganography import MessageNotFoundError, StegoError, StegoImage, inspectImage
+from collections import OrderedDict
+import bisect, sys, os
+
+# Memory budgets for the decode result and preview caches, in bytes
+MESSAGE_CACHE_BYTES = 16 << 20
+PREVIEW_CACHE_BYTES = 256 << 20
+
+# Largest preview shown, larger images are scaled down to fit
+PREVIEW_SIZE = QSize(1024, 1024)
+
+# Thumbnails shown in the image list, and the memory budget for them
+THUMBNAIL_SIZE = QSize(48, 48)
+THUMBNAIL_CACHE_BYTES = 32 << 20
+
+# Thumbnail jobs left waiting; older ones, for rows scrolled past, are cancelled
+MAX_PENDING_THUMBNAILS = 64
+
+# Files a rescan adds a row at a time; past this the list is rebuilt in one go
+MAX_ROW_INSERTS = 256
+
+# Wait after a change before rescanning, so a burst of writes costs one scan
+RESCAN_DELAY_MS = 200
+
+# Files listed in the image browser
+IMAGE_EXTENSIONS = (".png",)
 
 class App(QApplication):
     # Main application
@@ -38,7 +61,7 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Message decoder")
 
         # Set the size of the main window
-        self.resize(360, 360)
+        self.resize(720, 480)
 
         # Create a main widget object (the central widget)
         self.mainWidget = MainWidget()
@@ -74,6 +97,369 @@ class MainWindow(QMainWindow):
         QMainWindow.closeEvent(self, event)
 
 
+class LRUCache():
+    # Least recently used cache, bounded by the total cost of its entries
+    # rather than their number
+
+    # Input: budget <int, total cost allowed>
+    # Output: None
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        ''' Looks up an entry, marking it most recently used
+
+            Input: key
+            Output: value, or None if not cached
+        '''
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value, cost):
+        ''' Stores an entry, evicting the least recently used ones until the
+            cache is within budget again. Entries costing more than the whole
+            budget are not kept.
+
+            Input: key, value, cost <int>
+            Output: None
+        '''
+        if key in self.entries:
+            self.used -= self.entries.pop(key)[1]
+        if cost > self.budget:
+            return
+        self.entries[key] = (value, cost)
+        self.used += cost
+        while self.used > self.budget:
+            self.used -= self.entries.popitem(last=False)[1][1]
+
+
+def cacheKey(path):
+    ''' Identifies a file's current contents by its path, modification time
+        and size, so a rewritten file misses the cache
+
+        Input: path <str>
+        Output: key <tuple>
+    '''
+    status = os.stat(path)
+    return (path, status.st_mtime_ns, status.st_size)
+
+
+def scanDirectory(directory):
+    ''' Lists the images in a directory with their modification time and
+        size. Files removed while the scan runs are left out.
+
+        Input: directory <path>
+        Output: entries {name: (mtime_ns, size)}
+    '''
+    entries = {}
+    try:
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                try:
+                    if entry.is_file():
+                        status = entry.stat()
+                        entries[entry.name] = (status.st_mtime_ns, status.st_size)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return entries
+
+
+def describeImage(report, fileSize):
+    ''' Tooltip text for an image, from its inspection report
+
+        Input: report <dict, from inspectImage, or with an "error">,
+               file size <bytes>
+        Output: text <str>
+    '''
+    if "error" in report:
+        return report["error"]
+    text = "{} x {} {}, {:,} bytes".format(report["width"], report["height"], report["mode"],
+                                           fileSize)
+    payload = report["payload"]
+    if payload is None:
+        return text + "\nNo payload header"
+    if payload["sharded"]:
+        return text + "\nHolds a shard of {:,} bytes".format(payload["length"])
+    return text + "\nHolds a payload of {:,} bytes".format(payload["length"])
+
+
+class BrowserSignals(QObject):
+    # Signals the image list's workers send back to the UI thread
+
+    scanned = pyqtSignal(object)
+    thumbnailLoaded = pyqtSignal(object, object, str)
+
+
+class ScanWorker(QRunnable):
+    # Lists a directory on a thread pool thread
+
+    # Input: directory <path>, signals <BrowserSignals>
+    # Output: None
+
+    def __init__(self, directory, signals):
+        QRunnable.__init__(self)
+        self.directory = directory
+        self.signals = signals
+
+    def run(self):
+        ''' Scans the directory, emitting scanned with its entries
+
+            Input: None
+            Output: None
+        '''
+        self.signals.scanned.emit(scanDirectory(self.directory))
+
+
+class ThumbnailWorker(QRunnable):
+    # Reads a thumbnail and the inspection report of an image on a thread
+    # pool thread
+
+    # Input: key <tuple, from cacheKey>, signals <BrowserSignals>
+    # Output: None
+
+    def __init__(self, key, signals):
+        QRunnable.__init__(self)
+        self.key = key
+        self.signals = signals
+        self.cancelled = False
+
+    def cancel(self):
+        ''' Asks the worker to skip its image, if it has not started yet
+
+            Input: None
+            Output: None
+        '''
+        self.cancelled = True
+
+    def run(self):
+        ''' Loads the thumbnail and report, emitting thumbnailLoaded with them
+
+            Input: None
+            Output: None
+        '''
+        if self.cancelled:
+            return
+        imagePath, fileSize = self.key[0], self.key[2]
+        reader = QImageReader(imagePath)
+        size = reader.size()
+        if size.isValid():
+            reader.setScaledSize(size.scaled(THUMBNAIL_SIZE, Qt.KeepAspectRatio))
+        thumbnail = reader.read()
+        try:
+            report = inspectImage(imagePath)
+        except (StegoError, OSError) as err:
+            report = {"error": str(err)}
+        self.signals.thumbnailLoaded.emit(self.key, thumbnail, describeImage(report, fileSize))
+
+
+class ImageListModel(QAbstractListModel):
+    # The images in a directory, kept current by a file system watcher. The
+    # directory is scanned in the background, and each scan is applied as
+    # rows inserted, removed or changed. Thumbnails and tooltips are only
+    # loaded, in the background, for the rows a view asks to draw.
+
+    # Input: directory <path>, parent <QObject>
+    # Output: None
+
+    # Emitted with the name of a listed file whose contents changed
+    imageChanged = pyqtSignal(str)
+
+    def __init__(self, directory, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.directory = directory
+        self.names = []
+        self.stats = {}
+        self.thumbnails = LRUCache(THUMBNAIL_CACHE_BYTES)
+        self.pending = OrderedDict()
+        self.scanning = False
+        self.rescan = False
+
+        # Workers report back through one signals object owned by the model
+        self.signals = BrowserSignals(self)
+        self.signals.scanned.connect(self.applyScan)
+        self.signals.thumbnailLoaded.connect(self.storeThumbnail)
+        self.threadPool = QThreadPool(self)
+        self.threadPool.setMaxThreadCount(2)
+
+        # Rescan a moment after the directory, or the file being shown, changes
+        self.rescanTimer = QTimer(self)
+        self.rescanTimer.setSingleShot(True)
+        self.rescanTimer.setInterval(RESCAN_DELAY_MS)
+        self.rescanTimer.timeout.connect(self.startScan)
+        self.watcher = QFileSystemWatcher([directory], self)
+        self.watcher.directoryChanged.connect(self.rescanTimer.start)
+        self.watcher.fileChanged.connect(self.rescanTimer.start)
+
+        self.startScan()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.names):
+            return None
+        name = self.names[index.row()]
+        if role == Qt.DisplayRole:
+            return name
+        if role in (Qt.DecorationRole, Qt.ToolTipRole):
+            key = self.key(name)
+            entry = self.thumbnails.get(key)
+            if entry is None:
+                self.requestThumbnail(key)
+                return None
+            return entry[0] if role == Qt.DecorationRole else entry[1]
+        return None
+
+    def key(self, name):
+        ''' Cache key of a listed file, as cacheKey gives it, from the last scan
+
+            Input: name <str>
+            Output: key <tuple>
+        '''
+        return (os.path.join(self.directory, name),) + self.stats[name]
+
+    def path(self, row):
+        ''' Path of the file in a row
+
+            Input: row <int>
+            Output: path <str>
+        '''
+        return os.path.join(self.directory, self.names[row])
+
+    def rowOf(self, name):
+        ''' Row a file is listed in
+
+            Input: name <str>
+            Output: row <int>, or None if not listed
+        '''
+        row = bisect.bisect_left(self.names, name)
+        if row < len(self.names) and self.names[row] == name:
+            return row
+        return None
+
+    def watchFile(self, path):
+        ''' Watches one file for changes as well as the directory, as a file
+            rewritten in place doesn't change the directory
+
+            Input: path <str>, or None to stop watching files
+            Output: None
+        '''
+        files = self.watcher.files()
+        if files and files != [path]:
+            self.watcher.removePaths(files)
+        if path is not None and path not in files and os.path.exists(path):
+            self.watcher.addPath(path)
+
+    def startScan(self):
+        ''' Scans the directory in the background, or, if a scan is already
+            running, again once it is done
+
+            Input: None
+            Output: None
+        '''
+        if self.scanning:
+            self.rescan = True
+            return
+        self.scanning = True
+        self.rescan = False
+        self.threadPool.start(ScanWorker(self.directory, self.signals))
+
+    def applyScan(self, entries):
+        ''' Brings the rows up to date with a scan, removing, inserting and
+            changing only the rows that differ. A first scan, or one adding
+            many files, rebuilds the list instead.
+
+            Input: entries {name: (mtime_ns, size)}, from scanDirectory
+            Output: None
+        '''
+        self.scanning = False
+        changed = [name for name in self.names
+                   if name in entries and entries[name] != self.stats[name]]
+        added = sorted(name for name in entries if name not in self.stats)
+
+        if added and (not self.names or len(added) > MAX_ROW_INSERTS):
+            self.beginResetModel()
+            self.names = sorted(entries)
+            self.stats = dict(entries)
+            self.endResetModel()
+        else:
+            # Remove runs of adjacent rows, last first, so earlier rows keep their place
+            rows = [row for row, name in enumerate(self.names) if name not in entries]
+            end = len(rows)
+            while end:
+                start = end - 1
+                while start and rows[start - 1] == rows[start] - 1:
+                    start -= 1
+                first, last = rows[start], rows[end - 1]
+                self.beginRemoveRows(QModelIndex(), first, last)
+                for name in self.names[first:last + 1]:
+                    del self.stats[name]
+                del self.names[first:last + 1]
+                self.endRemoveRows()
+                end = start
+
+            for name in added:
+                row = bisect.bisect_left(self.names, name)
+                self.beginInsertRows(QModelIndex(), row, row)
+                self.names.insert(row, name)
+                self.stats[name] = entries[name]
+                self.endInsertRows()
+
+            for name in changed:
+                self.stats[name] = entries[name]
+                index = self.index(self.rowOf(name))
+                self.dataChanged.emit(index, index)
+
+        for name in changed:
+            self.imageChanged.emit(name)
+        if self.rescan:
+            self.startScan()
+
+    def requestThumbnail(self, key):
+        ''' Queues a thumbnail to load, cancelling the oldest waiting ones
+            past MAX_PENDING_THUMBNAILS, as their rows were scrolled past
+
+            Input: key <tuple>
+            Output: None
+        '''
+        if key in self.pending:
+            self.pending.move_to_end(key)
+            return
+        worker = ThumbnailWorker(key, self.signals)
+        self.pending[key] = worker
+        self.threadPool.start(worker)
+        while len(self.pending) > MAX_PENDING_THUMBNAILS:
+            self.pending.popitem(last=False)[1].cancel()
+
+    def storeThumbnail(self, key, thumbnail, tooltip):
+        ''' Caches a loaded thumbnail and tooltip, and redraws its row if the
+            file is still listed unchanged
+
+            Input: key <tuple>, thumbnail <QImage>, tooltip <str>
+            Output: None
+        '''
+        self.pending.pop(key, None)
+        pixmap = QPixmap.fromImage(thumbnail)
+        self.thumbnails.put(key, (pixmap, tooltip),
+                            pixmap.width() * pixmap.height() * pixmap.depth() // 8 + len(tooltip))
+        name = os.path.basename(key[0])
+        row = self.rowOf(name)
+        if row is not None and self.key(name) == key:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole, Qt.ToolTipRole])
+
+
 class MainWidget(QWidget):
     # Central widget, contains widgets and layouts
 
@@ -86,6 +472,8 @@ class MainWidget(QWidget):
         # Initialize variables/file structure
         #####################################
         self.encodedImagesDirectory = "encodedImages"
+        self.messageCache = LRUCache(MESSAGE_CACHE_BYTES)
+        self.previewCache = LRUCache(PREVIEW_CACHE_BYTES)
         if not os.path.exists(os.path.join(sys.path[0], self.encodedImagesDirectory)):
             os.mkdir(os.path.join(sys.path[0], self.encodedImagesDirectory))
 
@@ -96,12 +484,16 @@ class MainWidget(QWidget):
             # Set width
         width = self.imageSelectorLabel.fontMetrics().boundingRect(labelText).width()
         self.imageSelectorLabel.setMaximumWidth(width)
-            # Setup image selector combobox
-        self.imageSelector = QComboBox()
             # Path to image directory
         self.imagePath = os.path.join(sys.path[0], "encodedImages")
-            # Add all images to imageSelector 
-        self.imageSelector.addItems(os.listdir(self.imagePath))
+            # Image list, kept current as files are written to the directory
+        self.imageModel = ImageListModel(self.imagePath, self)
+        self.imageList = QListView()
+        self.imageList.setModel(self.imageModel)
+            # Equal rows let the view ask only the rows it draws for their data
+        self.imageList.setUniformItemSizes(True)
+        self.imageList.setIconSize(THUMBNAIL_SIZE)
+        self.imageList.setMaximumWidth(240)
             # Autodecode checkbox and decode button
         checkboxText = "Decode automatically"
         self.autoDecodeImage = QCheckBox(checkboxText)
@@ -118,31 +510,89 @@ class MainWidget(QWidget):
         self.decodeButton.clicked.connect(self.decodeMessage)
             # Compile imageSelectorLabel
         self.imageSelectorLayout.addWidget(self.imageSelectorLabel)
-        self.imageSelectorLayout.addWidget(self.imageSelector)
         self.imageSelectorLayout.addWidget(self.autoDecodeImage)
         self.imageSelectorLayout.addWidget(self.decodeButton)
         
-        # Initialize image label and update image when selected in ComboBox
+        # Initialize image label and update image when selected in the list
         self.imageLabel = QLabel()
         self.messageFoundLabel = QLabel()
         self.messageLabel = QLabel()
-        self.imageSelector.currentTextChanged.connect(self.showImage)
+        self.imageList.selectionModel().currentChanged.connect(self.showImage)
+        self.imageModel.imageChanged.connect(self.refreshImage)
+
+        # Keep the selection across a rebuilt list, selecting the first image
+        # once there are any
+        self.selectedName = None
+        self.imageModel.modelAboutToBeReset.connect(self.rememberSelection)
+        self.imageModel.modelReset.connect(self.restoreSelection)
 
         self.showImage()
 
         #####################
         # Compile Main Layout
         #####################
+        self.imageLayout = QVBoxLayout()
+        self.imageLayout.addWidget(self.messageFoundLabel, alignment=Qt.AlignHCenter)
+        self.imageLayout.addWidget(self.messageLabel, alignment=Qt.AlignHCenter)
+        self.imageLayout.addStretch(0)
+        self.imageLayout.addWidget(self.imageLabel)
+        self.browserLayout = QHBoxLayout()
+        self.browserLayout.addWidget(self.imageList)
+        self.browserLayout.addLayout(self.imageLayout)
         self.mainLayout.addLayout(self.imageSelectorLayout)
-        self.mainLayout.addWidget(self.messageFoundLabel, alignment=Qt.AlignHCenter)
-        self.mainLayout.addWidget(self.messageLabel, alignment=Qt.AlignHCenter)
-        self.mainLayout.addStretch(0)
-        self.mainLayout.addWidget(self.imageLabel)
+        self.mainLayout.addLayout(self.browserLayout)
+
+
+    def selectedImagePath(self):
+        ''' Path of the image selected in the image list
+
+            Input: None
+            Output: path <str>, or None if none is selected
+        '''
+        index = self.imageList.currentIndex()
+        if not index.isValid():
+            return None
+        return self.imageModel.path(index.row())
+
+
+    def rememberSelection(self):
+        ''' Notes the selected image before the list is rebuilt
+
+            Input: None
+            Output: None
+        '''
+        selectedImagePath = self.selectedImagePath()
+        self.selectedName = selectedImagePath and os.path.basename(selectedImagePath)
+
+
+    def restoreSelection(self):
+        ''' Selects the image noted before the list was rebuilt, or the
+            first image if it is gone
+
+            Input: None
+            Output: None
+        '''
+        row = self.imageModel.rowOf(self.selectedName) if self.selectedName else None
+        if row is None and self.imageModel.rowCount():
+            row = 0
+        if row is not None:
+            self.imageList.setCurrentIndex(self.imageModel.index(row))
+
+
+    def refreshImage(self, name):
+        ''' Shows the selected image again if its file changed
+
+            Input: name <str>
+            Output: None
+        '''
+        selectedImagePath = self.selectedImagePath()
+        if selectedImagePath is not None and os.path.basename(selectedImagePath) == name:
+            self.showImage()
 
 
     def showImage(self):
-        ''' Displays the image selected in the imageSelector combobox, and
-            decodes the message for viewing
+        ''' Displays the image selected in the image list, and decodes the
+            message for viewing
             
             Input: None
             Output: None
@@ -151,32 +601,76 @@ class MainWidget(QWidget):
         # Clear labels
         self.messageFoundLabel.clear()
         self.messageLabel.clear()
-        # Store path to selected image file
-        selectedImagePath = os.path.join(self.imagePath, self.imageSelector.currentText())
+        # Store path to selected image file, watching it for changes
+        selectedImagePath = self.selectedImagePath()
+        self.imageModel.watchFile(selectedImagePath)
+
+        # Display image, decoding it only if it changed since last shown. A
+        # file removed since the last scan is cleared until its row goes.
+        try:
+            key = cacheKey(selectedImagePath) if selectedImagePath is not None else None
+        except OSError:
+            key = None
+        if key is None:
+            self.imageLabel.clear()
+            return
+        pixmap = self.previewCache.get(key)
+        if pixmap is None:
+            pixmap = self.loadPreview(selectedImagePath)
+            self.previewCache.put(key, pixmap, pixmap.width() * pixmap.height() * pixmap.depth() // 8)
 
         # Set label to image size
-        image = Image.open(selectedImagePath)
-        self.imageLabel.setFixedSize(image.size[0], image.size[1])
-
-        # Display image
-        self.imageLabel.setPixmap(QPixmap(selectedImagePath))
+        self.imageLabel.setFixedSize(pixmap.size())
+        self.imageLabel.setPixmap(pixmap)
         if self.autoDecodeImage.isChecked():
             self.decodeMessage()
 
 
+    def loadPreview(self, imagePath):
+        ''' Reads an image for display, scaled down to fit PREVIEW_SIZE
+
+            Input: image path <str>
+            Output: preview <QPixmap>
+        '''
+        reader = QImageReader(imagePath)
+        size = reader.size()
+        if size.width() > PREVIEW_SIZE.width() or size.height() > PREVIEW_SIZE.height():
+            reader.setScaledSize(size.scaled(PREVIEW_SIZE, Qt.KeepAspectRatio))
+        return QPixmap.fromImage(reader.read())
+
+
     def decodeMessage(self):
-        ''' Extracts message out of image '''
+        ''' Extracts message out of image, reusing the result if the file is
+            unchanged since it was last decoded '''
         # Store path to selected image file
-        selectedImagePath = os.path.join(self.imagePath, self.imageSelector.currentText())
+        selectedImagePath = self.selectedImagePath()
+        if selectedImagePath is None:
+            return
 
         # Extract message
-        encodedMessage = extractMessage(selectedImagePath)
-        if encodedMessage == '' or encodedMessage == 'No message found':
-            self.messageFoundLabel.setText("No message found")
-            self.messageLabel.clear()
-        else:
-            self.messageFoundLabel.setText("Encoded message:")
-            self.messageLabel.setText(encodedMessage)
+        try:
+            key = cacheKey(selectedImagePath)
+        except OSError as err:
+            self.messageFoundLabel.setText(str(err))
+            return
+        result = self.messageCache.get(key)
+        if result is None:
+            try:
+                encodedMessage = StegoImage.fromFile(selectedImagePath).extract().decode(
+                                     encoding="utf-8")
+            except (MessageNotFoundError, UnicodeDecodeError):
+                result = ("No message found", "")
+            except StegoError as err:
+                result = (str(err), "")
+            else:
+                if encodedMessage == '':
+                    result = ("No message found", "")
+                else:
+                    result = ("Encoded message:", encodedMessage)
+            self.messageCache.put(key, result, len(result[0]) + len(result[1]))
+
+        self.messageFoundLabel.setText(result[0])
+        self.messageLabel.setText(result[1])
         
 
     def toggleDecodeButton(self):
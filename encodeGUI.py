@@ -2,9 +2,9 @@
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-from steganography import encodeMessage
+from steganography import CarrierCache, StegoError, loadPixels
 from PIL import Image
-import sys, os, shutil
+import sys, os
 
 class App(QApplication):
     # Main application
@@ -70,12 +70,103 @@ class MainWindow(QMainWindow):
             Input: None
             Output: None
         '''
-        if os.path.isfile(os.path.join(sys.path[0], self.mainWidget.tempImage)):
-            os.remove(os.path.join(sys.path[0], self.mainWidget.tempImage))
+        # Let a running encode stop before exiting
+        self.mainWidget.cancelEncoding()
+        self.mainWidget.threadPool.waitForDone()
         print("Application closed")
         QMainWindow.closeEvent(self, event)
 
 
+class EncodeCancelled(Exception):
+    # Raised from a worker's progress callback to abandon its encode
+    pass
+
+
+class EncodeSignals(QObject):
+    # Signals a worker sends back to the UI thread, tagged with its job id
+
+    progress = pyqtSignal(int, int, int)
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+
+# QImage formats the encoded pixels can be shown with as they are
+QIMAGE_FORMATS = {"RGB": QImage.Format_RGB888, "RGBA": QImage.Format_RGBA8888,
+                  "L": QImage.Format_Grayscale8, "I;16": QImage.Format_Grayscale16}
+
+
+def toQImage(image):
+    ''' Wraps an image's pixels in a QImage for display, without a PNG round trip
+
+        Input: image <Image>
+        Output: image <QImage, owning a copy of the pixels>
+    '''
+    if image.mode not in QIMAGE_FORMATS:
+        image = image.convert("RGBA")
+    pixels = loadPixels(image)
+    height, width = pixels.shape[:2]
+    qImage = QImage(pixels.tobytes(), width, height, pixels.strides[0], QIMAGE_FORMATS[image.mode])
+    return qImage.copy()
+
+
+class EncodeWorker(QRunnable):
+    # Encodes a message into an image on a thread pool thread, keeping the
+    # result in memory
+
+    # Input: job id <int>, image file <path>, message <str>, carrier cache
+    #        <CarrierCache> holding the decoded image
+    # Output: None
+
+    def __init__(self, jobId, imageFile, message, carrierCache):
+        QRunnable.__init__(self)
+        self.jobId = jobId
+        self.imageFile = imageFile
+        self.message = message
+        self.carrierCache = carrierCache
+        self.cancelled = False
+        self.signals = EncodeSignals()
+
+    def cancel(self):
+        ''' Asks the worker to stop at its next band of rows. A worker that has
+            not started yet returns straight away.
+
+            Input: None
+            Output: None
+        '''
+        self.cancelled = True
+
+    def reportProgress(self, rows, height):
+        ''' Progress callback for encodeMessage, which is also where
+            cancellation takes effect
+
+            Input: rows done <int>, total rows <int>
+            Output: None
+        '''
+        if self.cancelled:
+            raise EncodeCancelled()
+        self.signals.progress.emit(self.jobId, rows, height)
+
+    def run(self):
+        ''' Runs the encode, emitting finished with the encoded image or
+            failed with the error, unless cancelled
+
+            Input: None
+            Output: None
+        '''
+        if self.cancelled:
+            return
+        try:
+            encodedImage = self.carrierCache.carrier(self.imageFile).embedImage(
+                               self.message, progress=self.reportProgress)
+        except EncodeCancelled:
+            return
+        except (StegoError, OSError) as err:
+            self.signals.failed.emit(self.jobId, str(err))
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(self.jobId, encodedImage)
+
+
 class MainWidget(QWidget):
     # Central widget, contains widgets and layouts
 
@@ -85,7 +176,12 @@ class MainWidget(QWidget):
         #####################################
         # Initialize variables/file structure
         #####################################
-        self.tempImage = "tempImage.png"
+        self.encodedImage = None
+        self.threadPool = QThreadPool.globalInstance()
+        self.worker = None
+        self.jobId = 0
+        # Decoded carriers, so encoding another message skips decoding the image
+        self.carrierCache = CarrierCache()
         self.encodedImagesDirectory = "encodedImages"
         if not os.path.exists(os.path.join(sys.path[0], self.encodedImagesDirectory)):
             os.mkdir(os.path.join(sys.path[0], self.encodedImagesDirectory))
@@ -97,6 +193,7 @@ class MainWidget(QWidget):
         self.leftLayout = QVBoxLayout()
         self.selectorLayout = QHBoxLayout()
         self.messageLayout = QHBoxLayout()
+        self.progressLayout = QHBoxLayout()
         self.rightLayout = QVBoxLayout()
         self.saveFileLayout = QHBoxLayout()
 
@@ -137,6 +234,24 @@ class MainWidget(QWidget):
             # Link button with functionality
         self.generateEncodedImageButton.clicked.connect(self.generateEncodedImage)
 
+        # Re-encode shortly after the message stops changing, superseding any
+        # encode still running for an older message
+        self.encodeTimer = QTimer()
+        self.encodeTimer.setSingleShot(True)
+        self.encodeTimer.setInterval(300)
+        self.encodeTimer.timeout.connect(self.generateEncodedImage)
+        self.inputMessage.textChanged.connect(self.encodeTimer.start)
+
+        # Progress of the running encode, and a button to cancel it
+        self.encodeProgress = QProgressBar()
+        self.encodeProgress.setFormat("%v/%m rows")
+        buttonText = "Cancel"
+        self.cancelEncodeButton = QPushButton(buttonText)
+        width = self.cancelEncodeButton.fontMetrics().boundingRect(buttonText).width() + 7
+        self.cancelEncodeButton.setMaximumWidth(width)
+        self.cancelEncodeButton.setEnabled(False)
+        self.cancelEncodeButton.clicked.connect(self.cancelEncoding)
+
         ###########################
         # Create vertical separator
         ###########################
@@ -175,6 +290,9 @@ class MainWidget(QWidget):
         self.selectorLayout.addWidget(self.imageSelector)
         self.messageLayout.addWidget(self.inputMessage) 
         self.messageLayout.addWidget(self.generateEncodedImageButton)#, alignment=Qt.AlignLeft) 
+        self.leftLayout.addLayout(self.progressLayout)
+        self.progressLayout.addWidget(self.encodeProgress)
+        self.progressLayout.addWidget(self.cancelEncodeButton)
             # Centerline separator
         self.mainLayout.addWidget(self.verticalSeparator, alignment=Qt.AlignHCenter)
             # Right side
@@ -196,6 +314,10 @@ class MainWidget(QWidget):
             Input: None
             Output: None
         '''
+        # An encode of the previous image is no longer wanted
+        self.cancelEncoding()
+        self.encodedImage = None
+
         # Store path to selected image file
         selectedImagePath = os.path.join(self.imagePath, self.imageSelector.currentText())
 
@@ -209,6 +331,7 @@ class MainWidget(QWidget):
         # Adjust QLineEdit lengths to match image width
         self.inputMessage.setFixedWidth(self.imageLabel.width() - self.generateEncodedImageButton.width())
         self.nameOutputImage.setFixedWidth(self.imageLabel.width() - self.saveImageButton.width())
+        self.encodeProgress.setFixedWidth(self.imageLabel.width() - self.cancelEncodeButton.width())
 
         # Set up right side image label
         self.embeddedImageLabel.setFixedSize(image.size[0], image.size[1])
@@ -216,27 +339,90 @@ class MainWidget(QWidget):
 
 
     def generateEncodedImage(self):
-        ''' Passes the message string and selected image to steganography
-            program, and displays the resultant image
-            
+        ''' Passes the message string and selected image to a background
+            worker, superseding any encode still in flight
+
+            Input: None
+            Output: None
+        '''
+        self.encodeTimer.stop()
+        self.cancelEncoding()
+
+        self.jobId += 1
+        self.worker = EncodeWorker(self.jobId, os.path.join(self.imagePath, self.imageSelector.currentText()),
+                                   self.inputMessage.displayText(), self.carrierCache)
+        self.worker.signals.progress.connect(self.showProgress)
+        self.worker.signals.finished.connect(self.showEncodedImage)
+        self.worker.signals.failed.connect(self.showEncodeError)
+
+        self.encodeProgress.reset()
+        self.cancelEncodeButton.setEnabled(True)
+        self.threadPool.start(self.worker)
+
+    def cancelEncoding(self):
+        ''' Cancels the encode in flight, if any. Signals it already sent
+            are ignored, as they carry an old job id.
+
             Input: None
             Output: None
         '''
-        encodeMessage(os.path.join(self.imagePath, self.imageSelector.currentText()),
-                      os.path.join(sys.path[0], self.tempImage), self.inputMessage.displayText())
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        self.cancelEncodeButton.setEnabled(False)
+        self.encodeProgress.reset()
+
+    def showProgress(self, jobId, rows, height):
+        ''' Updates the progress bar with the rows the current encode has done
 
-        self.embeddedImageLabel.setPixmap(QPixmap(os.path.join(sys.path[0], self.tempImage)))
+            Input: job id <int>, rows done <int>, total rows <int>
+            Output: None
+        '''
+        if jobId != self.jobId or self.worker is None:
+            return
+        self.encodeProgress.setMaximum(height)
+        self.encodeProgress.setValue(rows)
+
+    def showEncodedImage(self, jobId, encodedImage):
+        ''' Displays the image the current encode produced, and keeps it in
+            memory for saving
+
+            Input: job id <int>, encoded image <StegoImage>
+            Output: None
+        '''
+        if jobId != self.jobId or self.worker is None:
+            return
+        self.worker = None
+        self.cancelEncodeButton.setEnabled(False)
+
+        self.encodedImage = encodedImage
+        self.embeddedImageLabel.setPixmap(QPixmap.fromImage(toQImage(encodedImage.toPil())))
+
+    def showEncodeError(self, jobId, message):
+        ''' Displays why the current encode failed
+
+            Input: job id <int>, error message <str>
+            Output: None
+        '''
+        if jobId != self.jobId or self.worker is None:
+            return
+        self.worker = None
+        self.cancelEncodeButton.setEnabled(False)
+        self.encodeProgress.reset()
+        self.embeddedImageLabel.setText(message)
 
     def saveImage(self):
-        ''' Copies the currently displayed encoded image to the output name of user's choice
+        ''' Saves the currently displayed encoded image as a PNG, with the output name of user's choice
 
             Input: None
             Output: None
         '''
+        if self.encodedImage is None:
+            return
         outputFileName = self.nameOutputImage.displayText()
         if not outputFileName[-4:] == ".png": outputFileName += ".png"
-        shutil.copy(os.path.join(sys.path[0], self.tempImage),
-                    os.path.join(sys.path[0], self.encodedImagesDirectory, outputFileName))
+        self.encodedImage.save(os.path.join(sys.path[0], self.encodedImagesDirectory,
+                                            outputFileName))
 
 
 def main():
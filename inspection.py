@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+import argparse
+import glob
+import json
+import os
+import sys
+from steganography import StegoError, inspectImage
+
+################################################################################
+# Image inspection
+#
+#   Reports what each image can carry, as one JSON object per line, reading
+#   only the PNG header and the first rows of every file, so large corpora
+#   can be sorted into carriers and payload holders cheaply.
+#
+#       steganography.py inspect <image|dir|glob> [...]
+#
+#   Every line has the image's size, mode and bit depth, its capacity in
+#   bytes at 1-4 bits per channel ("capacity_alpha" with the alpha channel
+#   too), and "payload", the container header found, or null.
+################################################################################
+
+def main(argv):
+    ''' Entry point for the inspect subcommand
+
+        Input: argv <list>, starting at the subcommand name
+        Output: exit status, 0 if every file could be inspected
+    '''
+    parser = argparse.ArgumentParser(prog="steganography.py " + argv[0])
+    parser.add_argument("sources", help="Images, directories or glob patterns", type=str, nargs="+")
+    args = parser.parse_args(argv[1:])
+
+    missing = []
+    images = list(collectImages(args.sources, missing))
+    for source in missing:
+        print("No image found at \"{}\"".format(source), file=sys.stderr)
+
+    failures = len(missing)
+    for imageFile in images:
+        try:
+            report = inspectImage(imageFile)
+        except (StegoError, OSError) as err:
+            failures += 1
+            report = {"image": imageFile, "error": "{}: {}".format(type(err).__name__, err)}
+        sys.stdout.write(json.dumps(report) + "\n")
+
+    return 1 if failures else 0
+
+
+def collectImages(sources, missing=None):
+    ''' Expands directories and glob patterns into image paths
+
+        Input: sources [path or pattern], missing <list> that sources naming
+               no file and matching none are appended to
+        Output: generator of paths
+    '''
+    for source in sources:
+        if os.path.isdir(source):
+            yield from sorted(glob.glob(os.path.join(source, "*.png")))
+        elif os.path.exists(source):
+            yield source
+        else:
+            matches = sorted(glob.glob(source))
+            if not matches and missing is not None:
+                missing.append(source)
+            yield from matches
@@ -0,0 +1,247 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+################################################################################
+# Per-stage metrics
+#
+#   Records how an encode or decode spends its time, stage by stage: format
+#   check, open, payload conversion, embed or extract, serialize and save.
+#   Each stage reports its wall time, the samples it touched, the bytes it
+#   read and wrote, and the peak memory of the process when it ended. A stage
+#   entered several times, such as once per band or chunk, adds up, and a
+#   stage entered inside another pauses the outer one, so no time is counted
+#   twice.
+#
+#       with metrics.Stats(hook=print) as stats:
+#           encodeMessage("castle.png", "out.png", "Message", stats=stats)
+#       stats.report()
+#
+#   Capture modes add detail at some cost in speed: "cprofile" profiles the
+#   whole run and reports the functions with the most cumulative time, and
+#   "tracemalloc" traces Python and NumPy allocations, giving every stage the
+#   peak of memory allocated while it ran, and the lines that allocated most.
+################################################################################
+
+CAPTURE_MODES = ("cprofile", "tracemalloc")
+
+# Entries kept in the profile and allocation listings of a report
+TOP_ENTRIES = 20
+
+
+class Stats:
+    # Collects the metrics of one run, calling hook(stage name, stage totals)
+    # each time a stage ends
+
+    # Input: hook <function(name, stage <dict>)> or None, capture mode <name
+    #        in CAPTURE_MODES or None>
+    # Output: None
+
+    def __init__(self, hook=None, capture=None):
+        if capture is not None and capture not in CAPTURE_MODES:
+            raise ValueError("Unknown capture mode \"{}\"".format(capture))
+        self.hook = hook
+        self.capture = capture
+        self.stages = {}
+        self.active = []
+        self.profiler = None
+        self.snapshot = None
+        self.started = None
+        self.seconds = None
+        self.ownTracing = False
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        if self.capture == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.capture == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.ownTracing = True
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.capture == "tracemalloc" and tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            if self.ownTracing:
+                tracemalloc.stop()
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' Times a stage, pausing the one it runs inside of
+
+            Input: name <str>
+            Output: context manager giving the stage totals <dict>
+        '''
+        now = time.perf_counter()
+        if self.active:
+            self.pause(now)
+        record = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "samples": 0,
+                                               "bytes_read": 0, "bytes_written": 0,
+                                               "peak_rss": 0})
+        record["calls"] += 1
+        self.active.append([record, now])
+        self.resetPeak()
+        try:
+            yield record
+        finally:
+            now = time.perf_counter()
+            self.pause(now)
+            self.active.pop()
+            if self.active:
+                self.active[-1][1] = now
+                self.resetPeak()
+            if self.hook: self.hook(name, record)
+
+    def pause(self, now):
+        ''' Adds the time and memory of the innermost stage so far to its totals
+
+            Input: now <time.perf_counter()>
+            Output: None
+        '''
+        record, started = self.active[-1]
+        record["seconds"] += now - started
+        record["peak_rss"] = max(record["peak_rss"], peakRSS())
+        if tracemalloc.is_tracing():
+            record["peak_traced"] = max(record.get("peak_traced", 0),
+                                        tracemalloc.get_traced_memory()[1])
+
+    def resetPeak(self):
+        ''' Starts a fresh traced peak for the stage now running
+
+            Input: None
+            Output: None
+        '''
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def count(self, samples=0, bytesRead=0, bytesWritten=0):
+        ''' Adds to the counters of the innermost stage running
+
+            Input: samples touched, bytes read, bytes written <int>
+            Output: None
+        '''
+        if self.active:
+            record = self.active[-1][0]
+            record["samples"] += samples
+            record["bytes_read"] += bytesRead
+            record["bytes_written"] += bytesWritten
+
+    def report(self):
+        ''' The metrics of the run, with the capture mode's findings
+
+            Input: None
+            Output: report {"seconds", "peak_rss", "stages": {name: totals},
+                    and "profile" or "allocations" [dict]}
+        '''
+        report = {"seconds": self.seconds, "peak_rss": peakRSS(), "stages": self.stages}
+        if self.profiler is not None:
+            profile = pstats.Stats(self.profiler)
+            entries = sorted(profile.stats.items(), key=lambda item: item[1][3], reverse=True)
+            report["profile"] = [{"function": "{}:{}({})".format(*function), "calls": calls,
+                                  "seconds": ownTime, "cumulative": cumulative}
+                                 for function, (_, calls, ownTime, cumulative, _)
+                                 in entries[:TOP_ENTRIES]]
+        if self.snapshot is not None:
+            report["allocations"] = [{"line": "{}:{}".format(stat.traceback[0].filename,
+                                                             stat.traceback[0].lineno),
+                                      "bytes": stat.size, "count": stat.count}
+                                     for stat in self.snapshot.statistics("lineno")[:TOP_ENTRIES]]
+        return report
+
+
+def stage(stats, name):
+    ''' Times a stage if metrics are being collected
+
+        Input: stats <Stats or None>, stage name <str>
+        Output: context manager
+    '''
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
+
+
+def count(stats, samples=0, bytesRead=0, bytesWritten=0):
+    ''' Adds to the counters of the stage running, if metrics are being
+        collected
+
+        Input: stats <Stats or None>, samples touched, bytes read, bytes written <int>
+        Output: None
+    '''
+    if stats is not None:
+        stats.count(samples, bytesRead, bytesWritten)
+
+
+def timed(stats, name, iterable):
+    ''' Times each step of an iterable as a stage, such as a stream read a
+        chunk at a time or an image decoded a band at a time
+
+        Input: stats <Stats or None>, stage name <str>, iterable
+        Output: generator of the iterable's items
+    '''
+    iterator = iter(iterable)
+    while True:
+        with stage(stats, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def peakRSS():
+    ''' Peak resident set size of this process in bytes, 0 where it can't be
+        read. VmHWM is used where available, as ru_maxrss carries the
+        parent's peak across exec on Linux.
+
+        Input: None
+        Output: bytes <int>
+    '''
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def formatReport(report, style="json"):
+    ''' Renders a report as JSON, or as a table for the terminal
+
+        Input: report <dict, from Stats.report>, style <"json" or "text">
+        Output: text <str>
+    '''
+    if style == "json":
+        return json.dumps(report)
+
+    traced = any("peak_traced" in record for record in report["stages"].values())
+    lines = ["{:<10} {:>10} {:>6} {:>12} {:>12} {:>12} {:>10}{}".format(
+             "stage", "seconds", "calls", "samples", "read", "written", "peak MB",
+             " {:>10}".format("traced MB") if traced else "")]
+    for name, record in report["stages"].items():
+        lines.append("{:<10} {:>10.6f} {:>6} {:>12} {:>12} {:>12} {:>10.1f}{}".format(
+                     name, record["seconds"], record["calls"], record["samples"],
+                     record["bytes_read"], record["bytes_written"], record["peak_rss"] / 2**20,
+                     " {:>10.1f}".format(record.get("peak_traced", 0) / 2**20) if traced else ""))
+    lines.append("{:<10} {:>10.6f}".format("total", report["seconds"]))
+    for entry in report.get("profile", []):
+        lines.append("{:>10.6f} {:>10.6f} {:>8} {}".format(entry["cumulative"], entry["seconds"],
+                                                        entry["calls"], entry["function"]))
+    for entry in report.get("allocations", []):
+        lines.append("{:>12} {:>8} {}".format(entry["bytes"], entry["count"], entry["line"]))
+    return "\n".join(lines)
@@ -0,0 +1,613 @@
+#!/usr/bin/python3
+import io
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+################################################################################
+# PNG input/output
+#
+#   Low level PNG writing, for when Pillow's single threaded encoder is the
+#   bottleneck. Rows are filtered with NumPy and split into bands, and each
+#   band is compressed as raw DEFLATE on its own thread (zlib releases the GIL
+#   while compressing). Bands end on a sync flush and are primed with the last
+#   32 KB of the band before them, pigz style, so together they still form one
+#   ordinary zlib stream. PNGWriter instead takes the image a band of rows at
+#   a time, for images too large to hold in memory.
+#
+#   Reading goes the other way only as far as needed: the IHDR chunk alone,
+#   or rows decoded lazily from the top, inflating no more of the image data
+#   than the rows asked for cover. None, Sub and Up rows are unfiltered with
+#   NumPy; Average and Paeth rows, which go a byte at a time, by Pillow.
+################################################################################
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG color type and bit depth of each supported image mode
+MODE_FORMATS = {"L": (0, 8), "RGB": (2, 8), "LA": (4, 8), "RGBA": (6, 8), "I;16": (0, 16)}
+
+# Image mode of each color type, as Pillow names them
+COLOR_TYPE_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+
+# Samples per pixel of each color type
+COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Row filter types
+FILTER_NONE, FILTER_SUB, FILTER_UP, FILTER_AVERAGE, FILTER_PAETH = range(5)
+FILTERS = {"none": FILTER_NONE, "sub": FILTER_SUB, "up": FILTER_UP, "average": FILTER_AVERAGE,
+           "paeth": FILTER_PAETH, "adaptive": None}
+
+# How rows of each filter type are undone: on their own, from the row above
+# with NumPy, or from the row above by Pillow, as 8 bit images of the color
+# type with the same pixel size in bytes
+KIND_OWN, KIND_UP, KIND_PREDICTED = range(3)
+UNFILTER_KINDS = np.array([KIND_OWN, KIND_OWN, KIND_UP, KIND_PREDICTED, KIND_PREDICTED])
+UNFILTER_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# Uncompressed bytes per band, and DEFLATE's window size
+BAND_BYTES = 1 << 20
+WINDOW_BYTES = 1 << 15
+
+# Ancillary chunks kept when an image's pixels are rewritten, besides those
+# marked safe to copy: the color space and transparency still hold once only
+# the low bits of samples have changed
+KEPT_CHUNKS = {b"iCCP", b"sRGB", b"gAMA", b"cHRM", b"tRNS"}
+
+
+def chunk(chunkType, data):
+    ''' Builds a PNG chunk, with its length and crc
+
+        Input: chunkType <4 bytes>, data <bytes>
+        Output: chunk <bytes>
+    '''
+    return (struct.pack(">I", len(data)) + chunkType + data
+            + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunkType))))
+
+
+def metadataChunks(image):
+    ''' Builds the ancillary chunks that carry an image's metadata (text,
+        gamma, chromaticity, sRGB, ICC profile, dpi, EXIF and transparency)
+
+        Input: image <Image>
+        Output: chunks [(chunkType, data)]
+    '''
+    info = image.info
+    chunks = []
+    if "icc_profile" in info:
+        chunks.append((b"iCCP", b"ICC Profile\x00\x00" + zlib.compress(info["icc_profile"])))
+    elif "srgb" in info:
+        chunks.append((b"sRGB", struct.pack(">B", info["srgb"])))
+    if "gamma" in info:
+        chunks.append((b"gAMA", struct.pack(">I", round(info["gamma"] * 100000))))
+    if "chromaticity" in info:
+        chunks.append((b"cHRM", struct.pack(">8I", *(round(value * 100000)
+                                                     for value in info["chromaticity"]))))
+    if "dpi" in info:
+        chunks.append((b"pHYs", struct.pack(">IIB", *(round(value / 0.0254) for value in info["dpi"]), 1)))
+
+    # A palette index means nothing once converted, and alpha replaces it
+    if "transparency" in info and image.mode in ("RGB", "L", "I;16"):
+        transparency = info["transparency"]
+        if isinstance(transparency, tuple):
+            chunks.append((b"tRNS", struct.pack(">3H", *transparency)))
+        elif isinstance(transparency, int):
+            chunks.append((b"tRNS", struct.pack(">H", transparency)))
+
+    if "exif" in info:
+        exif = info["exif"]
+        chunks.append((b"eXIf", exif[6:] if exif.startswith(b"Exif\x00\x00") else exif))
+
+    for key, value in getattr(image, "text", {}).items():
+        try:
+            chunks.append((b"tEXt", key.encode("latin-1") + b"\x00" + value.encode("latin-1")))
+        except UnicodeEncodeError:
+            chunks.append((b"iTXt", key.encode("utf-8") + b"\x00\x00\x00\x00\x00"
+                                    + value.encode("utf-8")))
+    return chunks
+
+
+def rowBytes(pixels):
+    ''' Views pixels as rows of big endian bytes, as PNG stores them
+
+        Input: pixels <np.uint8 or np.uint16 array of (height, width, channels)>
+        Output: rows <np.uint8 array of (height, row bytes)>
+    '''
+    if pixels.dtype.itemsize > 1:
+        pixels = pixels.astype(">u2")
+    return np.ascontiguousarray(pixels).view(np.uint8).reshape(pixels.shape[0], -1)
+
+
+def filterRows(rows, prior, bytesPerPixel, filterType):
+    ''' Filters a band of rows, prefixing each with its filter type. The
+        adaptive filter picks, per row, the type with the smallest sum of
+        absolute differences, as libpng does.
+
+        Input: rows <np.uint8 array of (rows, row bytes)>, prior <row above
+               the band, zeros at the top of the image>, bytesPerPixel <int>,
+               filterType <int, or None for adaptive>
+        Output: filtered rows <bytes>
+    '''
+    rows = rows.astype(np.int16)
+    up = np.vstack((prior[None].astype(np.int16), rows[:-1]))
+    left = np.zeros_like(rows)
+    left[:, bytesPerPixel:] = rows[:, :-bytesPerPixel]
+    upLeft = np.zeros_like(up)
+    upLeft[:, bytesPerPixel:] = up[:, :-bytesPerPixel]
+
+    def predict(filterType):
+        if filterType == FILTER_NONE:
+            return 0
+        if filterType == FILTER_SUB:
+            return left
+        if filterType == FILTER_UP:
+            return up
+        if filterType == FILTER_AVERAGE:
+            return (left + up) >> 1
+        estimate = left + up - upLeft
+        distanceLeft = np.abs(estimate - left)
+        distanceUp = np.abs(estimate - up)
+        distanceUpLeft = np.abs(estimate - upLeft)
+        return np.where((distanceLeft <= distanceUp) & (distanceLeft <= distanceUpLeft), left,
+                        np.where(distanceUp <= distanceUpLeft, up, upLeft))
+
+    if filterType is None:
+        candidates = np.stack([(rows - predict(candidate)).astype(np.uint8)
+                               for candidate in range(5)])
+        cost = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        types = cost.argmin(axis=0)
+        filtered = candidates[types, np.arange(rows.shape[0])]
+    else:
+        types = np.full(rows.shape[0], filterType)
+        filtered = (rows - predict(filterType)).astype(np.uint8)
+
+    return np.hstack((types[:, None].astype(np.uint8), filtered)).tobytes()
+
+
+def compressBand(data, dictionary, level, last):
+    ''' Compresses one band as raw DEFLATE, primed with the end of the band
+        before it, ending on a sync flush so the next band can follow on
+
+        Input: data <bytes>, dictionary <bytes>, level <0-9>, last flag
+        Output: compressed band <bytes>
+    '''
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def zlibHeader(level):
+    ''' The two byte zlib stream header zlib itself writes for a level
+
+        Input: level <0-9>
+        Output: header <bytes>
+    '''
+    if level < 2:
+        return b"\x78\x01"
+    if level < 6:
+        return b"\x78\x5e"
+    if level == 6:
+        return b"\x78\x9c"
+    return b"\x78\xda"
+
+
+def writePNG(output, pixels, mode, level=6, filterType=None, threads=1, chunks=()):
+    ''' Writes pixels as a PNG, compressing row bands on a pool of threads
+
+        Input: output <path or binary file object>, pixels <array of (height,
+               width, channels)>, mode <Image mode>, level <0-9>, filterType
+               <int, or None for adaptive>, threads <int>, ancillary chunks
+               [(chunkType, data)]
+        Output: bytes written <int>
+    '''
+    height, width = pixels.shape[:2]
+    colorType, bitDepth = MODE_FORMATS[mode]
+    rows = rowBytes(pixels)
+    bytesPerPixel = max(1, rows.shape[1] // width)
+
+    # Split the image into bands of whole rows
+    bandRows = max(1, BAND_BYTES // rows.shape[1])
+    starts = range(0, height, bandRows)
+
+    def filterBand(start):
+        prior = rows[start - 1] if start else np.zeros(rows.shape[1], dtype=np.uint8)
+        return filterRows(rows[start:start + bandRows], prior, bytesPerPixel, filterType)
+
+    ownFile = isinstance(output, str)
+    stream = open(output, "wb") if ownFile else output
+    try:
+        written = stream.write(SIGNATURE)
+        written += stream.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bitDepth,
+                                                           colorType, 0, 0, 0)))
+        for chunkType, data in chunks:
+            written += stream.write(chunk(chunkType, data))
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            bands = list(executor.map(filterBand, starts))
+            dictionaries = [b""] + [band[-WINDOW_BYTES:] for band in bands[:-1]]
+            compressed = executor.map(compressBand, bands, dictionaries, [level] * len(bands),
+                                      [index == len(bands) - 1 for index in range(len(bands))])
+
+            # One IDAT per band, with the zlib header up front and checksum at the end
+            checksum = 1
+            for index, (band, data) in enumerate(zip(bands, compressed)):
+                checksum = zlib.adler32(band, checksum)
+                if index == 0:
+                    data = zlibHeader(level) + data
+                if index == len(bands) - 1:
+                    data += struct.pack(">I", checksum)
+                written += stream.write(chunk(b"IDAT", data))
+
+        written += stream.write(chunk(b"IEND", b""))
+    finally:
+        if ownFile:
+            stream.close()
+
+    return written
+
+
+def readChunk(stream):
+    ''' Reads the next chunk, without checking its crc
+
+        Input: stream <binary file object>
+        Output: (chunkType <4 bytes>, data <bytes>)
+        Raises: ValueError if the file ends mid chunk
+    '''
+    header = stream.read(8)
+    if len(header) < 8:
+        raise ValueError("Truncated PNG file")
+    length, chunkType = struct.unpack(">I4s", header)
+    data = stream.read(length)
+    if len(data) < length or len(stream.read(4)) < 4:
+        raise ValueError("Truncated PNG file")
+    return chunkType, data
+
+
+def readHeader(stream):
+    ''' Reads the signature and IHDR chunk, leaving the stream at the chunk after
+
+        Input: stream <binary file object>
+        Output: header {"width", "height", "bit_depth", "color_type", "interlaced", "mode"}
+        Raises: ValueError if this is not a PNG file
+    '''
+    if stream.read(len(SIGNATURE)) != SIGNATURE:
+        raise ValueError("Not a PNG file")
+    chunkType, data = readChunk(stream)
+    if chunkType != b"IHDR" or len(data) != 13:
+        raise ValueError("PNG file does not start with an IHDR chunk")
+    width, height, bitDepth, colorType, _, _, interlace = struct.unpack(">IIBBBBB", data)
+
+    mode = COLOR_TYPE_MODES.get(colorType)
+    if mode == "L" and bitDepth == 16:
+        mode = "I;16"
+    elif mode == "L" and bitDepth == 1:
+        mode = "1"
+    return {"width": width, "height": height, "bit_depth": bitDepth, "color_type": colorType,
+            "interlaced": bool(interlace), "mode": mode}
+
+
+def unfilterRows(data, rowLength, bytesPerPixel, prior=None):
+    ''' Reverses the row filters of decompressed image data. None, Sub and
+        Up rows are undone with NumPy: Sub as a running sum along each byte
+        of the pixel, and a run of Up rows as one running sum down the
+        columns. Average and Paeth bytes depend on the byte decoded to their
+        left, so runs of those rows are handed to unfilterImage instead.
+
+        Input: data <bytes of whole filtered rows>, rowLength <bytes per row,
+               without the filter type>, bytesPerPixel <int>, prior <row above
+               the first, None at the top of the image>
+        Output: rows <np.uint8 array of (rows, row bytes)>
+        Raises: ValueError on an unknown filter type
+    '''
+    filtered = np.frombuffer(data, dtype=np.uint8).reshape(-1, rowLength + 1)
+    types = filtered[:, 0]
+    if types.size and types.max() > FILTER_PAETH:
+        raise ValueError("Unknown PNG filter type {}".format(types.max()))
+    count = filtered.shape[0]
+    rows = np.empty((count, rowLength), dtype=np.uint8)
+
+    # Rows that don't look at the row above can all be done at once
+    none = types == FILTER_NONE
+    if none.any():
+        rows[none] = filtered[none, 1:]
+    sub = types == FILTER_SUB
+    if sub.any():
+        pixels = filtered[sub, 1:].reshape(-1, rowLength // bytesPerPixel, bytesPerPixel)
+        rows[sub] = np.cumsum(pixels, axis=1, dtype=np.uint8).reshape(-1, rowLength)
+
+    # The rest follow on from the row decoded above them, a run of the same kind at a time
+    kinds = UNFILTER_KINDS[types]
+    starts = np.flatnonzero(np.diff(kinds, prepend=-1))
+    up = np.zeros(rowLength, dtype=np.uint8) if prior is None else prior
+    for start, stop in zip(starts, np.append(starts[1:], count)):
+        if kinds[start] == KIND_UP:
+            rows[start:stop] = np.cumsum(filtered[start:stop, 1:], axis=0, dtype=np.uint8) + up
+        elif kinds[start] == KIND_PREDICTED:
+            rows[start:stop] = unfilterImage(filtered[start:stop], up, bytesPerPixel)
+        up = rows[stop - 1]
+    return rows
+
+
+def unfilterImage(filtered, prior, bytesPerPixel):
+    ''' Unfilters rows with Pillow, which does it in C. Pixels of 6 or 8
+        bytes, 16 bit RGB(A), are split in half first: the bytes a filter
+        looks back to are a whole pixel away, so each half unfilters on its
+        own as 8 bit RGB(A).
+
+        Input: filtered <np.uint8 array of (rows, 1 + row bytes)>, prior
+               <np.uint8 array, the row above>, bytesPerPixel <int>
+        Output: rows <np.uint8 array of (rows, row bytes)>
+    '''
+    if bytesPerPixel in UNFILTER_COLOR_TYPES:
+        return unfilterPNG(filtered, prior, bytesPerPixel)
+
+    count, rowLength, half = filtered.shape[0], filtered.shape[1] - 1, bytesPerPixel // 2
+    halves = filtered[:, 1:].reshape(count, -1, 2, half)
+    priors = prior.reshape(-1, 2, half)
+    rows = np.empty((count, rowLength // bytesPerPixel, 2, half), dtype=np.uint8)
+    for index in range(2):
+        part = np.concatenate((filtered[:, :1], halves[:, :, index].reshape(count, -1)), axis=1)
+        rows[:, :, index] = unfilterPNG(part, priors[:, index].reshape(-1),
+                                        half).reshape(count, -1, half)
+    return rows.reshape(count, rowLength)
+
+
+def unfilterPNG(filtered, prior, bytesPerPixel):
+    ''' Unfilters rows as the image data of an 8 bit PNG, stored without
+        compression, after an unfiltered copy of the row above them
+
+        Input: filtered <np.uint8 array of (rows, 1 + row bytes)>, prior
+               <np.uint8 array, the row above>, bytesPerPixel <1-4>
+        Output: rows <np.uint8 array of (rows, row bytes)>
+    '''
+    rowLength = filtered.shape[1] - 1
+    imageData = np.empty((filtered.shape[0] + 1, rowLength + 1), dtype=np.uint8)
+    imageData[0, 0] = FILTER_NONE
+    imageData[0, 1:] = prior
+    imageData[1:] = filtered
+
+    header = struct.pack(">IIBBBBB", rowLength // bytesPerPixel, imageData.shape[0], 8,
+                         UNFILTER_COLOR_TYPES[bytesPerPixel], 0, 0, 0)
+    png = (SIGNATURE + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(imageData, 0))
+           + chunk(b"IEND", b""))
+    with Image.open(io.BytesIO(png)) as image:
+        image.load()
+        return np.asarray(image).reshape(imageData.shape[0], rowLength)[1:]
+
+
+class RowReader():
+    # Decodes the rows of a non interlaced PNG image only as they are asked
+    # for, inflating just enough IDAT data to cover them. Slicing rows off it
+    # gives a NumPy array, as slicing the array of the whole image would.
+
+    # Input: image file <path or binary file object>, header <from
+    #        readHeader, if the stream is already past the IHDR chunk>
+    # Output: None
+    # Raises: ValueError if this is not a PNG file, or it can't be read by row
+
+    def __init__(self, imageFile, header=None):
+        self.ownFile = isinstance(imageFile, str)
+        self.stream = open(imageFile, "rb") if self.ownFile else imageFile
+        try:
+            self.header = readHeader(self.stream) if header is None else header
+            if self.header["interlaced"] or self.header["bit_depth"] < 8:
+                raise ValueError("Only non interlaced images of 8 or 16 bits per sample can be "
+                                 "read by row")
+
+            # Keep the chunks before the image data, and the first IDAT for decoding
+            self.chunks = []
+            chunkType, data = readChunk(self.stream)
+            while chunkType != b"IDAT":
+                if chunkType == b"IEND":
+                    raise ValueError("PNG file has no image data")
+                self.chunks.append((chunkType, data))
+                chunkType, data = readChunk(self.stream)
+            self.imageData = data
+        except ValueError:
+            self.close()
+            raise
+
+        width, height = self.header["width"], self.header["height"]
+        channels = COLOR_TYPE_CHANNELS[self.header["color_type"]]
+        sampleBytes = self.header["bit_depth"] // 8
+        self.mode = self.header["mode"]
+        self.size = (width, height)
+        self.shape = (height, width, channels)
+        self.rowLength = width * channels * sampleBytes
+        self.bytesPerPixel = channels * sampleBytes
+
+        self.decompressor = zlib.decompressobj()
+        self.pixels = np.empty((0, width, channels),
+                               dtype=np.uint16 if sampleBytes > 1 else np.uint8)
+        self.prior = None
+        self.decoded = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        ''' Closes the file, if it was opened from a path
+
+            Input: None
+            Output: None
+        '''
+        if self.ownFile:
+            self.stream.close()
+
+    def __getitem__(self, index):
+        ''' Rows of the image, decoding any not decoded yet
+
+            Input: index <int, or slice of rows with a step of 1>
+            Output: pixels <np.uint8 or np.uint16 array>
+        '''
+        rows = range(self.shape[0])[index]
+        if isinstance(rows, int):
+            self.decode(rows + 1)
+            return self.pixels[rows]
+        if rows.step != 1:
+            raise IndexError("Rows can only be read in order")
+        self.decode(rows.stop)
+        return self.pixels[rows.start:max(rows.start, rows.stop)]
+
+    def decode(self, stop):
+        ''' Decodes rows until the first stop rows are available
+
+            Input: stop <row count>
+            Output: None
+            Raises: ValueError if the image data is cut short or corrupted
+        '''
+        stop = min(stop, self.shape[0])
+        if stop <= self.decoded:
+            return
+        rows = self.inflateRows(stop - self.decoded)
+
+        # Grow the buffer geometrically, so reading a few rows at a time stays linear
+        if stop > self.pixels.shape[0]:
+            grown = np.empty((min(max(stop, 2 * self.pixels.shape[0]), self.shape[0]),)
+                             + self.shape[1:], dtype=self.pixels.dtype)
+            grown[:self.decoded] = self.pixels[:self.decoded]
+            self.pixels = grown
+        self.pixels[self.decoded:stop] = rows
+        self.decoded = stop
+
+    def bands(self, bandRows):
+        ''' Decodes the image from the top a band of rows at a time, keeping
+            none of them, so only one band is ever in memory. The reader
+            can't be sliced afterwards.
+
+            Input: bandRows <int>
+            Output: generator of bands <np.uint8 or np.uint16 array of (rows,
+                    width, channels)>, each a private, writable array
+            Raises: ValueError if the image data is cut short or corrupted
+        '''
+        for start in range(self.decoded, self.shape[0], bandRows):
+            yield self.inflateRows(min(bandRows, self.shape[0] - start))
+
+    def inflateRows(self, count):
+        ''' Inflates and unfilters the next rows of the image data
+
+            Input: count <rows>
+            Output: rows <np.uint8 or np.uint16 array of (rows, width, channels)>
+            Raises: ValueError if the image data is cut short or corrupted
+        '''
+        wanted = count * (self.rowLength + 1)
+        data = bytearray()
+        try:
+            while len(data) < wanted:
+                compressed = self.decompressor.unconsumed_tail or self.nextImageData()
+                data += self.decompressor.decompress(compressed, wanted - len(data))
+        except zlib.error as err:
+            raise ValueError("Corrupted PNG image data ({})".format(err))
+
+        rows = unfilterRows(data, self.rowLength, self.bytesPerPixel, self.prior)
+        self.prior = rows[-1].copy()
+        if self.pixels.dtype == np.uint16:
+            rows = rows.view(">u2").astype(np.uint16)
+        return rows.reshape((-1,) + self.shape[1:])
+
+    def nextImageData(self):
+        ''' Reads up to the next IDAT chunk, skipping any other chunks
+
+            Input: None
+            Output: compressed data <bytes>
+            Raises: ValueError if the image data ends first
+        '''
+        if self.imageData is not None:
+            data, self.imageData = self.imageData, None
+            return data
+        while not self.decompressor.eof:
+            chunkType, data = readChunk(self.stream)
+            if chunkType == b"IDAT":
+                return data
+            if chunkType == b"IEND":
+                break
+        raise ValueError("PNG image data ends early")
+
+
+class PNGWriter():
+    # Writes a PNG a band of rows at a time, filtering and compressing each
+    # band as it arrives, so the whole image never has to be in memory
+
+    # Input: output <path or binary file object>, size (width, height), mode
+    #        <Image mode>, level <0-9>, filterType <int, or None for
+    #        adaptive>, ancillary chunks [(chunkType, data)]
+    # Output: None
+
+    def __init__(self, output, size, mode, level=6, filterType=None, chunks=()):
+        self.ownFile = isinstance(output, str)
+        self.stream = open(output, "wb") if self.ownFile else output
+        self.size = size
+        self.filterType = filterType
+        colorType, bitDepth = MODE_FORMATS[mode]
+        self.bytesPerPixel = COLOR_TYPE_CHANNELS[colorType] * bitDepth // 8
+        self.prior = np.zeros(size[0] * self.bytesPerPixel, dtype=np.uint8)
+        self.compressor = zlib.compressobj(level)
+        self.rows = 0
+
+        self.written = self.stream.write(SIGNATURE)
+        self.written += self.stream.write(chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1],
+                                                                     bitDepth, colorType, 0, 0, 0)))
+        for chunkType, data in chunks:
+            self.written += self.stream.write(chunk(chunkType, data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        if self.ownFile:
+            self.stream.close()
+
+    def write(self, pixels):
+        ''' Filters and compresses the next band of rows, in pieces of about
+            BAND_BYTES so the filter's working arrays stay small
+
+            Input: pixels <array of (rows, width, channels)>
+            Output: None
+        '''
+        rows = rowBytes(pixels)
+        pieceRows = max(1, BAND_BYTES // rows.shape[1])
+        for start in range(0, rows.shape[0], pieceRows):
+            piece = rows[start:start + pieceRows]
+            filtered = filterRows(piece, self.prior, self.bytesPerPixel, self.filterType)
+            self.writeData(self.compressor.compress(filtered))
+            self.prior = piece[-1].copy()
+        self.rows += rows.shape[0]
+
+    def finish(self):
+        ''' Flushes the compressor and ends the file
+
+            Input: None
+            Output: bytes written <int>
+            Raises: ValueError if fewer or more rows were written than the image has
+        '''
+        if self.rows != self.size[1]:
+            raise ValueError("Wrote {} rows of an image {} rows high".format(self.rows,
+                                                                            self.size[1]))
+        self.writeData(self.compressor.flush())
+        self.written += self.stream.write(chunk(b"IEND", b""))
+        return self.written
+
+    def writeData(self, data):
+        ''' Writes compressed data as an IDAT chunk, unless there is none yet
+
+            Input: data <bytes>
+            Output: None
+        '''
+        if data:
+            self.written += self.stream.write(chunk(b"IDAT", data))
+
+
+def keptChunks(chunks):
+    ''' Picks the ancillary chunks still valid once an image's pixels are
+        rewritten: those marked safe to copy, and KEPT_CHUNKS
+
+        Input: chunks [(chunkType, data)]
+        Output: chunks [(chunkType, data)]
+    '''
+    return [(chunkType, data) for chunkType, data in chunks
+            if chunkType[0] & 0x20 and (chunkType[3] & 0x20 or chunkType in KEPT_CHUNKS)]
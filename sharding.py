@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from inspection import collectImages
+from steganography import (CODECS, FLAG_CODEC, MODE_CHANNELS, SAVE_PROFILES, SHARD,
+                           CapacityError, MessageNotFoundError, StegoError,
+                           UnsupportedFormatError, compressPayload, containerSegments, embedNumpy,
+                           extractShard, openImage, openLazyImage, openPayloadFile,
+                           payloadCapacity, readImageHeader, replacedOnSuccess, saveImage,
+                           sizeCapacity, writePayload)
+
+################################################################################
+# Sharding a payload over several images
+#
+#   Splits a payload too large for any one carrier over a set of images. The
+#   payload is compressed whole, then cut into shards sized in proportion to
+#   each image's capacity, and the shards are encoded on a pool of worker
+#   processes. Every shard starts with the payload's id, its sequence number
+#   and the shard count, and sets the shard flag in the container header, so
+#   the images can be decoded in any order, concurrently, and the payload is
+#   written out in order as the shards come in.
+#
+#       steganography.py encode-shards <image|dir|glob> [...] -p <payload> -o <dir>
+#       steganography.py decode-shards <image|dir|glob> [...] -p <payload>
+################################################################################
+
+def main(argv):
+    ''' Entry point for the encode-shards and decode-shards subcommands
+
+        Input: argv <list>, starting at the subcommand name
+        Output: exit status
+    '''
+    command = argv[0]
+    parser = argparse.ArgumentParser(prog="steganography.py " + command)
+    parser.add_argument("sources", help="Images, directories or glob patterns", type=str,
+                                   nargs="+")
+    if command == "encode-shards":
+        payload = parser.add_mutually_exclusive_group(required=True)
+        payload.add_argument("-m", "--message", help="Message to split over the images", type=str)
+        payload.add_argument("-p", "--payload-file", help="File to split over the images, "
+                                               "- for stdin", type=str)
+        parser.add_argument("-o", "--output_dir", help="Directory for encoded images", type=str,
+                                              default="encodedImages")
+        parser.add_argument("-k", "--bits-per-channel", help="Payload bits per color sample (1-4)",
+                                              type=int, choices=range(1, 5), default=1)
+        parser.add_argument("-a", "--use-alpha", help="Also store the payload in the alpha channel",
+                                              action="store_true")
+        parser.add_argument("-c", "--compress", help="Compress the payload before splitting it",
+                                              choices=list(CODECS), default=None)
+        parser.add_argument("--convert-palette", help="Convert palette images to RGB(A) first",
+                                              action="store_true")
+        parser.add_argument("--profile", help="PNG save profile", choices=list(SAVE_PROFILES),
+                                              default="balanced")
+    else:
+        parser.add_argument("-p", "--payload-file", help="File to write the payload to, "
+                                               "- for stdout", type=str, default="-")
+    parser.add_argument("-s", "--passphrase", help="Passphrase to scatter the shards with",
+                                          type=str, default=None)
+    parser.add_argument("-j", "--workers", help="Number of worker processes", type=int,
+                                          default=os.cpu_count())
+    args = parser.parse_args(argv[1:])
+
+    missing = []
+    images = list(collectImages(args.sources, missing))
+    try:
+        if missing:
+            raise StegoError("No image found at \"{}\"".format(missing[0]))
+        if command == "encode-shards":
+            if args.payload_file is not None:
+                with openPayloadFile(args.payload_file, "rb") as stream:
+                    payload = stream.read()
+            else:
+                payload = args.message
+            os.makedirs(args.output_dir, exist_ok=True)
+            outputs = [os.path.join(args.output_dir, os.path.basename(image)) for image in images]
+            for result in encodeShards(images, outputs, payload, args.bits_per_channel,
+                                       args.use_alpha, args.convert_palette, args.profile,
+                                       args.passphrase, args.compress, args.workers):
+                print(json.dumps(result))
+        else:
+            # The payload only takes the file's place once every shard checks out
+            with replacedOnSuccess(args.payload_file) as target:
+                with openPayloadFile(target, "wb") as stream:
+                    extractShards(images, stream, passphrase=args.passphrase,
+                                  workers=args.workers)
+    except StegoError as err:
+        print(err, file=sys.stderr)
+        return err.exitCode
+    return 0
+
+
+def encodeShards(imageFiles, outputFiles, payload, bitsPerChannel=1, useAlpha=False,
+                 convertPalette=False, profile="balanced", passphrase=None, codec=None,
+                 workers=None):
+    ''' Splits a payload over several images, one shard each, sized by the
+        capacity of each image, and encodes them on a process pool
+
+        Input: image files [path], output files [path], payload <str or
+               bytes>, bitsPerChannel <1-4>, useAlpha flag, convertPalette
+               flag, PNG save profile, passphrase <str or None>, codec <name
+               in CODECS or None>, workers <int>
+        Output: results [{"image", "output", "sequence", "shard_bytes",
+                "bytes"}], in shard order
+        Raises: StegoError, UnsupportedFormatError, CapacityError
+    '''
+    if not imageFiles:
+        raise StegoError("No images given")
+    if len(set(outputFiles)) != len(outputFiles):
+        raise StegoError("Two of the images would be saved under the same name")
+    if len(imageFiles) > 0xffff:
+        raise StegoError("A payload can be split over at most 65535 images")
+
+    if isinstance(payload, str):
+        payload = payload.encode(encoding="utf-8")
+    payload, codec = compressPayload(payload, codec)
+
+    capacities = [carrierCapacity(imageFile, bitsPerChannel, useAlpha, convertPalette)
+                  for imageFile in imageFiles]
+    sizes = shardSizes(len(payload), capacities)
+    payloadId = os.urandom(8)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        offset = 0
+        for sequence, (imageFile, outputFile, size) in enumerate(zip(imageFiles, outputFiles,
+                                                                     sizes)):
+            shard = SHARD.pack(payloadId, sequence, len(sizes)) + payload[offset:offset + size]
+            offset += size
+            futures.append(executor.submit(encodeShard, imageFile, outputFile, shard,
+                                           bitsPerChannel, useAlpha, convertPalette, profile,
+                                           passphrase, codec))
+        for sequence, future in enumerate(futures):
+            report = future.result()
+            results.append({"image": imageFiles[sequence], "output": outputFiles[sequence],
+                            "sequence": sequence, "shard_bytes": sizes[sequence],
+                            "bytes": report["bytes"]})
+    return results
+
+
+def carrierCapacity(imageFile, bitsPerChannel=1, useAlpha=False, convertPalette=False):
+    ''' Payload bytes a shard in this image can hold, reading only the PNG
+        header unless the image has to be converted from a palette
+
+        Input: imageFile <path>, bitsPerChannel <1-4>, useAlpha flag,
+               convertPalette flag
+        Output: capacity in bytes <int>
+        Raises: UnsupportedFormatError, CapacityError if not even the shard
+                header fits
+    '''
+    header = readImageHeader(imageFile)
+    if header["mode"] == "P":
+        capacity = payloadCapacity(openImage(imageFile, convertPalette), bitsPerChannel, useAlpha)
+    elif header["mode"] in MODE_CHANNELS:
+        capacity = sizeCapacity((header["width"], header["height"]), header["mode"],
+                                bitsPerChannel, useAlpha)
+    else:
+        raise UnsupportedFormatError("Sorry, but {} images are not supported".format(
+                                     header["mode"]))
+
+    if capacity < SHARD.size:
+        raise CapacityError("\"{}\" is too small to carry a shard".format(imageFile))
+    return capacity - SHARD.size
+
+
+def shardSizes(length, capacities):
+    ''' Splits a payload's length over the images in proportion to their
+        capacities, handing the bytes lost to rounding to images with room left
+
+        Input: payload length <int>, capacities [int]
+        Output: shard sizes [int]
+        Raises: CapacityError
+    '''
+    room = sum(capacities)
+    if length > room:
+        raise CapacityError("These images hold {} bytes between them, too few for a payload of "
+                            "{} bytes".format(room, length))
+
+    sizes = [length * capacity // room if room else 0 for capacity in capacities]
+    remainder = length - sum(sizes)
+    for index, capacity in enumerate(capacities):
+        if not remainder:
+            break
+        if sizes[index] < capacity:
+            sizes[index] += 1
+            remainder -= 1
+    return sizes
+
+
+def encodeShard(imageFile, outputFile, shard, bitsPerChannel, useAlpha, convertPalette, profile,
+                passphrase, codec):
+    ''' Encodes one shard into its image, in a worker process
+
+        Input: image file, output file, shard <bytes, with its shard header>,
+               and the options of encodeShards
+        Output: save report {"bytes", "seconds"}
+    '''
+    image = openImage(imageFile, convertPalette)
+    segments = containerSegments(image, shard, bitsPerChannel, useAlpha, passphrase, codec,
+                                 shard=True)
+    return saveImage(image, embedNumpy(image, segments), outputFile, profile)
+
+
+def extractShards(imageFiles, stream, backend="numpy", passphrase=None, workers=None):
+    ''' Reads the shards of a payload from several images on a process pool,
+        writing the payload to a stream in order as the shards come in
+
+        Input: image files [path], in any order, stream <binary file object>,
+               extraction backend, passphrase <str or None>, workers <int>
+        Output: number of payload bytes written <int>
+        Raises: UnsupportedFormatError, MessageNotFoundError if a shard is
+                missing, repeated, or from another payload
+    '''
+    if not imageFiles:
+        raise StegoError("No images given")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(readShard, imageFile, backend, passphrase)
+                   for imageFile in imageFiles]
+        shards = (future.result() for future in as_completed(futures))
+        first = next(shards)
+        try:
+            return writePayload(orderShards(itertools.chain([first], shards), first),
+                                first[3], stream)
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def readShard(imageFile, backend="numpy", passphrase=None):
+    ''' Reads the shard an image holds, in a worker process, naming the
+        image in any error
+
+        Input: image file, extraction backend, passphrase <str or None>
+        Output: shard, as from extractShard
+        Raises: StegoError
+    '''
+    try:
+        with openLazyImage(imageFile, backend) as image:
+            return extractShard(image, backend=backend, passphrase=passphrase)
+    except StegoError as err:
+        raise type(err)("\"{}\": {}".format(imageFile, err))
+
+
+def orderShards(shards, first):
+    ''' Puts shards back in sequence, holding back those that arrive early,
+        and checks they all belong to the same payload
+
+        Input: shards [(payload id, sequence, count, flags, data)], in any
+               order, the first of them
+        Output: generator of shard data <bytes>, in sequence order
+        Raises: MessageNotFoundError
+    '''
+    payloadId, _, count, flags, _ = first
+    pending = {}
+    expected = 0
+    for shardId, sequence, shardCount, shardFlags, data in shards:
+        if (shardId, shardCount, shardFlags & FLAG_CODEC) != (payloadId, count, flags & FLAG_CODEC):
+            raise MessageNotFoundError("These images hold shards of more than one payload")
+        if sequence >= count:
+            raise MessageNotFoundError("Shard {} claims to be one of only {}".format(sequence + 1,
+                                                                                    count))
+        if sequence < expected or sequence in pending:
+            raise MessageNotFoundError("Shard {} of {} turns up twice".format(sequence + 1, count))
+        pending[sequence] = data
+        while expected in pending:
+            yield pending.pop(expected)
+            expected += 1
+
+    if expected < count:
+        missing = [str(sequence + 1) for sequence in range(expected, count)
+                   if sequence not in pending]
+        raise MessageNotFoundError("Shard{} {} of {} {} missing".format(
+                                   "s" if len(missing) > 1 else "", ", ".join(missing), count,
+                                   "are" if len(missing) > 1 else "is"))
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+from batch import runJobs
+from inspection import collectImages
+from steganography import MODE_CHANNELS, UnsupportedFormatError, loadPixels
+
+################################################################################
+# Steganalysis
+#
+#   Scans images for LSB payloads, whatever wrote them, and ranks them by how
+#   likely they are to hold one. Each image is decoded once, and every test
+#   runs over the same pixel buffer a band of rows at a time:
+#
+#       chi_square   Westfeld and Pfitzmann's pairs of values test. Embedding
+#                    evens out the counts of 2k and 2k+1, so "p" near 1 means
+#                    a payload. Run over the whole image and every band, as
+#                    a sequential payload only fills the top rows.
+#       rs           Fridrich's RS analysis, which estimates the share of
+#                    samples carrying a payload ("rate", 0-1) from how
+#                    flipping LSBs changes the smoothness of groups of four.
+#       lsb_entropy  Entropy of the LSB plane read as bytes, per band, in
+#                    bits per bit; close to 1 for encrypted or compressed
+#                    payloads, lower where the plane follows the picture.
+#
+#   The score is the largest of the whole image and first band chi-square p
+#   and the RS rate.
+#
+#       steganography.py scan <image|dir|glob> [...] [-j WORKERS] [--rank]
+################################################################################
+
+# Rows of pixels in each band the tests report on
+BAND_ROWS = 64
+
+# Pairs of values with fewer expected samples than this are left out of the
+# chi-square statistic, where it no longer follows the distribution
+MIN_EXPECTED = 5
+
+
+def main(argv):
+    ''' Entry point for the scan subcommand
+
+        Input: argv <list>, starting at the subcommand name
+        Output: exit status, 0 if every file could be scanned
+    '''
+    parser = argparse.ArgumentParser(prog="steganography.py " + argv[0])
+    parser.add_argument("sources", help="Images, directories or glob patterns", type=str,
+                                   nargs="+")
+    parser.add_argument("-j", "--workers", help="Number of worker processes", type=int,
+                                          default=os.cpu_count())
+    parser.add_argument("--rank", help="Write the results once all are in, highest score "
+                                       "first, instead of as each image finishes",
+                                  action="store_true")
+    parser.add_argument("--min-score", help="Only report images scoring at least this",
+                                       type=float, default=0.0)
+    parser.add_argument("--band-rows", help="Rows of pixels per band", type=int,
+                                       default=BAND_ROWS)
+    parser.add_argument("-r", "--results", help="File to write JSONL results to, - for stdout",
+                                          type=str, default="-")
+    args = parser.parse_args(argv[1:])
+
+    missing = []
+    jobs = [{"image": imageFile, "band_rows": args.band_rows}
+            for imageFile in collectImages(args.sources, missing)]
+    for source in missing:
+        print("No image found at \"{}\"".format(source), file=sys.stderr)
+    results = sys.stdout if args.results == "-" else open(args.results, "w")
+    failures = len(missing)
+    ranked = []
+    try:
+        for result in runJobs(scanJob, jobs, args.workers):
+            failures += result["status"] != "ok"
+            if result.get("score", 1.0) < args.min_score:
+                continue
+            if args.rank:
+                ranked.append(result)
+                continue
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+        for result in sorted(ranked, key=lambda result: result.get("score", -1.0), reverse=True):
+            results.write(json.dumps(result) + "\n")
+    finally:
+        if results is not sys.stdout:
+            results.close()
+
+    return 1 if failures else 0
+
+
+def scanJob(job):
+    ''' Scans one image, recording any error instead of raising it
+
+        Input: job <dict> with "image" and "band_rows" keys
+        Output: result <dict>
+    '''
+    start = time.perf_counter()
+    try:
+        result = scanImage(job["image"], job.get("band_rows", BAND_ROWS))
+        result["status"] = "ok"
+    except Exception as err:
+        result = {"image": job["image"], "status": "error",
+                  "error": "{}: {}".format(type(err).__name__, err)}
+    result["seconds"] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def scanImage(imageFile, bandRows=BAND_ROWS):
+    ''' Runs every test over an image, decoding it only once
+
+        Input: imageFile <path or binary file object, any format Pillow
+               reads>, bandRows <int>
+        Output: report {"image", "size", "mode", "score", "chi_square",
+                "rs", "bands": [{"row", "chi_square", "lsb_entropy"}]}
+        Raises: UnsupportedFormatError
+    '''
+    with Image.open(imageFile) as image:
+        pixels = samplePlanes(image)
+        size, mode = image.size, image.mode
+
+    bins = 1 << (8 * pixels.dtype.itemsize)
+    histogram = np.zeros(bins, dtype=np.int64)
+    rsCounts = np.zeros(9, dtype=np.int64)
+    bands = []
+    for top in range(0, pixels.shape[0], bandRows):
+        band = pixels[top:top + bandRows]
+        bandHistogram = np.bincount(band.ravel(), minlength=bins)
+        histogram += bandHistogram
+        rsCounts += regularSingular(band)
+        bands.append({"row": top, "chi_square": chiSquare(bandHistogram)["p"],
+                      "lsb_entropy": lsbEntropy(band)})
+
+    report = {"image": imageFile if isinstance(imageFile, str) else None, "size": list(size),
+              "mode": mode, "chi_square": chiSquare(histogram), "rs": rsEstimate(rsCounts),
+              "bands": bands}
+    scores = [report["chi_square"]["p"], report["rs"]["rate"], bands[0]["chi_square"] if bands
+              else None]
+    report["score"] = max([score for score in scores if score is not None], default=0.0)
+    return report
+
+
+def samplePlanes(image):
+    ''' The color samples of an image, as a payload would be written to them:
+        alpha is left out, and palette images give their indices
+
+        Input: image <Image>
+        Output: samples <np.uint8 or np.uint16 array of (height, width, channels)>
+        Raises: UnsupportedFormatError
+    '''
+    if image.mode == "P":
+        colorChannels = 1
+    elif image.mode in MODE_CHANNELS:
+        colorChannels = MODE_CHANNELS[image.mode][0]
+    else:
+        raise UnsupportedFormatError("Sorry, but {} images are not supported".format(image.mode))
+    return loadPixels(image)[:, :, :colorChannels]
+
+
+def chiSquare(histogram):
+    ''' Pairs of values test on a histogram of samples
+
+        Input: histogram <array of counts, even length>
+        Output: {"statistic", "dof", "p"}, p the probability the pairs were
+                evened out by embedding, None without enough samples
+    '''
+    even = histogram[0::2].astype(np.float64)
+    odd = histogram[1::2].astype(np.float64)
+    expected = (even + odd) / 2
+    used = expected >= MIN_EXPECTED
+    dof = int(used.sum()) - 1
+    if dof < 1:
+        return {"statistic": None, "dof": max(dof, 0), "p": None}
+    statistic = float(((even[used] - expected[used]) ** 2 / expected[used]).sum())
+    return {"statistic": round(statistic, 3), "dof": dof,
+            "p": round(chiSquareSurvival(statistic, dof), 6)}
+
+
+def chiSquareSurvival(statistic, dof):
+    ''' Chance of a chi-square statistic this large or larger, with the
+        Wilson-Hilferty approximation, which is close for the hundred or so
+        degrees of freedom 8 bit samples give
+
+        Input: statistic <float>, dof <int>
+        Output: probability <float>
+    '''
+    spread = 2 / (9 * dof)
+    z = ((statistic / dof) ** (1 / 3) - (1 - spread)) / math.sqrt(spread)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def regularSingular(band):
+    ''' Counts the regular and singular groups of four horizontally adjacent
+        samples, with the mask 0110 flipped both ways, in a band as it is and
+        with every LSB flipped
+
+        Input: band <array of (rows, width, channels)>
+        Output: counts <np.int64 array of R_M, S_M, R_-M, S_-M as is, the
+                same with LSBs flipped, and the number of groups>
+    '''
+    usable = band.shape[1] - band.shape[1] % 4
+    columns = [band[:, offset:usable:4].astype(np.int32).ravel() for offset in range(4)]
+
+    counts = []
+    for first, second, third, fourth in (columns, [column ^ 1 for column in columns]):
+        smoothness = roughness(first, second, third, fourth)
+        for flip in (lambda values: values ^ 1, lambda values: ((values + 1) ^ 1) - 1):
+            changed = roughness(first, flip(second), flip(third), fourth)
+            counts += [np.count_nonzero(changed > smoothness),
+                       np.count_nonzero(changed < smoothness)]
+    return np.array(counts + [first.size], dtype=np.int64)
+
+
+def roughness(first, second, third, fourth):
+    ''' Sum of the differences between neighbours in groups of four samples,
+        given a column at a time
+
+        Input: the groups' samples <np.int32 arrays>, by position
+        Output: roughness of each group <np.int32 array>
+    '''
+    return np.abs(second - first) + np.abs(third - second) + np.abs(fourth - third)
+
+
+def rsEstimate(counts):
+    ''' Estimates the share of samples carrying a payload from RS counts
+
+        Input: counts <array, from regularSingular, summed over bands>
+        Output: {"rate": 0-1, or None without any groups, "groups"}
+    '''
+    groups = int(counts[8])
+    if not groups:
+        return {"rate": None, "groups": 0}
+    rM, sM, rNegM, sNegM, rMFlipped, sMFlipped, rNegMFlipped, sNegMFlipped = counts[:8] / groups
+    d0, d1 = rM - sM, rMFlipped - sMFlipped
+    dNeg0, dNeg1 = rNegM - sNegM, rNegMFlipped - sNegMFlipped
+
+    # 2(d1 + d0)z^2 + (d-0 - d-1 - d1 - 3d0)z + d0 - d-0 = 0, taking the smaller root
+    a = 2 * (d1 + d0)
+    b = dNeg0 - dNeg1 - d1 - 3 * d0
+    c = d0 - dNeg0
+    if abs(a) < 1e-12:
+        z = -c / b if abs(b) > 1e-12 else 0.0
+    else:
+        discriminant = max(b * b - 4 * a * c, 0.0)
+        z = min(((-b + math.sqrt(discriminant)) / (2 * a),
+                 (-b - math.sqrt(discriminant)) / (2 * a)), key=abs)
+    rate = z / (z - 0.5) if z != 0.5 else 1.0
+    return {"rate": round(min(max(float(rate), 0.0), 1.0), 6), "groups": groups}
+
+
+def lsbEntropy(band):
+    ''' Entropy of a band's LSB plane, read as bytes along the rows
+
+        Input: band <array of (rows, width, channels)>
+        Output: bits of entropy per LSB, 0-1 <float>
+    '''
+    symbols = np.packbits((band & 1).astype(np.uint8).ravel())
+    counts = np.bincount(symbols, minlength=256)
+    probabilities = counts[counts > 0] / symbols.size
+    return round(float(-(probabilities * np.log2(probabilities)).sum() / 8), 6)
@@ -1,7 +1,26 @@
 #!/usr/bin/python3
 import argparse
-import imghdr
-from PIL import Image
+import collections
+import contextlib
+import hashlib
+import importlib
+import io
+import lzma
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+from PIL import Image, PngImagePlugin
+import metrics
+import pngio
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 ################################################################################
 # Steganography - the practice of hiding data "in plain sight"
@@ -11,20 +30,375 @@ from PIL import Image
 #         compression, complicating the encoding process 
 ################################################################################
 
+################################################################################
+# Container format
+#
+#   Payloads are written behind a fixed size header, one bit per color sample:
+#
+#       magic (4) | version (1) | flags (1) | payload length (8) | crc32 (4)
+#
+#   Fields are big endian, and the crc32 covers the payload bytes. The low two
+#   bits of flags hold the number of payload bits per color sample, less one,
+#   the next bit is set when the payload also uses the alpha channel, and the
+#   one after when the payload is scattered with a passphrase. The two bits
+#   above that hold the codec the payload was compressed with, if any; the
+#   length and crc32 are then those of the compressed bytes. The bit above
+#   those is set when the image holds one shard of a payload split over
+#   several images; the stored bytes then start with a shard header:
+#
+#       payload id (8) | sequence number (2) | shard count (2)
+#
+#   Shards are cut from the stored, compressed payload, so they are only
+#   decompressed once put back together.
+#
+#   The header is always one bit per sample in the color channels, so it can
+#   be read before the flags are known. The payload starts on the first whole
+#   pixel after it.
+#
+#   Images written before the header existed hold ASCII text ended by a \x00
+#   byte, and are still decoded when no header is found.
+################################################################################
+MAGIC = b"\x89STG"
+VERSION = 1
+HEADER = struct.Struct(">4sBBQI")
+HEADER_BITS = HEADER.size * 8
+FLAG_BITS_PER_CHANNEL = 0x03
+FLAG_ALPHA = 0x04
+FLAG_SCATTER = 0x08
+FLAG_CODEC = 0x30
+CODEC_SHIFT = 4
+FLAG_SHARD = 0x40
+SHARD = struct.Struct(">8sHH")
+MAX_BITS_PER_CHANNEL = 4
+
+# Payload codecs, as (number in the header flags, compressor factory,
+# decompressor factory). zstd is only available with the zstandard package.
+CODECS = {"zlib": (1, lambda: zlib.compressobj(9), zlib.decompressobj),
+          "lzma": (2, lzma.LZMACompressor, lzma.LZMADecompressor)}
+if zstandard is not None:
+    CODECS["zstd"] = (3, lambda: zstandard.ZstdCompressor(level=19).compressobj(),
+                      lambda: zstandard.ZstdDecompressor().decompressobj())
+CODEC_NAMES = {1: "zlib", 2: "lzma", 3: "zstd"}
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ())
+
+################################################################################
+# Keyed scattering
+#
+#   With a passphrase, payload value i goes to sample P(i) of the samples
+#   after the header rather than sample i, P being a permutation keyed by the
+#   passphrase. P is an unbalanced Feistel network over the fewest bits that
+#   cover the sample count, walking the cycle until it lands inside it, so
+#   any position can be computed on its own, a batch at a time, without ever
+#   building the whole permutation. The header stays in place so it can be
+#   found without the passphrase.
+################################################################################
+SCATTER_ROUNDS = 4
+SCATTER_ITERATIONS = 20000
+SCATTER_BATCH = 1 << 16
+
+# Image modes that can carry a message, as (color channels, alpha channels).
+# Color channels always come first in a pixel.
+MODE_CHANNELS = {"RGB": (3, 0), "RGBA": (3, 1), "L": (1, 0), "LA": (1, 1), "I;16": (1, 0)}
+
+# Modes of 8 bit arrays, by channel count
+ARRAY_MODES = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}
+
+# PNG save profiles, as (zlib level, row filter, Pillow optimize flag)
+SAVE_PROFILES = {"fast": (1, "sub", False), "balanced": (6, "adaptive", False),
+                 "small": (9, "adaptive", True)}
+
+# Rows of pixels embedded at a time, between progress reports
+ROWS_PER_BAND = 256
+
+# Bytes of pixels held per band of rows when encoding with --low-memory
+BAND_BYTES = 1 << 22
+
+# Bytes of pixel data extraction decodes row by row with pngio. Reads reaching
+# further hand the whole image to Pillow, whose C decoder unfilters far faster.
+LAZY_READ_BYTES = 1 << 18
+
+# Bytes of decoded pixels a CarrierCache holds by default
+CARRIER_CACHE_BYTES = 256 << 20
+
+# Bytes of payload handled at a time when streaming. A multiple of 3 bytes is
+# a whole number of samples at every bits per channel setting.
+CHUNK_SIZE = 3 << 18
+
+# Subcommands, mapped to the module implementing them. Each module's main()
+# takes the command line starting at the subcommand name.
+SUBCOMMANDS = {"encode-batch": "batch", "decode-batch": "batch", "inspect": "inspection",
+               "serve": "daemon", "encode-shards": "sharding", "decode-shards": "sharding",
+               "scan": "steganalysis"}
+
+
+class StegoError(Exception):
+    ''' Base class for errors raised while encoding or decoding. exitCode is
+        the status the command line tool exits with.
+    '''
+    exitCode = 1
+
+
+class UnsupportedFormatError(StegoError):
+    ''' Input file is not a supported image format '''
+    exitCode = 1
+
+
+class CapacityError(StegoError):
+    ''' Message does not fit in the image '''
+    exitCode = 2
+
+
+class MessageNotFoundError(StegoError):
+    ''' Image holds no readable message '''
+    exitCode = 3
+
+
 def main():
-    parser = argparse.ArgumentParser()
+    # Hand subcommands over to their own module
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        exit(importlib.import_module(SUBCOMMANDS[sys.argv[1]]).main(sys.argv[1:]))
+
+    exit(runCommand(buildParser().parse_args()))
+
+
+def buildParser():
+    ''' Builds the command line parser, shared with the daemon so its client
+        takes the same flags
+
+        Input: None
+        Output: parser <argparse.ArgumentParser>
+    '''
+    parser = argparse.ArgumentParser(epilog="Subcommands: " + ", ".join(SUBCOMMANDS))
     parser.add_argument("input_image", help="Input image file", type=str)
     parser.add_argument("-m", "--message", help="Message to encode in input file", type=str)
+    parser.add_argument("-p", "--payload-file", help="File to encode, or with -d to write the "
+                                          "decoded payload to; - for stdin/stdout", type=str)
     parser.add_argument("-d", "--decode", help="Decode input file", action="store_true")
     parser.add_argument("-o", "--output_filename", help="Name for output image", type=str,
                                           default="output.png", nargs='?')
     parser.add_argument("-v", "--verbose", help="Enable verbose output", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument("-b", "--backend", help="Embedding/extraction backend",
+                                          choices=sorted(EMBED_BACKENDS), default="numpy")
+    parser.add_argument("--legacy", help="Write the old \\x00 delimited ASCII format",
+                                          action="store_true")
+    parser.add_argument("-k", "--bits-per-channel", help="Payload bits stored per color sample",
+                                          type=int, choices=range(1, MAX_BITS_PER_CHANNEL + 1),
+                                          default=1)
+    parser.add_argument("-a", "--use-alpha", help="Store payload in the alpha channel too",
+                                          action="store_true")
+    parser.add_argument("--convert-palette", help="Convert palette images to RGB(A) first",
+                                          action="store_true")
+    parser.add_argument("-s", "--passphrase", help="Scatter the payload over the image with, "
+                                          "or read a scattered payload with, this passphrase",
+                                          type=str)
+    parser.add_argument("-c", "--compress", help="Compress the payload first, if that makes it "
+                                          "smaller", choices=list(CODECS))
+    parser.add_argument("--profile", help="PNG save profile", choices=list(SAVE_PROFILES),
+                                          default="balanced")
+    parser.add_argument("-t", "--threads", help="Compress the output PNG on this many threads",
+                                          type=int, default=1)
+    parser.add_argument("--low-memory", help="Encode a band of rows at a time, so memory use "
+                                          "doesn't grow with the image height", action="store_true")
+    parser.add_argument("--stats", help="Print the time, samples, bytes and peak memory of "
+                                          "each stage to stderr", choices=["json", "text"])
+    parser.add_argument("--capture", help="Profile the run with cProfile, or trace its "
+                                          "allocations with tracemalloc, for --stats",
+                                          choices=list(metrics.CAPTURE_MODES))
+    return parser
 
-    if args.message:
-        encodeMessage(args.input_image, args.output_filename, args.message, args.verbose)
-    elif args.decode:
-        print(extractMessage(args.input_image, args.verbose))
+
+def runCommand(args):
+    ''' Runs the encode or decode the parsed command line asks for
+
+        Input: args <argparse.Namespace, from buildParser>
+        Output: exit status <int>
+    '''
+    # A capture mode is no use without a report to put it in
+    stats = None
+    if args.stats or args.capture:
+        stats = metrics.Stats(capture=args.capture)
+
+    status = 0
+    try:
+        with stats or contextlib.nullcontext():
+            if args.low_memory and not args.decode:
+                if args.passphrase or args.legacy or args.convert_palette or args.threads > 1:
+                    raise StegoError("--low-memory can't be combined with --passphrase, "
+                                     "--legacy, --convert-palette or --threads")
+                if args.payload_file:
+                    with openPayloadFile(args.payload_file, "rb") as payloadFile:
+                        encodeBands(args.input_image, args.output_filename, payloadFile,
+                                    args.verbose, args.bits_per_channel, args.use_alpha,
+                                    args.profile, args.compress, stats=stats)
+                elif args.message is not None:
+                    encodeBands(args.input_image, args.output_filename, args.message,
+                                args.verbose, args.bits_per_channel, args.use_alpha, args.profile,
+                                args.compress, stats=stats)
+            elif args.decode and args.payload_file:
+                with openPayloadFile(args.payload_file, "wb") as payloadFile:
+                    extractStream(args.input_image, payloadFile, args.verbose, args.backend,
+                                  args.passphrase, stats=stats)
+            elif args.payload_file:
+                with openPayloadFile(args.payload_file, "rb") as payloadFile:
+                    encodeStream(args.input_image, args.output_filename, payloadFile,
+                                 args.verbose, args.bits_per_channel, args.use_alpha,
+                                 args.convert_palette, args.profile, args.threads,
+                                 args.passphrase, args.compress, stats=stats)
+            elif args.message is not None:
+                encodeMessage(args.input_image, args.output_filename, args.message, args.verbose,
+                              args.backend, args.legacy, args.bits_per_channel, args.use_alpha,
+                              args.convert_palette, args.profile, args.threads,
+                              passphrase=args.passphrase, codec=args.compress, stats=stats)
+            elif args.decode:
+                print(extractMessage(args.input_image, args.verbose, args.backend,
+                                     args.passphrase, stats))
+    except StegoError as err:
+        print(err)
+        status = err.exitCode
+
+    # Stats go to stderr, as stdout may be carrying the payload
+    if stats is not None:
+        print(metrics.formatReport(stats.report(), args.stats or "json"), file=sys.stderr)
+    return status
+
+
+def openPayloadFile(path, mode):
+    ''' Opens a payload file, where "-" is stdin or stdout
+
+        Input: path <path or "-">, mode <"rb" or "wb">
+        Output: context manager giving a binary file object
+    '''
+    if path == "-":
+        # Leave the standard streams open when done
+        return contextlib.nullcontext(sys.stdin.buffer if mode == "rb" else sys.stdout.buffer)
+    return open(path, mode)
+
+
+@contextlib.contextmanager
+def replacedOnSuccess(path):
+    ''' Gives a temporary path beside an output file to write it under. The
+        temporary file replaces the output once the block ends without an
+        error, and is deleted otherwise, so a failed write leaves no partial
+        file behind, and the output may be the very file being read. "-" and
+        file objects are given back as they are.
+
+        Input: path <path, "-" or binary file object>
+        Output: context manager giving the path or file object to write to
+    '''
+    if not isinstance(path, (str, os.PathLike)) or path == "-":
+        yield path
+        return
+    directory, name = os.path.split(os.path.abspath(path))
+    temporary = os.path.join(directory, ".{}.{}.tmp".format(name, os.urandom(4).hex()))
+    try:
+        yield temporary
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, path)
+
+
+def checkChunkSize(chunkSize):
+    ''' Checks that a chunk size holds a whole number of samples at every
+        bits per channel setting, as a chunk ending mid sample would leave
+        bits of that sample to the next chunk, which is written or read apart
+
+        Input: chunkSize <int>
+        Output: None
+        Raises: ValueError if it isn't a positive multiple of 3 bytes
+    '''
+    if chunkSize <= 0 or chunkSize % 3:
+        raise ValueError("The chunk size must be a positive multiple of 3 bytes, not {}".format(
+                         chunkSize))
+
+
+def readChunks(stream, chunkSize=CHUNK_SIZE):
+    ''' Reads a stream in chunks of exactly chunkSize bytes, bar the last,
+        however short the underlying reads are
+
+        Input: stream <binary file object>, chunkSize <int>
+        Output: generator of chunks <bytes>
+    '''
+    pending = b""
+    while True:
+        data = stream.read(chunkSize - len(pending))
+        if not data:
+            break
+        pending += data
+        if len(pending) == chunkSize:
+            yield pending
+            pending = b""
+    if pending:
+        yield pending
+
+
+def compressPayload(payload, codec=None):
+    ''' Compresses a payload, unless that doesn't make it any smaller
+
+        Input: payload <bytes>, codec <name in CODECS, or None>
+        Output: (stored payload <bytes>, codec used <name or None>)
+        Raises: UnsupportedFormatError if the codec is unknown or unavailable
+    '''
+    if codec is None:
+        return payload, None
+    compressor = payloadCompressor(codec)
+    compressed = compressor.compress(payload) + compressor.flush()
+    if len(compressed) >= len(payload):
+        return payload, None
+    return compressed, codec
+
+
+def compressChunks(chunks, codec, chunkSize=CHUNK_SIZE):
+    ''' Compresses a stream of chunks, cutting the output back into chunks of
+        exactly chunkSize bytes, bar the last
+
+        Input: chunks <iterable of bytes>, codec <name in CODECS>, chunkSize <int>
+        Output: generator of compressed chunks <bytes>
+    '''
+    compressor = payloadCompressor(codec)
+    pending = b""
+    for chunk in chunks:
+        pending += compressor.compress(chunk)
+        while len(pending) >= chunkSize:
+            yield pending[:chunkSize]
+            pending = pending[chunkSize:]
+    pending += compressor.flush()
+    for start in range(0, len(pending), chunkSize):
+        yield pending[start:start + chunkSize]
+
+
+def payloadCompressor(codec):
+    ''' Compressor for a codec named by the caller
+
+        Input: codec <name in CODECS>
+        Output: compressor
+        Raises: UnsupportedFormatError if the codec is unknown or unavailable
+    '''
+    if codec not in CODECS:
+        if codec in CODEC_NAMES.values():
+            raise UnsupportedFormatError("Compressing with {} needs the zstandard "
+                                         "package".format(codec))
+        raise UnsupportedFormatError("Unknown codec \"{}\", choose from {}".format(
+                                     codec, ", ".join(CODECS)))
+    return CODECS[codec][1]()
+
+
+def payloadDecompressor(flags):
+    ''' Decompressor for the codec recorded in a header's flags
+
+        Input: flags <int>
+        Output: decompressor, or None if the payload is stored as is
+        Raises: UnsupportedFormatError if the codec isn't available
+    '''
+    number = (flags & FLAG_CODEC) >> CODEC_SHIFT
+    if not number:
+        return None
+    name = CODEC_NAMES[number]
+    if name not in CODECS:
+        raise UnsupportedFormatError("The message is compressed with {}, which needs the "
+                                     "zstandard package".format(name))
+    return CODECS[name][2]()
 
 
 def toBinary(string):
@@ -36,120 +410,1658 @@ def toBinary(string):
     return bin(int.from_bytes(string.encode(encoding="ascii"), byteorder='big'))
 
 
-def toText(binaryMessage):
-    ''' Converts a binary string of the form 0b<binary> into an ascii string
-        If UnicodeDecodeError, then report back error
-        
-        Input: binary
-        Output: ascii string
+def toBits(data):
+    ''' Unpacks bytes into an array of bits, most significant bit first
+
+        Input: data <bytes>
+        Output: bits <np.uint8 array of 0/1>
     '''
-    try:
-        string = int(binaryMessage, 2)
-        return string.to_bytes((string.bit_length() + 7) // 8, byteorder='big').decode(encoding="ascii")
-    except UnicodeDecodeError:
-        print("No message found, are you sure your input file was properly encoded?")
-        return
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
 
-def encodeMessage(imageFile, outputFile, message, verbose=False):
-    ''' Unpacks image, and encodes the message in LSB format
 
-        Input: image, message in binary, image width, image height, and verbose flag
-        Output: list of pixel values
+def packHeader(payload, flags=0):
+    ''' Builds the container header for a payload
+
+        Input: payload <bytes>, flags <int>
+        Output: header <bytes>
     '''
-    # Local variable declarations
-    bitsInjected = 0
-    delimBits = 0
-    imageData = []
+    return HEADER.pack(MAGIC, VERSION, flags, len(payload), zlib.crc32(payload))
 
-    # Check image format 
-    if imghdr.what(imageFile) != "png":
-        print("Sorry, but this program only supports .png image formats")
-        exit(1)
 
-    # Open input image
-    image = Image.open(imageFile)
+def parseHeader(headerBytes):
+    ''' Unpacks a container header
 
-    if verbose: print("Converting \"{}\" to binary...".format(message))
+        Input: headerBytes <bytes>
+        Output: (flags, payload length, crc32), or None if there is no header
+    '''
+    magic, version, flags, length, checksum = HEADER.unpack(headerBytes)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return flags, length, checksum
 
-    # Check message length
+
+def toValues(bits, bitsPerChannel):
+    ''' Groups bits into the values written to each color sample, padding the
+        last group with zeros
+
+        Input: bits <np.uint8 array of 0/1>, bitsPerChannel <1-4>
+        Output: values <np.uint8 array>
+    '''
+    if bitsPerChannel == 1:
+        return bits
+    padded = np.zeros(-(-bits.size // bitsPerChannel) * bitsPerChannel, dtype=np.uint8)
+    padded[:bits.size] = bits
+    return np.packbits(padded.reshape(-1, bitsPerChannel), axis=1).reshape(-1) >> (8 - bitsPerChannel)
+
+
+def fromSamples(samples, bitsPerChannel):
+    ''' Strips the low bits of color samples back into a run of bits
+
+        Input: samples <np.uint8 or np.uint16 array>, bitsPerChannel <1-4>
+        Output: bits <np.uint8 array of 0/1>
+    '''
+    values = (samples & ((1 << bitsPerChannel) - 1)).astype(np.uint8)
+    if bitsPerChannel == 1:
+        return values
+    return np.unpackbits(values.reshape(-1, 1), axis=1)[:, 8 - bitsPerChannel:].reshape(-1)
+
+
+def scatterKeys(passphrase):
+    ''' Derives the Feistel round keys from a passphrase
+
+        Input: passphrase <str>
+        Output: keys <np.uint32 array of SCATTER_ROUNDS>
+    '''
+    digest = hashlib.pbkdf2_hmac("sha256", passphrase.encode(encoding="utf-8"), MAGIC,
+                                 SCATTER_ITERATIONS, dklen=4 * SCATTER_ROUNDS)
+    return np.frombuffer(digest, dtype=">u4").astype(np.uint32)
+
+
+def feistel(keys, values, bits):
+    ''' One pass of the keyed Feistel network over values of the given number
+        of bits. Each round splits a value into its low and high halves, moves
+        the low half to the top and mixes a multiplicative hash of it into the
+        high half, so the halves may differ in size by a bit.
+
+        Input: keys <np.uint32 array>, values <np.uint32 array>, bits <2-32>
+        Output: permuted values <np.uint32 array>
+    '''
+    lowBits, highBits = bits // 2, bits - bits // 2
+    for key in keys:
+        low = values & np.uint32((1 << lowBits) - 1)
+        mixed = (low ^ key) * np.uint32(0x9E3779B1)
+        mixed ^= mixed >> np.uint32(15)
+        mixed *= np.uint32(0x85EBCA77)
+        high = (values >> np.uint32(lowBits)) ^ (mixed >> np.uint32(32 - highBits))
+        values = (low << np.uint32(highBits)) | high
+        lowBits, highBits = highBits, lowBits
+    return values
+
+
+def permute(keys, size, start, count):
+    ''' Positions start to start + count of a keyed permutation of range(size)
+
+        Input: keys <np.uint32 array>, size <int, under 2**32>, start <int>, count <int>
+        Output: positions <np.int64 array>
+    '''
+    bits = max(2, (size - 1).bit_length())
+    positions = feistel(keys, np.arange(start, start + count, dtype=np.uint32), bits)
+
+    # Walk the cycle back into range, under two passes on average as the domain is under 2 * size
+    outside = np.flatnonzero(positions >= size)
+    while outside.size:
+        positions[outside] = feistel(keys, positions[outside], bits)
+        outside = outside[positions[outside] >= size]
+
+    return positions.astype(np.int64)
+
+
+def flatPositions(pixels, positions, channels):
+    ''' Converts positions among the first channels of each pixel into
+        indices into the whole flattened pixel buffer
+
+        Input: pixels <array of (height, width, channels)>, positions <np.int64
+               array of sample indices>, channels <int>
+        Output: indices <np.int64 array>
+    '''
+    if channels == pixels.shape[2]:
+        return positions
+    pixel, channel = np.divmod(positions, channels)
+    return pixel * pixels.shape[2] + channel
+
+
+def headerPixels(image):
+    ''' Number of whole pixels the header takes up
+
+        Input: image <Image>
+        Output: pixels <int>
+    '''
+    return -(-HEADER_BITS // MODE_CHANNELS[image.mode][0])
+
+
+def payloadChannels(image, useAlpha=False):
+    ''' Number of channels per pixel the payload is stored in
+
+        Input: image <Image>, useAlpha flag
+        Output: channels <int>
+    '''
+    colorChannels, alphaChannels = MODE_CHANNELS[image.mode]
+    return colorChannels + (alphaChannels if useAlpha else 0)
+
+
+def payloadCapacity(image, bitsPerChannel=1, useAlpha=False):
+    ''' Largest payload a container in this image can hold, negative if
+        even the header doesn't fit
+
+        Input: image <Image>, bitsPerChannel <1-4>, useAlpha flag
+        Output: capacity in bytes <int>
+    '''
+    return sizeCapacity(image.size, image.mode, bitsPerChannel, useAlpha)
+
+
+def sizeCapacity(size, mode, bitsPerChannel=1, useAlpha=False):
+    ''' Largest payload a container can hold in an image of this size and
+        mode, negative if even the header doesn't fit
+
+        Input: size (width, height), mode <str>, bitsPerChannel <1-4>, useAlpha flag
+        Output: capacity in bytes <int>
+    '''
+    colorChannels, alphaChannels = MODE_CHANNELS[mode]
+    pixels = size[0] * size[1] - -(-HEADER_BITS // colorChannels)
+    if pixels < 0:
+        return -1
+    return pixels * (colorChannels + (alphaChannels if useAlpha else 0)) * bitsPerChannel // 8
+
+
+def containerFlags(image, bitsPerChannel=1, useAlpha=False, scatter=False, codec=None,
+                   shard=False):
+    ''' Header flags for a payload layout
+
+        Input: image <Image>, bitsPerChannel <1-4>, useAlpha flag, scatter
+               flag, codec <name in CODECS, or None>, shard flag
+        Output: flags <int>
+    '''
+    flags = bitsPerChannel - 1
+    if payloadChannels(image, useAlpha) > MODE_CHANNELS[image.mode][0]:
+        flags |= FLAG_ALPHA
+    if scatter:
+        flags |= FLAG_SCATTER
+    if codec is not None:
+        flags |= CODECS[codec][0] << CODEC_SHIFT
+    if shard:
+        flags |= FLAG_SHARD
+    return flags
+
+
+def containerSegments(image, payload, bitsPerChannel=1, useAlpha=False, passphrase=None,
+                      codec=None, shard=False):
+    ''' Converts a payload into the segments of its container: the header at
+        one bit per color sample, then the payload from the next whole pixel
+        on, scattered over the rest of the image if a passphrase is given
+
+        Input: image <Image>, payload <bytes, already compressed with codec>,
+               bitsPerChannel <1-4>, useAlpha flag, passphrase <str or None>,
+               codec <name in CODECS, or None>, shard flag, set when the
+               payload starts with a shard header
+        Output: segments [(bits <np.uint8 array of 0/1>, bitsPerChannel,
+                           channels, first sample, scatter keys or None)]
+    '''
+    channels = payloadChannels(image, useAlpha)
+    keys = None if passphrase is None else scatterKeys(passphrase)
+    header = packHeader(payload, containerFlags(image, bitsPerChannel, useAlpha, keys is not None,
+                                                codec, shard))
+    return [(toBits(header), 1, MODE_CHANNELS[image.mode][0], 0, None),
+            (toBits(payload), bitsPerChannel, channels, headerPixels(image) * channels, keys)]
+
+
+def legacySegments(image, message):
+    ''' Converts an ASCII message into the bits of the old delimited format,
+        dropping leading zeros and appending 8 zero bits as delimiter. Like
+        the old format, every channel of each pixel is used.
+
+        Input: image <Image>, message <ascii text>
+        Output: segments [(bits <np.uint8 array of 0/1>, 1, channels, 0, None)]
+    '''
     binaryMessage = toBinary(message)[2:]
-    if len(binaryMessage) > (image.size[0] * image.size[1] * 3):
-        print("This image is too small to contain your message!\nExiting...")
-        exit(2)
+    bits = np.frombuffer(binaryMessage.encode(encoding="ascii"), dtype=np.uint8) - ord("0")
+    return [(np.concatenate((bits, np.zeros(8, dtype=np.uint8))), 1, len(image.getbands()), 0,
+             None)]
 
-    if verbose: print("Encoding message...")
 
-    # Loop through every pixel of input image
-    for y in range(image.size[1]):
-        for x in range(image.size[0]):
-            for index, color in enumerate(image.getpixel((x,y))):
-
-                # Encode one bit of the message string
-                if bitsInjected < len(binaryMessage):
-                    # Set LSB of color to one bit of the binaryMessage
-                    # Mask color with 254 to gaurantee LSB is 0, then set LSB to message bit
-                    imageData.append(color & 254 | int(binaryMessage[bitsInjected]))
-                    bitsInjected += 1
-
-                # Zero out 8 LSB as message delimeter
-                elif delimBits < 8:
-                    imageData.append(color & 254)
-                    delimBits += 1
-                
-                # After message & delimeter are encoded, pass image data through
-                else:
-                    imageData.append(color)
+def checkFormat(imageFile):
+    ''' Raises UnsupportedFormatError unless imageFile starts with the PNG
+        signature
+
+        Input: imageFile <path or binary file object>
+        Output: None
+    '''
+    if isinstance(imageFile, str):
+        with open(imageFile, "rb") as stream:
+            signature = stream.read(len(pngio.SIGNATURE))
+    else:
+        position = imageFile.tell()
+        signature = imageFile.read(len(pngio.SIGNATURE))
+        imageFile.seek(position)
+    if signature != pngio.SIGNATURE:
+        raise UnsupportedFormatError("Sorry, but this program only supports .png image formats")
+
+
+def openImage(imageFile, convertPalette=False, stats=None):
+    ''' Opens a .png image, checking its mode can carry a message. Palette
+        images are only converted to RGB(A) when asked to, as any change to
+        their pixels would otherwise pick different palette entries.
+
+        Input: imageFile <path>, convertPalette flag, stats <metrics.Stats>
+        Output: image <Image>, decoded
+        Raises: UnsupportedFormatError, also for truncated or corrupted files
+    '''
+    with metrics.stage(stats, "check"):
+        checkFormat(imageFile)
+    with metrics.stage(stats, "open"):
+        # Decode now, so a damaged file fails here rather than in whatever
+        # first touches the pixels, and isn't timed as part of it
+        try:
+            image = prepareImage(Image.open(imageFile), convertPalette)
+            image.load()
+        except (OSError, ValueError) as err:
+            raise UnsupportedFormatError("Can't read the image data ({})".format(err))
+        if stats is not None:
+            metrics.count(stats, samples=image.size[0] * image.size[1] * len(image.getbands()),
+                          bytesRead=fileSize(imageFile))
+    return image
+
+
+def fileSize(imageFile):
+    ''' Size of an image file, leaving a file object where it was
+
+        Input: imageFile <path or seekable binary file object>
+        Output: bytes <int>
+    '''
+    if isinstance(imageFile, str):
+        return os.path.getsize(imageFile)
+    position = imageFile.tell()
+    size = imageFile.seek(0, io.SEEK_END)
+    imageFile.seek(position)
+    return size
+
+
+def openLazyImage(imageFile, backend="numpy", stats=None):
+    ''' Opens a .png image for extraction. With the numpy backend, non
+        interlaced images of 8 or 16 bits per sample are decoded a few rows
+        at a time as they are read, so a short payload costs the same in any
+        size of image; others are opened with Pillow.
+
+        Input: imageFile <path or binary file object>, extraction backend,
+               stats <metrics.Stats>
+        Output: image <LazyImage or Image>, to be closed after use
+        Raises: UnsupportedFormatError
+    '''
+    with metrics.stage(stats, "check"):
+        header = readImageHeader(imageFile)
+    if backend != "numpy" or header["interlaced"] or header["bit_depth"] < 8:
+        return openImage(imageFile, stats=stats)
+    with metrics.stage(stats, "open"):
+        try:
+            return LazyImage(imageFile)
+        except ValueError as err:
+            raise UnsupportedFormatError("Can't read the image data ({})".format(err))
+
+
+def readImageHeader(imageFile):
+    ''' Reads the IHDR chunk of a .png image, leaving a file object where it
+        was, and refuses 16 bit color, which Pillow loads as 8 bit and so
+        never carries a message
+
+        Input: imageFile <path or binary file object>
+        Output: header <dict, from pngio.readHeader>
+        Raises: UnsupportedFormatError
+    '''
+    checkFormat(imageFile)
+    position = None if isinstance(imageFile, str) else imageFile.tell()
+    with open(imageFile, "rb") if position is None else contextlib.nullcontext(imageFile) as stream:
+        try:
+            header = pngio.readHeader(stream)
+        except ValueError as err:
+            raise UnsupportedFormatError("Can't read the image header ({})".format(err))
+    if position is not None:
+        imageFile.seek(position)
+
+    if header["bit_depth"] == 16 and header["mode"] != "I;16":
+        raise UnsupportedFormatError("Sorry, but 16 bit color images are not supported")
+    return header
+
+
+class LazyImage(pngio.RowReader):
+    # Rows of a PNG image, decoded by pngio as far as they are read, until a
+    # read reaches past LAZY_READ_BYTES of pixel data and Pillow decodes the
+    # whole image instead. Stands in for an Image during extraction.
+
+    def __init__(self, imageFile):
+        self.start = 0 if isinstance(imageFile, str) else imageFile.tell()
+        pngio.RowReader.__init__(self, imageFile)
+
+    def decode(self, stop):
+        if stop <= self.decoded or stop * self.rowLength <= LAZY_READ_BYTES:
+            try:
+                pngio.RowReader.decode(self, stop)
+            except ValueError as err:
+                raise UnsupportedFormatError("Can't read the image data ({})".format(err))
+            return
+        self.stream.seek(self.start)
+        self.pixels = loadPixels(Image.open(self.stream))
+        self.decoded = self.shape[0]
+
+
+def prepareImage(image, convertPalette=False):
+    ''' Checks an opened image's mode can carry a message, converting
+        palette images if asked to
+
+        Input: image <Image>, convertPalette flag
+        Output: image <Image>
+        Raises: UnsupportedFormatError
+    '''
+    if image.mode in ("P", "PA"):
+        if not convertPalette:
+            raise UnsupportedFormatError("Palette images can't carry a message as they are, "
+                                         "convert them to RGB first (--convert-palette)")
+        hasAlpha = image.mode == "PA" or "transparency" in image.info
+        return image.convert("RGBA" if hasAlpha else "RGB")
+
+    if image.mode not in MODE_CHANNELS:
+        raise UnsupportedFormatError("Sorry, but {} images are not supported".format(image.mode))
+
+    # Pillow loads 16 bit color as 8 bit, which would throw away half of every sample
+    rawMode = image.tile[0][3] if getattr(image, "tile", None) else ""
+    if isinstance(rawMode, str) and rawMode.endswith(";16B") and image.mode != "I;16":
+        raise UnsupportedFormatError("Sorry, but 16 bit color images are not supported")
+
+    return image
+
+
+def saveOptions(image):
+    ''' Keyword arguments for Image.save that carry the original image's
+        metadata (text, gamma, chromaticity, sRGB, ICC profile, dpi, EXIF and
+        transparency) over to the encoded PNG
+
+        Input: image <Image>
+        Output: options <dict>
+    '''
+    pngInfo = PngImagePlugin.PngInfo()
+    for key, value in getattr(image, "text", {}).items():
+        pngInfo.add_text(key, value)
+    if "gamma" in image.info:
+        pngInfo.add(b"gAMA", struct.pack(">I", round(image.info["gamma"] * 100000)))
+    if "chromaticity" in image.info:
+        pngInfo.add(b"cHRM", struct.pack(">8I", *(round(value * 100000)
+                                                  for value in image.info["chromaticity"])))
+    if "srgb" in image.info and "icc_profile" not in image.info:
+        pngInfo.add(b"sRGB", struct.pack(">B", image.info["srgb"]))
+
+    options = {"pnginfo": pngInfo}
+    for key in ("icc_profile", "dpi", "exif", "transparency"):
+        if key in image.info:
+            options[key] = image.info[key]
+
+    # A palette index means nothing once converted, and alpha replaces it
+    if MODE_CHANNELS[image.mode][1]:
+        options.pop("transparency", None)
+
+    return options
+
+
+def saveImage(image, encodedImage, outputFile, profile="balanced", threads=1, stats=None):
+    ''' Saves an encoded image as PNG with a save profile, carrying the
+        original image's metadata over. With more than one thread, row bands
+        are compressed in parallel into a single PNG stream. Pillow can't be
+        told which row filter to use, so profiles with a fixed filter are
+        written with pngio even on one thread. With stats, the PNG is
+        serialized to memory first, so writing it out is timed apart.
+
+        Input: original image <Image>, encoded image <Image>, output file
+               <path or binary file object>, profile <"fast", "balanced" or
+               "small">, threads <int>, stats <metrics.Stats>
+        Output: save report {"bytes": bytes written, "seconds": time taken}
+    '''
+    level, filterName, optimize = SAVE_PROFILES[profile]
+    start = time.perf_counter()
+    target = outputFile if stats is None else io.BytesIO()
+
+    with metrics.stage(stats, "serialize"):
+        if threads > 1 or pngio.FILTERS[filterName] is not None:
+            written = pngio.writePNG(target, loadPixels(encodedImage), encodedImage.mode, level,
+                                     pngio.FILTERS[filterName], threads,
+                                     pngio.metadataChunks(image))
+        else:
+            position = None if isinstance(target, str) else target.tell()
+            encodedImage.save(target, 'PNG', compress_level=level, optimize=optimize,
+                              **saveOptions(image))
+            if position is None:
+                written = os.path.getsize(target)
+            else:
+                written = target.tell() - position
+        metrics.count(stats, samples=encodedImage.size[0] * encodedImage.size[1]
+                                     * len(encodedImage.getbands()), bytesWritten=written)
+
+    if target is not outputFile:
+        with metrics.stage(stats, "save"):
+            if isinstance(outputFile, str):
+                with open(outputFile, "wb") as output:
+                    output.write(target.getbuffer())
+            else:
+                outputFile.write(target.getbuffer())
+            metrics.count(stats, bytesWritten=written)
+
+    return {"bytes": written, "seconds": time.perf_counter() - start}
+
+
+class StegoImage:
+    # A carrier held in memory, to embed payloads in and extract them from
+    # without going through the disk. Images given as bytes or a path are
+    # only decoded when first needed, and extracting from them decodes just
+    # the rows the payload occupies. Errors are raised as StegoError
+    # subclasses, never printed.
+
+    # Input: image <Image>, or source <path, binary file object or bytes-like>
+    #        to open on demand,
+    #        convertPalette flag, original <Image> whose metadata saved
+    #        images carry, the image itself if None, pixels <read only
+    #        array of the image's samples> that embedding copies instead of
+    #        decoding the image again
+    # Output: None
+
+    def __init__(self, image=None, source=None, convertPalette=False, original=None, pixels=None):
+        if image is None and source is None:
+            raise ValueError("StegoImage needs an image or a source to open")
+        self.source = source
+        self.convertPalette = convertPalette
+        self.loaded = None if image is None else prepareImage(image, convertPalette)
+        self.original = original
+        self.pixels = pixels
+
+    @classmethod
+    def fromBytes(cls, data, convertPalette=False):
+        ''' Wraps an encoded PNG held in memory, checking its signature and
+            header up front
+
+            Input: data <bytes-like>, convertPalette flag
+            Output: StegoImage
+            Raises: UnsupportedFormatError
+        '''
+        readImageHeader(io.BytesIO(data))
+        return cls(source=data, convertPalette=convertPalette)
+
+    @classmethod
+    def fromFile(cls, imageFile, convertPalette=False):
+        ''' Wraps a .png file, checking its signature and header up front. A
+            file object is read from where it is, and only once.
+
+            Input: imageFile <path or binary file object>, convertPalette flag
+            Output: StegoImage
+            Raises: UnsupportedFormatError
+        '''
+        readImageHeader(imageFile)
+        return cls(source=imageFile, convertPalette=convertPalette)
+
+    @classmethod
+    def fromPil(cls, image, convertPalette=False):
+        ''' Wraps an opened image, whatever format it was read from; it is
+            saved as PNG
+
+            Input: image <Image>, convertPalette flag
+            Output: StegoImage
+            Raises: UnsupportedFormatError
+        '''
+        return cls(image, convertPalette=convertPalette)
+
+    @classmethod
+    def fromArray(cls, pixels, mode=None):
+        ''' Wraps an array of pixels, sharing its memory where Pillow can.
+            The mode follows from the channel count, and 16 bit grayscale
+            from the dtype, unless given.
+
+            Input: pixels <np.uint8 or np.uint16 array of (height, width) or
+                   (height, width, channels)>, mode <str or None>
+            Output: StegoImage
+            Raises: UnsupportedFormatError
+        '''
+        pixels = np.asarray(pixels)
+        if pixels.ndim == 3 and pixels.shape[2] == 1:
+            pixels = pixels[:, :, 0]
+        if mode is None:
+            if pixels.dtype == np.uint16 and pixels.ndim == 2:
+                mode = "I;16"
+            elif pixels.dtype == np.uint8:
+                mode = ARRAY_MODES.get(1 if pixels.ndim == 2 else pixels.shape[2])
+            if mode is None:
+                raise UnsupportedFormatError("Sorry, but {} arrays of shape {} are not "
+                                             "supported".format(pixels.dtype, pixels.shape))
+        if mode == "I;16":
+            pixels = pixels.astype("<u2", copy=False)
+        pixels = np.ascontiguousarray(pixels)
+        height, width = pixels.shape[:2]
+        return cls(Image.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1))
+
+    @property
+    def image(self):
+        ''' The image, opened with Pillow on first use
+
+            Input: None
+            Output: image <Image>
+            Raises: UnsupportedFormatError
+        '''
+        return self.load()
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def mode(self):
+        return self.image.mode
+
+    def load(self, stats=None):
+        ''' Opens the source with Pillow, unless that is done already
+
+            Input: stats <metrics.Stats>
+            Output: image <Image>
+            Raises: UnsupportedFormatError
+        '''
+        if self.loaded is None:
+            self.loaded = openImage(self.openSource(), self.convertPalette, stats)
+        return self.loaded
+
+    def openSource(self):
+        ''' The source as something Pillow and pngio can open
+
+            Input: None
+            Output: path or binary file object
+        '''
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            return io.BytesIO(self.source)
+        return self.source
+
+    def toPil(self):
+        ''' The image, as Pillow holds it
+
+            Input: None
+            Output: image <Image>
+        '''
+        return self.image
+
+    def toArray(self):
+        ''' The pixels as a read only array, made on the first call and
+            shared by later ones rather than copied again
+
+            Input: None
+            Output: pixels <array of (height, width, channels)>
+        '''
+        if self.pixels is None:
+            pixels = loadPixels(self.image, writable=True)
+            pixels.flags.writeable = False
+            self.pixels = pixels
+        return self.pixels
+
+    def capacity(self, bitsPerChannel=1, useAlpha=False):
+        ''' Largest payload this image can hold, negative if even the header
+            doesn't fit
+
+            Input: bitsPerChannel <1-4>, useAlpha flag
+            Output: capacity in bytes <int>
+        '''
+        return payloadCapacity(self.image, bitsPerChannel, useAlpha)
+
+    def embedImage(self, payload, bitsPerChannel=1, useAlpha=False, passphrase=None, codec=None,
+                   legacy=False, backend="numpy", progress=None, verbose=False, stats=None):
+        ''' Embeds a payload, leaving this image as it is
+
+            Input: payload <str or bytes>, and the options of encodeImage
+            Output: encoded image <StegoImage>, which saves with this
+                    image's metadata
+            Raises: StegoError, UnsupportedFormatError, CapacityError
+        '''
+        image = self.load(stats)
+        encodedImage = encodeImage(image, payload, verbose, backend, legacy, bitsPerChannel,
+                                   useAlpha, progress, passphrase, codec, stats, self.pixels)
+        return StegoImage(encodedImage, original=self.original or image)
+
+    def embed(self, payload, bitsPerChannel=1, useAlpha=False, passphrase=None, codec=None,
+              profile="balanced", threads=1, stats=None):
+        ''' Embeds a payload, and gives back the encoded PNG
+
+            Input: payload <str or bytes>, bitsPerChannel <1-4>, useAlpha
+                   flag, passphrase <str or None>, codec <name in CODECS or
+                   None>, PNG save profile, threads <int>, stats <metrics.Stats>
+            Output: encoded PNG <bytes>
+            Raises: StegoError, UnsupportedFormatError, CapacityError
+        '''
+        return self.embedImage(payload, bitsPerChannel, useAlpha, passphrase, codec,
+                               stats=stats).toBytes(profile, threads, stats)
+
+    def save(self, outputFile, profile="balanced", threads=1, stats=None):
+        ''' Saves the image as PNG
+
+            Input: output file <path or binary file object>, PNG save
+                   profile, threads <int>, stats <metrics.Stats>
+            Output: save report {"bytes": bytes written, "seconds": time taken}
+        '''
+        image = self.load(stats)
+        return saveImage(self.original or image, image, outputFile, profile, threads, stats)
+
+    def toBytes(self, profile="balanced", threads=1, stats=None):
+        ''' The image as PNG
+
+            Input: PNG save profile, threads <int>, stats <metrics.Stats>
+            Output: PNG <bytes>
+        '''
+        output = io.BytesIO()
+        self.save(output, profile, threads, stats)
+        return output.getvalue()
+
+    def extract(self, passphrase=None, backend="numpy", verbose=False, stats=None):
+        ''' Extracts the payload this image holds
+
+            Input: passphrase <str> for scattered payloads, extraction
+                   backend, verbose flag, stats <metrics.Stats>
+            Output: payload <bytes>
+            Raises: UnsupportedFormatError, MessageNotFoundError
+        '''
+        payload = io.BytesIO()
+        self.extractTo(payload, passphrase, backend, verbose=verbose, stats=stats)
+        return payload.getvalue()
+
+    def extractTo(self, stream, passphrase=None, backend="numpy", chunkSize=CHUNK_SIZE,
+                  verbose=False, stats=None):
+        ''' Extracts the payload this image holds into a stream, a chunk at
+            a time
+
+            Input: stream <binary file object>, passphrase <str>, extraction
+                   backend, chunk size, verbose flag, stats <metrics.Stats>
+            Output: payload length <int>
+            Raises: UnsupportedFormatError, MessageNotFoundError
+        '''
+        if self.loaded is not None:
+            return extractPayloadStream(self.loaded, stream, verbose, backend, passphrase,
+                                        chunkSize, stats)
+        with openLazyImage(self.openSource(), backend, stats) as image:
+            return extractPayloadStream(image, stream, verbose, backend, passphrase, chunkSize,
+                                        stats)
+
+
+class CarrierCache:
+    # Decoded carriers kept in memory, so that encoding many payloads into
+    # the same few images decodes each of them only once. Entries are keyed
+    # by path, modification time and size, so a rewritten file is decoded
+    # afresh, and the least recently used go first once the pixels held pass
+    # the budget. Only the pixel array and the metadata saving needs are
+    # kept; each encode wraps them in an image, copies the pixels and
+    # rewrites only the samples its payload covers. Safe to share between
+    # threads.
+
+    # Input: budget <bytes of pixels held>
+    # Output: None
+
+    def __init__(self, budget=CARRIER_CACHE_BYTES):
+        self.budget = budget
+        self.used = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def carrier(self, imageFile, convertPalette=False, stats=None):
+        ''' The carrier at a path, decoded only if it isn't cached or the file
+            changed since. File objects are opened as they are, uncached.
+
+            Input: imageFile <path or binary file object>, convertPalette
+                   flag, stats <metrics.Stats>
+            Output: carrier <StegoImage>, sharing the cached pixels
+            Raises: UnsupportedFormatError
+        '''
+        if not isinstance(imageFile, str):
+            return StegoImage.fromFile(imageFile, convertPalette)
+
+        with metrics.stage(stats, "check"):
+            status = os.stat(imageFile)
+            path = os.path.realpath(imageFile)
+            key = (path, status.st_mtime_ns, status.st_size, convertPalette)
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+        if entry is None:
+            opened = openImage(imageFile, convertPalette, stats)
+            with metrics.stage(stats, "open"):
+                pixels = loadPixels(opened, writable=True)
+                pixels.flags.writeable = False
+                entry = (pixels, opened.mode, dict(opened.info),
+                         dict(getattr(opened, "text", {})))
+            self.store(key, entry)
+        return StegoImage(self.carrierImage(*entry), pixels=entry[0])
+
+    def carrierImage(self, pixels, mode, info, text):
+        ''' Wraps cached pixels in an image carrying the original's metadata.
+            Pillow shares the array's memory for modes it stores as they are,
+            and copies it for RGB, which it pads to 4 bytes a pixel.
+
+            Input: pixels <array>, mode <str>, info <dict>, text <dict>
+            Output: image <Image>
+        '''
+        image = Image.frombuffer(mode, (pixels.shape[1], pixels.shape[0]), pixels, "raw", mode, 0,
+                                 1)
+        image.info = dict(info)
+        image.text = dict(text)
+        return image
+
+    def store(self, key, entry):
+        ''' Caches a decoded carrier, dropping older versions of the same file
+            and the least recently used entries past the budget. Carriers
+            larger than the whole budget are not kept.
+
+            Input: key <tuple>, entry (pixels <array>, mode, info, text)
+            Output: None
+        '''
+        with self.lock:
+            for staleKey in [cached for cached in self.entries if cached[0] == key[0]]:
+                self.used -= self.entries.pop(staleKey)[0].nbytes
+            if entry[0].nbytes > self.budget:
+                return
+            self.entries[key] = entry
+            self.used += entry[0].nbytes
+            while self.used > self.budget:
+                self.used -= self.entries.popitem(last=False)[1][0].nbytes
+
+    def clear(self):
+        ''' Drops every cached carrier
+
+            Input: None
+            Output: None
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+
+def encodeMessage(imageFile, outputFile, message, verbose=False, backend="numpy", legacy=False,
+                  bitsPerChannel=1, useAlpha=False, convertPalette=False, profile="balanced",
+                  threads=1, progress=None, passphrase=None, codec=None, stats=None, cache=None):
+    ''' Unpacks image, and encodes the message in LSB format
+
+        Input: image file, output file, message <str or bytes>, verbose flag,
+               embedding backend ("numpy" or the reference "python" loop),
+               legacy flag to write the old delimited format, number of
+               payload bits per color sample, flag to use the alpha channel
+               too, flag to convert palette images, PNG save profile, number
+               of compression threads, progress <function(rows done, total
+               rows)>, which may raise to cancel the encode, passphrase <str>
+               to scatter the payload with, codec <name in CODECS> to
+               compress it with, stats <metrics.Stats> to record each stage
+               in, and cache <CarrierCache> to take the decoded image from
+        Output: save report {"bytes": bytes written, "seconds": time taken}
+        Raises: UnsupportedFormatError, CapacityError
+    '''
+    # Check image format, and open input image
+    if cache is None:
+        carrier = StegoImage.fromFile(imageFile, convertPalette)
+    else:
+        carrier = cache.carrier(imageFile, convertPalette, stats)
 
     # Create new image file
-    savedImage = Image.frombytes('RGB', image.size, bytes(imageData))
+    savedImage = carrier.embedImage(message, bitsPerChannel, useAlpha, passphrase, codec, legacy,
+                                    backend, progress, verbose, stats)
 
     # Ensure output file ends with ".png"
 #    if not outputFile[-4:] == ".png": outputFile += ".png"
-    savedImage.save(outputFile, 'PNG')
+    report = savedImage.save(outputFile, profile, threads, stats)
 
-    if verbose: print("Saved encoded data as \"{}\"\nDone".format(outputFile))
+    if verbose: print("Saved encoded data as \"{}\" ({} bytes in {:.3f}s)\nDone".format(
+                          outputFile, report["bytes"], report["seconds"]))
+    return report
 
 
-def extractMessage(imageFile, verbose=False):
-    ''' Extracts message from image
+def encodeImage(image, message, verbose=False, backend="numpy", legacy=False, bitsPerChannel=1,
+                useAlpha=False, progress=None, passphrase=None, codec=None, stats=None,
+                pixels=None):
+    ''' Encodes the message into an opened image in memory, leaving saving
+        to the caller
 
-        Input: <input_image>, <image_size>, <verbosity_flag>
-        Output: <message>
+        Input: image <Image, from openImage>, message <str or bytes>, verbose
+               flag, embedding backend, legacy flag, number of payload bits
+               per color sample, flag to use the alpha channel too, progress
+               <function(rows done, total rows)>, passphrase <str or None>,
+               codec <name in CODECS or None>, skipped if it doesn't help,
+               stats <metrics.Stats>, and pixels <array of the image's
+               samples, already decoded>, which the numpy backend copies and
+               writes the payload into
+        Output: encoded image <Image>
+        Raises: StegoError, CapacityError
     '''
-    # Initialize message
-    message = ""
-    # Check image format 
-    if imghdr.what(imageFile) != "png":
-        print("Sorry, but this program only supports .png image formats")
-        exit(1)
+    if verbose: print("Converting \"{}\" to binary...".format(message))
 
-    # Open input image
-    image = Image.open(imageFile)
+    with metrics.stage(stats, "convert"):
+        if legacy:
+            if bitsPerChannel != 1:
+                raise StegoError("The legacy format only stores 1 bit per channel")
+            if passphrase is not None or codec is not None:
+                raise StegoError("The legacy format can't be scattered or compressed")
+            segments = legacySegments(image, message)
+            # The delimiter may be cut short, as it always has been
+            fits = (segments[0][0].size - 8
+                    <= image.size[0] * image.size[1] * len(image.getbands()))
+        else:
+            if isinstance(message, str):
+                message = message.encode(encoding="utf-8")
+            metrics.count(stats, bytesRead=len(message))
+            message, codec = compressPayload(message, codec)
+            if verbose and codec: print("Compressed payload to {} bytes with {}".format(
+                                            len(message), codec))
+            segments = containerSegments(image, message, bitsPerChannel, useAlpha, passphrase,
+                                         codec)
+            fits = len(message) <= payloadCapacity(image, bitsPerChannel, useAlpha)
+            metrics.count(stats, bytesWritten=len(message))
 
-    if verbose: print("Extracting message...")
-    byteList = getBinaryMessage(image)
+    # Check message length
+    if not fits:
+        raise CapacityError("This image is too small to contain your message!\nExiting...")
 
-    if verbose: print("Converting binary to text...")
+    if verbose: print("Encoding message ({} backend)...".format(backend))
+
+    with metrics.stage(stats, "embed"):
+        if pixels is not None and backend == "numpy":
+            encodedImage = embedNumpy(image, segments, progress, np.array(pixels))
+        else:
+            encodedImage = EMBED_BACKENDS[backend](image, segments, progress)
+        metrics.count(stats, samples=sum(-(-segment[0].size // segment[1])
+                                         for segment in segments))
+    return encodedImage
+
+
+def encodeStream(imageFile, outputFile, stream, verbose=False, bitsPerChannel=1, useAlpha=False,
+                 convertPalette=False, profile="balanced", threads=1, passphrase=None,
+                 codec=None, chunkSize=CHUNK_SIZE, stats=None):
+    ''' Encodes a payload read from a stream, one chunk at a time, so the
+        payload is never held in memory whole. The header goes in last, once
+        the length and checksum are known.
+
+        Input: image file, output file, stream <binary file object>, verbose
+               flag, number of payload bits per color sample, flag to use the
+               alpha channel too, flag to convert palette images, PNG save
+               profile, number of compression threads, passphrase <str> to
+               scatter the payload with, codec <name in CODECS> to compress
+               it with, always applied as the stream can't be read twice,
+               chunk size, stats <metrics.Stats>
+        Output: save report {"bytes": bytes written, "seconds": time taken}
+        Raises: UnsupportedFormatError, CapacityError, ValueError if the
+                chunk size splits samples
+    '''
+    checkChunkSize(chunkSize)
+
+    # Check image format, open input image, and load its pixels once
+    image = openImage(imageFile, convertPalette, stats)
+    pixels = loadPixels(image, writable=True)
+    capacity = payloadCapacity(image, bitsPerChannel, useAlpha)
+
+    if verbose: print("Encoding payload stream...")
+
+    # Skip over the header, and embed each chunk as it arrives
+    channels = payloadChannels(image, useAlpha)
+    offset = headerPixels(image) * channels
+    keys = None if passphrase is None else scatterKeys(passphrase)
+    index = 0
+    length = 0
+    checksum = 0
+    chunks = readChunks(stream, chunkSize)
+    if codec is not None:
+        chunks = compressChunks(chunks, codec, chunkSize)
+    for chunk in metrics.timed(stats, "convert", chunks):
+        length += len(chunk)
+        if length > capacity:
+            raise CapacityError("This image is too small to contain your message!\nExiting...")
+        with metrics.stage(stats, "embed"):
+            checksum = zlib.crc32(chunk, checksum)
+            if keys is None:
+                offset = writeSegment(pixels, offset, toBits(chunk), bitsPerChannel, channels)
+            else:
+                index = scatterSegment(pixels, offset, toBits(chunk), bitsPerChannel, channels,
+                                       keys, index)
+            metrics.count(stats, samples=-(-len(chunk) * 8 // bitsPerChannel),
+                          bytesRead=len(chunk))
+
+    if capacity < 0:
+        raise CapacityError("This image is too small to contain your message!\nExiting...")
+    with metrics.stage(stats, "embed"):
+        header = HEADER.pack(MAGIC, VERSION,
+                             containerFlags(image, bitsPerChannel, useAlpha, keys is not None,
+                                            codec), length, checksum)
+        writeSegment(pixels, 0, toBits(header), 1, MODE_CHANNELS[image.mode][0])
+        metrics.count(stats, samples=HEADER_BITS)
+
+    report = saveImage(image, toImage(image, pixels), outputFile, profile, threads, stats)
+
+    if verbose: print("Encoded {} bytes, saved as \"{}\" ({} bytes in {:.3f}s)\nDone".format(
+                          length, outputFile, report["bytes"], report["seconds"]))
+    return report
+
+
+def encodeBands(imageFile, outputFile, payload, verbose=False, bitsPerChannel=1, useAlpha=False,
+                profile="balanced", codec=None, progress=None, bandBytes=BAND_BYTES,
+                stats=None):
+    ''' Encodes a payload a band of rows at a time: each band is decoded from
+        the input, has its share of the container written into it, and is
+        filtered and compressed into the output before the next is read, so
+        memory use follows the image width rather than its height. Streamed
+        payloads are spooled to a temporary file first, as the header needs
+        their length before the first band is written. An output path is
+        written beside it and renamed into place once complete, so it may be
+        the input itself.
+
+        Input: image file <path or binary file object, non interlaced with 8
+               or 16 bits per sample>, output file, payload <str, bytes or
+               binary file object>, verbose flag, number of payload bits per
+               color sample, flag to use the alpha channel too, PNG save
+               profile, codec <name in CODECS>, progress <function(rows
+               done, total rows)>, bytes of pixels per band, stats
+               <metrics.Stats>, where decoding, embedding and compressing
+               each band add up under "open", "embed" and "serialize"
+        Output: save report {"bytes": bytes written, "seconds": time taken}
+        Raises: UnsupportedFormatError, CapacityError
+    '''
+    start = time.perf_counter()
+    with metrics.stage(stats, "check"):
+        header = readImageHeader(imageFile)
+    if header["interlaced"] or header["bit_depth"] < 8:
+        raise UnsupportedFormatError("Only non interlaced images of 8 or 16 bits per sample can "
+                                     "be encoded a band at a time")
+    if header["mode"] == "P":
+        raise UnsupportedFormatError("Palette images can't be encoded a band at a time, "
+                                     "convert them to RGB first")
+    with metrics.stage(stats, "open"):
+        try:
+            reader = pngio.RowReader(imageFile)
+        except ValueError as err:
+            raise UnsupportedFormatError("Can't read the image data ({})".format(err))
+
+    with reader, tempfile.TemporaryFile() as spool:
+        prepareImage(reader)
+        capacity = payloadCapacity(reader, bitsPerChannel, useAlpha)
+
+        # Settle the payload's length and checksum before anything is written
+        with metrics.stage(stats, "convert"):
+            if isinstance(payload, (str, bytes)):
+                if isinstance(payload, str):
+                    payload = payload.encode(encoding="utf-8")
+                metrics.count(stats, bytesRead=len(payload))
+                payload, codec = compressPayload(payload, codec)
+                source, length, checksum = io.BytesIO(payload), len(payload), zlib.crc32(payload)
+            else:
+                source, length, checksum = spool, 0, 0
+                chunks = readChunks(payload)
+                if codec is not None:
+                    chunks = compressChunks(chunks, codec)
+                for chunk in chunks:
+                    length += len(chunk)
+                    if length > capacity:
+                        break
+                    checksum = zlib.crc32(chunk, checksum)
+                    spool.write(chunk)
+            metrics.count(stats, bytesWritten=length)
+        if length > capacity:
+            raise CapacityError("This image is too small to contain your message!\nExiting...")
+
+        container = HEADER.pack(MAGIC, VERSION, containerFlags(reader, bitsPerChannel, useAlpha,
+                                                               codec=codec), length, checksum)
+        channels = payloadChannels(reader, useAlpha)
+        segments = [(io.BytesIO(container), len(container), 1, MODE_CHANNELS[reader.mode][0], 0),
+                    (source, length, bitsPerChannel, channels, headerPixels(reader) * channels)]
+
+        if verbose: print("Encoding {} bytes a band of rows at a time...".format(length))
+
+        level, filterName, _ = SAVE_PROFILES[profile]
+        height = reader.shape[0]
+        bandRows = max(1, bandBytes // reader.rowLength)
+        with replacedOnSuccess(outputFile) as target:
+            with pngio.PNGWriter(target, reader.size, reader.mode, level,
+                                 pngio.FILTERS[filterName],
+                                 pngio.keptChunks(reader.chunks)) as writer:
+                try:
+                    bands = reader.bands(bandRows)
+                    for index in range(-(-height // bandRows)):
+                        with metrics.stage(stats, "open"):
+                            before = reader.stream.tell()
+                            band = next(bands)
+                            metrics.count(stats, samples=band.size,
+                                          bytesRead=reader.stream.tell() - before)
+                        with metrics.stage(stats, "embed"):
+                            samples = sum(writeBandSegment(band, index * bandRows, *segment)
+                                          for segment in segments)
+                            metrics.count(stats, samples=samples)
+                        with metrics.stage(stats, "serialize"):
+                            before = writer.written
+                            writer.write(band)
+                            metrics.count(stats, samples=band.size,
+                                          bytesWritten=writer.written - before)
+                        if progress: progress(index * bandRows + band.shape[0], height)
+                except ValueError as err:
+                    raise UnsupportedFormatError("Can't read the image data ({})".format(err))
+                written = writer.finish()
+
+    report = {"bytes": written, "seconds": time.perf_counter() - start}
+    if verbose: print("Saved encoded data as \"{}\" ({} bytes in {:.3f}s)\nDone".format(
+                          outputFile, report["bytes"], report["seconds"]))
+    return report
+
+
+def writeBandSegment(band, firstRow, source, length, bitsPerChannel, channels, first):
+    ''' Writes the part of a sequential segment that falls in a band of rows,
+        reading only those bytes of it
+
+        Input: band <array of (rows, width, channels)>, firstRow <row of the
+               image the band starts on>, source <seekable binary file object>
+               holding the segment, length <bytes>, bitsPerChannel <1-4>,
+               channels <int>, first <sample the segment starts on>
+        Output: samples written <int>
+    '''
+    bandStart = firstRow * band.shape[1] * channels
+    firstValue = max(bandStart - first, 0)
+    lastValue = min(bandStart + band.shape[0] * band.shape[1] * channels - first,
+                    -(-length * 8 // bitsPerChannel))
+    if firstValue >= lastValue:
+        return 0
+
+    firstBit = firstValue * bitsPerChannel
+    lastBit = min(lastValue * bitsPerChannel, length * 8)
+    source.seek(firstBit // 8)
+    data = source.read(-(-lastBit // 8) - firstBit // 8)
+    bits = toBits(data)[firstBit % 8:firstBit % 8 + lastBit - firstBit]
+    writeSegment(band, first + firstValue - bandStart, bits, bitsPerChannel, channels)
+    return lastValue - firstValue
+
+
+def writeSegment(pixels, offset, bits, bitsPerChannel, channels):
+    ''' Writes bits into the low bits of the first channels of each pixel,
+        seen as one flat run of samples, with a single masked operation over
+        the rows the run covers. Bits that don't fit are dropped.
+
+        Input: pixels <array of (height, width, channels)>, offset <sample
+               index>, bits <np.uint8 array of 0/1>, bitsPerChannel <1-4>,
+               channels <int>
+        Output: offset of the next free sample <int>
+    '''
+    carrier = pixels[:, :, :channels]
+    values = toValues(bits, bitsPerChannel)[:carrier.size - offset].astype(pixels.dtype)
+
+    # Rows holding the first and last sample
+    rowSamples = pixels.shape[1] * channels
+    firstRow = offset // rowSamples
+    lastRow = -(-(offset + values.size) // rowSamples)
+    rows = carrier[firstRow:lastRow]
+
+    # A view of the rows, unless some channels are skipped
+    samples = rows.reshape(-1)
+    span = slice(offset - firstRow * rowSamples, offset - firstRow * rowSamples + values.size)
+
+    # Mask colors (e.g. with 254) to clear the low bits, then set them to the message bits
+    samples[span] = samples[span] & ~pixels.dtype.type((1 << bitsPerChannel) - 1) | values
+    if not np.may_share_memory(samples, rows):
+        rows[...] = samples.reshape(rows.shape)
+
+    return offset + values.size
+
+
+def scatterSegment(pixels, offset, bits, bitsPerChannel, channels, keys, first=0):
+    ''' Writes bits like writeSegment, except value i goes to sample P(first + i)
+        of the samples from offset on, P being the keyed permutation of them.
+        Positions are computed a batch at a time.
+
+        Input: pixels <array of (height, width, channels)>, offset <sample
+               index>, bits <np.uint8 array of 0/1>, bitsPerChannel <1-4>,
+               channels <int>, keys <np.uint32 array>, first <index into the
+               permutation>
+        Output: index into the permutation of the next value <int>
+    '''
+    size = pixels.shape[0] * pixels.shape[1] * channels - offset
+    values = toValues(bits, bitsPerChannel)[:max(size - first, 0)].astype(pixels.dtype)
+    mask = ~pixels.dtype.type((1 << bitsPerChannel) - 1)
+
+    # A view of the whole buffer, as loadPixels gives a contiguous array
+    flat = pixels.reshape(-1)
+    for start in range(0, values.size, SCATTER_BATCH):
+        batch = values[start:start + SCATTER_BATCH]
+        indices = flatPositions(pixels, offset + permute(keys, size, first + start, batch.size),
+                                channels)
+        flat[indices] = flat[indices] & mask | batch
+
+    return first + values.size
+
+
+def loadPixels(image, writable=False):
+    ''' Decodes an image into a NumPy array, with a channel axis even for
+        single channel modes
+
+        Input: image <Image>, writable flag to get a private copy
+        Output: pixels <np.uint8 or np.uint16 array of (height, width, channels)>,
+                or the image itself for a LazyImage, which decodes rows as
+                they are sliced off
+    '''
+    if isinstance(image, LazyImage):
+        return image
+    pixels = np.array(image) if writable else np.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, None]
+    return pixels
+
+
+def toImage(image, pixels):
+    ''' Wraps pixels back into an image of the original mode, without copying
+
+        Input: image <Image> the pixels came from, pixels <array>
+        Output: image <Image>
+    '''
+    return Image.frombuffer(image.mode, image.size, pixels, 'raw', image.mode, 0, 1)
+
+
+def pixelValues(image, xy):
+    ''' Reads a pixel as a list of channel values, whatever the mode
+
+        Input: image <Image>, xy (x, y)
+        Output: values [int]
+    '''
+    pixel = image.getpixel(xy)
+    return list(pixel) if isinstance(pixel, tuple) else [pixel]
+
+
+def embedNumpy(image, segments, progress=None, pixels=None):
+    ''' Writes each segment into the low bits of the image's samples, with
+        one masked operation per band of rows over the native pixel buffer.
+        Only the rows the segments cover are touched.
+
+        Input: image <Image>, segments [(bits, bitsPerChannel, channels, first sample,
+               scatter keys)], progress <function(rows done, total rows), may
+               raise to cancel>, pixels <writable copy of the image's samples>
+               to write into, decoded from the image if None
+        Output: encoded image <Image>
+    '''
+    # Load pixels once
+    if pixels is None:
+        pixels = loadPixels(image, writable=True)
+    height, width = pixels.shape[:2]
+
+    # Values that don't fit are dropped, i.e. the tail of a legacy delimiter
+    for bits, bitsPerChannel, channels, offset, keys in segments:
+        bandBits = ROWS_PER_BAND * width * channels * bitsPerChannel
+        for start in range(0, bits.size, bandBits):
+            band = bits[start:start + bandBits]
+            if keys is None:
+                offset = writeSegment(pixels, offset, band, bitsPerChannel, channels)
+                rows = -(-offset // (width * channels))
+            else:
+                # Scattered values land all over, so report the share written
+                scatterSegment(pixels, offset, band, bitsPerChannel, channels, keys,
+                               start // bitsPerChannel)
+                rows = height * (start + band.size) // bits.size
+            if progress: progress(min(rows, height), height)
+
+    if progress: progress(height, height)
+    return toImage(image, pixels)
+
+
+def embedPython(image, segments, progress=None):
+    ''' Reference backend, encodes the segments one color at a time with
+        getpixel/putpixel
+
+        Input: image <Image>, segments [(bits, bitsPerChannel, channels, first sample,
+               scatter keys)], progress <function(rows done, total rows), may
+               raise to cancel>
+        Output: encoded image <Image>
+    '''
+    encodedImage = image.copy()
+    width, height = image.size
+
+    for bits, bitsPerChannel, channels, offset, keys in segments:
+        mask = ~((1 << bitsPerChannel) - 1)
+        values = toValues(bits, bitsPerChannel)
+        size = width * height * channels - offset
+        if keys is not None:
+            positions = permute(keys, size, 0, min(values.size, size))
+        for index, value in enumerate(values):
+
+            # Find the pixel and channel this value goes in
+            if index >= size:
+                break
+            sample = index if keys is None else int(positions[index])
+            pixel, channel = divmod(offset + sample, channels)
+            xy = (pixel % width, pixel // width)
+            if progress and keys is None and xy[0] == 0 and channel == 0: progress(xy[1], height)
+
+            # Mask color (e.g. with 254) to clear the low bits, then set them to the message bits
+            color = pixelValues(encodedImage, xy)
+            color[channel] = color[channel] & mask | int(value)
+            encodedImage.putpixel(xy, tuple(color) if len(color) > 1 else color[0])
+
+    if progress: progress(height, height)
+    return encodedImage
+
+
+# Available embedding backends, selectable with -b/--backend
+EMBED_BACKENDS = {"numpy": embedNumpy, "python": embedPython}
+
+
+def inspectImage(imageFile):
+    ''' Describes what an image can carry without decoding all of it: its
+        size and mode from the IHDR chunk, the capacity of every embedding
+        mode, and the container header if the first rows hold one. Interlaced
+        and low bit depth images are decoded in full to look for the header.
+        Legacy delimited messages can't be told apart from noise this way,
+        so are not reported.
+
+        Input: image file <path or binary file object>
+        Output: report <dict>
+        Raises: UnsupportedFormatError
+    '''
+    isPath = isinstance(imageFile, str)
+    with open(imageFile, "rb") if isPath else contextlib.nullcontext(imageFile) as stream:
+        try:
+            header = pngio.readHeader(stream)
+        except ValueError as err:
+            raise UnsupportedFormatError("Sorry, but this program only supports .png image formats "
+                                         "({})".format(err))
+
+        report = {"image": imageFile if isPath else getattr(imageFile, "name", None),
+                  "width": header["width"], "height": header["height"],
+                  "mode": header["mode"], "bit_depth": header["bit_depth"],
+                  "interlaced": header["interlaced"]}
+        mode = header["mode"]
+        size = (header["width"], header["height"])
+
+        # Palette images must be converted, and 16 bit color can't be stored
+        if mode not in MODE_CHANNELS or (header["bit_depth"] == 16 and mode != "I;16"):
+            report["supported"] = False
+            report["payload"] = None
+            return report
+        report["supported"] = True
+
+        report["capacity"] = {str(bits): sizeCapacity(size, mode, bits)
+                              for bits in range(1, MAX_BITS_PER_CHANNEL + 1)}
+        if MODE_CHANNELS[mode][1]:
+            report["capacity_alpha"] = {str(bits): sizeCapacity(size, mode, bits, True)
+                                        for bits in range(1, MAX_BITS_PER_CHANNEL + 1)}
+        if report["capacity"]["1"] < 0:
+            report["payload"] = None
+            return report
+
+        # Decode just the rows the header is in
+        colorChannels = MODE_CHANNELS[mode][0]
+        headerRows = -(-HEADER_BITS // colorChannels // size[0])
+        if not header["interlaced"] and header["bit_depth"] >= 8:
+            try:
+                pixels = pngio.RowReader(stream, header)[:headerRows]
+            except ValueError as err:
+                raise UnsupportedFormatError("Can't read the image data ({})".format(err))
+        else:
+            stream.seek(0)
+            pixels = loadPixels(openImage(stream))
+
+    headerSamples = readSamples(pixels, 0, HEADER_BITS, colorChannels)
+    container = parseHeader(np.packbits(fromSamples(headerSamples, 1)).tobytes())
+    if container is None:
+        report["payload"] = None
+        return report
+
+    flags, length, checksum = container
+    bitsPerChannel = (flags & FLAG_BITS_PER_CHANNEL) + 1
+    useAlpha = bool(flags & FLAG_ALPHA)
+    report["payload"] = {"version": VERSION, "length": length, "crc32": "{:08x}".format(checksum),
+                         "bits_per_channel": bitsPerChannel, "use_alpha": useAlpha,
+                         "scattered": bool(flags & FLAG_SCATTER),
+                         "sharded": bool(flags & FLAG_SHARD),
+                         "codec": CODEC_NAMES.get((flags & FLAG_CODEC) >> CODEC_SHIFT),
+                         "plausible": length <= sizeCapacity(size, mode, bitsPerChannel, useAlpha)}
+    return report
+
+
+def extractMessage(imageFile, verbose=False, backend="numpy", passphrase=None, stats=None):
+    ''' Extracts message from image
+
+        Input: <input_image>, <verbosity_flag>, <extraction_backend>, <passphrase>, <stats>
+        Output: <message>
+        Raises: UnsupportedFormatError
+    '''
+    # Check image format, and open input image
+    carrier = StegoImage.fromFile(imageFile)
+    if verbose: print("Extracting message...")
     try:
-        for byte in byteList:
-            message += toText(byte)
-    except TypeError as err:
+        messageBytes = carrier.extract(passphrase, backend, verbose, stats)
+    except MessageNotFoundError as err:
         print(err)
         return "No message found"
 
-    return message
+    if verbose: print("Converting binary to text...")
+    with metrics.stage(stats, "convert"):
+        try:
+            return messageBytes.decode(encoding="utf-8")
+        except UnicodeDecodeError:
+            print("No message found, are you sure your input file was properly encoded?")
+            return "No message found"
+
+
+def extractPayload(image, verbose=False, backend="numpy", passphrase=None, stats=None):
+    ''' Reads the container header and exactly the payload bits behind it,
+        falling back to the old delimited format if no header is found
+
+        Input: image <Image, or LazyImage for the numpy backend>, verbose
+               flag, extraction backend, passphrase <str> for scattered
+               payloads, stats <metrics.Stats>
+        Output: payload <bytes>
+        Raises: UnsupportedFormatError, MessageNotFoundError if no intact
+                message was found
+    '''
+    payload = io.BytesIO()
+    extractPayloadStream(image, payload, verbose, backend, passphrase, stats=stats)
+    return payload.getvalue()
+
+
+def extractStream(imageFile, stream, verbose=False, backend="numpy", passphrase=None,
+                  chunkSize=CHUNK_SIZE, stats=None):
+    ''' Extracts the payload of an image file into a stream
+
+        Input: image file, stream <binary file object>, verbose flag,
+               extraction backend, passphrase <str>, chunk size, stats
+               <metrics.Stats>
+        Output: payload length <int>
+        Raises: UnsupportedFormatError, MessageNotFoundError, ValueError if
+                the chunk size splits samples
+    '''
+    # Check image format, and open input image
+    return StegoImage.fromFile(imageFile).extractTo(stream, passphrase, backend, chunkSize, verbose,
+                                                    stats)
+
+
+def extractPayloadStream(image, stream, verbose=False, backend="numpy", passphrase=None,
+                         chunkSize=CHUNK_SIZE, stats=None):
+    ''' Reads the container header, then streams the payload behind it one
+        chunk at a time, checking the checksum once the last chunk is written.
+        Legacy delimited messages are written in one go.
+
+        Input: image <Image, or LazyImage for the numpy backend>, stream
+               <binary file object>, verbose flag, extraction backend,
+               passphrase <str> for scattered payloads, chunk size, stats
+               <metrics.Stats>
+        Output: payload length <int>, after decompression
+        Raises: UnsupportedFormatError, MessageNotFoundError if no intact
+                message was found
+    '''
+    with metrics.stage(stats, "extract"):
+        flags, chunks = readContainer(image, verbose, backend, passphrase, chunkSize, stats)
+        if flags & FLAG_SHARD:
+            raise MessageNotFoundError("This image holds one shard of a larger payload, decode "
+                                       "it together with the others (decode-shards)")
+        written = writePayload(chunks, flags, stream, stats)
+        if isinstance(image, LazyImage):
+            # Rows are decoded as they are read, so the file is only read this far
+            metrics.count(stats, bytesRead=image.stream.tell() - image.start)
+    return written
+
+
+def readContainer(image, verbose=False, backend="numpy", passphrase=None, chunkSize=CHUNK_SIZE,
+                  stats=None):
+    ''' Reads the container header, and gives the payload behind it as it is
+        stored, still compressed, one chunk at a time. The checksum is checked
+        once the last chunk is read. Legacy delimited messages come in one
+        chunk, with no flags set.
+
+        Input: image <Image, or LazyImage for the numpy backend>, verbose
+               flag, extraction backend, passphrase <str> for scattered
+               payloads, chunk size, stats <metrics.Stats>
+        Output: (flags <int>, generator of chunks <bytes>)
+        Raises: UnsupportedFormatError, MessageNotFoundError if no intact
+                message was found, the checksum mismatch from the generator,
+                ValueError if the chunk size splits samples
+    '''
+    checkChunkSize(chunkSize)
+    image = prepareImage(image)
+    load, readSamples, getLegacyMessage, readPositions = EXTRACT_BACKENDS[backend]
+    pixels = load(image)
+    colorChannels = MODE_CHANNELS[image.mode][0]
+
+    # Check for a container header
+    header = None
+    if payloadCapacity(image) >= 0:
+        headerSamples = readSamples(pixels, 0, HEADER_BITS, colorChannels)
+        header = parseHeader(np.packbits(fromSamples(headerSamples, 1)).tobytes())
+        metrics.count(stats, samples=HEADER_BITS)
+
+    if header is None:
+        if verbose: print("No header found, reading legacy delimited message...")
+        message = getLegacyMessage(pixels)
+        if message is None:
+            raise MessageNotFoundError("No message delimiter found")
+        # The legacy format only held ASCII text, anything else is noise
+        # that happens to come before a \x00 byte
+        if not message or max(message) > 0x7f:
+            raise MessageNotFoundError("No message found, the image has no header and no "
+                                       "legacy ASCII message")
+        return 0, iter([message])
+
+    flags, length, checksum = header
+    bitsPerChannel = (flags & FLAG_BITS_PER_CHANNEL) + 1
+    useAlpha = bool(flags & FLAG_ALPHA)
+    if length > payloadCapacity(image, bitsPerChannel, useAlpha):
+        raise MessageNotFoundError("Header claims more data than the image can hold")
+
+    keys = None
+    if flags & FLAG_SCATTER:
+        if passphrase is None:
+            raise MessageNotFoundError("The message is scattered, a passphrase is needed to read it")
+        keys = scatterKeys(passphrase)
+
+    if verbose: print("Found header, reading {} bytes at {} bit(s) per channel...".format(
+                          length, bitsPerChannel))
 
+    def storedChunks():
+        # Read the payload a chunk at a time
+        channels = payloadChannels(image, useAlpha)
+        offset = headerPixels(image) * channels
+        size = image.size[0] * image.size[1] * channels - offset
+        index = 0
+        crc = 0
+        for chunkStart in range(0, length, chunkSize):
+            chunkLength = min(chunkSize, length - chunkStart)
+            count = -(-chunkLength * 8 // bitsPerChannel)
+            if keys is None:
+                samples = readSamples(pixels, offset, count, channels)
+                offset += count
+            else:
+                # Only the samples this chunk needs, a batch of positions at a time
+                batches = []
+                for start in range(index, index + count, SCATTER_BATCH):
+                    positions = permute(keys, size, start,
+                                        min(SCATTER_BATCH, index + count - start))
+                    batches.append(readPositions(pixels, offset + positions, channels))
+                samples = np.concatenate(batches)
+                index += count
+            bits = fromSamples(samples, bitsPerChannel)
+            chunk = np.packbits(bits[:chunkLength * 8]).tobytes()
+            crc = zlib.crc32(chunk, crc)
+            metrics.count(stats, samples=count)
+            yield chunk
 
-def getBinaryMessage(image):
-    ''' Stores the LSB of each color for each pixel until encountering
-        a \x00 character
+        if crc != checksum:
+            raise MessageNotFoundError("Checksum mismatch, the message is corrupted")
+
+    return flags, storedChunks()
+
+
+def writePayload(chunks, flags, stream, stats=None):
+    ''' Writes stored payload chunks to a stream, decompressing them with the
+        codec the header's flags name
+
+        Input: chunks <iterable of bytes>, flags <int>, stream <binary file
+               object>, stats <metrics.Stats>
+        Output: payload length <int>, after decompression
+        Raises: UnsupportedFormatError, MessageNotFoundError if the payload
+                can't be decompressed
+    '''
+    decompressor = payloadDecompressor(flags)
+    written = 0
+    for chunk in chunks:
+        if decompressor is not None:
+            with metrics.stage(stats, "convert"):
+                metrics.count(stats, bytesRead=len(chunk))
+                try:
+                    chunk = decompressor.decompress(chunk)
+                except DECOMPRESS_ERRORS:
+                    raise MessageNotFoundError("The message can't be decompressed, it is "
+                                               "corrupted")
+        with metrics.stage(stats, "save"):
+            stream.write(chunk)
+            metrics.count(stats, bytesWritten=len(chunk))
+        written += len(chunk)
+
+    # lzma has nothing left to flush, and no flush method
+    if decompressor is not None and hasattr(decompressor, "flush"):
+        chunk = decompressor.flush()
+        with metrics.stage(stats, "save"):
+            stream.write(chunk)
+            metrics.count(stats, bytesWritten=len(chunk))
+        written += len(chunk)
+
+    return written
+
+
+def extractShard(image, verbose=False, backend="numpy", passphrase=None):
+    ''' Reads the shard of a split payload an image holds, as it is stored
+
+        Input: image <Image, or LazyImage for the numpy backend>, verbose
+               flag, extraction backend, passphrase <str> for scattered shards
+        Output: (payload id <bytes>, sequence number <int>, shard count
+                 <int>, flags <int>, shard data <bytes, still compressed>)
+        Raises: UnsupportedFormatError, MessageNotFoundError if the image
+                holds no intact shard
+    '''
+    flags, chunks = readContainer(image, verbose, backend, passphrase)
+    if not flags & FLAG_SHARD:
+        raise MessageNotFoundError("This image holds a whole message, not a shard")
+    data = b"".join(chunks)
+    if len(data) < SHARD.size:
+        raise MessageNotFoundError("The shard header is cut short")
+    payloadId, sequence, count = SHARD.unpack_from(data)
+    return payloadId, sequence, count, flags, data[SHARD.size:]
+
+
+def loadPixelsPython(image):
+    ''' Reference backend, reads straight from the image with getpixel
 
         Input: image <Image>
-        Output: byteList [string]
+        Output: image <Image>
     '''
+    return image
 
-    # Buffer to store message
-    message = "0b0"
+
+def readSamples(pixels, start, count, channels):
+    ''' Reads a run of samples from the first channels of each pixel,
+        touching only the rows the run covers
+
+        Input: pixels <array of (height, width, channels), or LazyImage>,
+               start <sample index>, count <number of samples>, channels <int>
+        Output: samples <np.uint8 or np.uint16 array>
+    '''
+    rowSamples = pixels.shape[1] * channels
+
+    # Rows holding the first and last sample
+    firstRow = start // rowSamples
+    lastRow = (start + count + rowSamples - 1) // rowSamples
+    offset = start - firstRow * rowSamples
+
+    return pixels[firstRow:lastRow][:, :, :channels].reshape(-1)[offset:offset + count]
+
+
+def readPositions(pixels, positions, channels):
+    ''' Reads the samples at scattered positions in the first channels of
+        each pixel
+
+        Input: pixels <array of (height, width, channels), or LazyImage>,
+               positions <np.int64 array of sample indices>, channels <int>
+        Output: samples <np.uint8 or np.uint16 array>
+    '''
+    # Positions are spread over the whole image, so all of it is decoded
+    return pixels[:].reshape(-1)[flatPositions(pixels, positions, channels)]
+
+
+def readPositionsPython(image, positions, channels):
+    ''' Reference backend, reads the samples at scattered positions one
+        pixel at a time
+
+        Input: image <Image>, positions <sample indices>, channels <int>
+        Output: samples <np.int64 array>
+    '''
+    samples = []
+    for position in positions:
+        pixel, channel = divmod(int(position), channels)
+        y, x = divmod(pixel, image.size[0])
+        samples.append(pixelValues(image, (x, y))[channel])
+    return np.array(samples, dtype=np.int64)
+
+
+def readSamplesPython(image, start, count, channels):
+    ''' Reference backend, reads a run of samples from the first channels of
+        each pixel, one pixel at a time
+
+        Input: image <Image>, start <sample index>, count <number of samples>,
+               channels <int>
+        Output: samples <np.int64 array>
+    '''
+    samples = []
+    for index in range(start // channels, (start + count + channels - 1) // channels):
+        y, x = divmod(index, image.size[0])
+        for color in pixelValues(image, (x,y))[:channels]:
+            samples.append(color)
+
+    offset = start % channels
+    return np.array(samples[offset:offset + count], dtype=np.int64)
+
+
+# Number of image rows read per block when extracting
+ROWS_PER_CHUNK = 16
+
+def getBinaryMessage(pixels, rowsPerChunk=ROWS_PER_CHUNK):
+    ''' Reads the LSB of each color, one block of rows at a time, until
+        encountering a \x00 byte. Rows past the delimiter are never read.
+
+        Input: pixels <array of (height, width, channels), or LazyImage>,
+               rowsPerChunk <int>
+        Output: message <bytes>, or None if no delimiter was found
+    '''
+
+    # The encoder drops the leading 0 bit of the first character, put it back
+    pending = np.zeros(1, dtype=np.uint8)
+
+    # Bytes of the message found so far
+    chunks = []
+
+    for y in range(0, pixels.shape[0], rowsPerChunk):
+        # Strip the LSBs of this block of rows, e.g. 0b1110011(0)
+        bits = np.concatenate((pending, fromSamples(pixels[y:y + rowsPerChunk].reshape(-1), 1)))
+
+        # Pack whole bytes, and carry the leftover bits into the next block
+        wholeBits = bits.size - bits.size % 8
+        block = np.packbits(bits[:wholeBits])
+        pending = bits[wholeBits:]
+
+        # If we encounter the end of the message
+        delimiter = np.flatnonzero(block == 0)
+        if delimiter.size:
+            chunks.append(block[:delimiter[0]].tobytes())
+            return b"".join(chunks)
+
+        chunks.append(block.tobytes())
+
+    return None
+
+
+def getBinaryMessagePython(image):
+    ''' Reference backend, stores the LSB of each color for each pixel until
+        encountering a \x00 character
+
+        Input: image <Image>
+        Output: message <bytes>, or None if no delimiter was found
+    '''
 
     # Return message after finding first \x00
     bitCount = 1
@@ -161,7 +2073,7 @@ def getBinaryMessage(image):
     # Loop through picture and store all LSB in message
     for y in range(image.size[1]):
         for x in range(image.size[0]):
-            for color in image.getpixel((x,y)):
+            for color in pixelValues(image, (x,y)):
 
                 # Store last bit of pixel's color, e.g. 0b1110011(0)
                 byte += bin(color)[-1]
@@ -172,12 +2084,20 @@ def getBinaryMessage(image):
 
                     # If we encounter the end of the message
                     if byte == "00000000":
-                        return byteList
+                        return bytes(int(byte, 2) for byte in byteList)
 
                     byteList.append(byte)
                     bitCount = 0
                     byte = ""
 
+    return None
+
+
+# Available extraction backends, as (pixel loader, sample reader, legacy message scanner)
+EXTRACT_BACKENDS = {"numpy": (loadPixels, readSamples, getBinaryMessage, readPositions),
+                    "python": (loadPixelsPython, readSamplesPython, getBinaryMessagePython,
+                               readPositionsPython)}
+
 
 if __name__ == "__main__":
     main()
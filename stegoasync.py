@@ -0,0 +1,280 @@
+import asyncio
+import io
+import os
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from steganography import StegoImage, inspectImage
+
+################################################################################
+# Asyncio API
+#
+#   Encodes, extracts and inspects from an event loop without blocking it.
+#   The CPU bound work runs on a thread or process pool, with at most "limit"
+#   jobs in flight, and carriers are read and encoded images written on
+#   threads of their own, so a stream of images overlaps its disk reads, PNG
+#   inflate, embedding and deflate.
+#
+#       async with AsyncStego(workers=4) as stego:
+#           await stego.aencode("castle.png", "out.png", "Message")
+#           payload = await stego.aextract("out.png")
+#           async for image, report, error in stego.amap(stego.ainspect, paths):
+#               ...
+#
+#   aencode, aextract and ainspect are module functions too, running on a
+#   thread pool runner kept for each event loop.
+################################################################################
+
+# Threads each runner reads and writes files on
+IO_THREADS = 4
+
+# Runners of the module functions, by event loop
+runners = weakref.WeakKeyDictionary()
+
+
+class AsyncStego:
+    # Runs jobs for coroutines on an executor, at most limit at once. By
+    # default the limit is twice the workers, so the next carriers are read
+    # while others are embedding.
+
+    # Input: workers <int>, processes flag to use a process pool rather than
+    #        threads, limit <int, jobs in flight>, executor <Executor> to run
+    #        on instead of a pool of its own, which is left running on close
+    # Output: None
+
+    def __init__(self, workers=None, processes=False, limit=None, executor=None):
+        self.workers = workers or os.cpu_count()
+        self.ownExecutor = executor is None
+        if executor is None:
+            pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            executor = pool(max_workers=self.workers)
+        self.executor = executor
+        self.files = ThreadPoolExecutor(max_workers=IO_THREADS)
+        self.limit = limit or 2 * self.workers
+        self.slots = asyncio.Semaphore(self.limit)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def close(self):
+        ''' Shuts the pools down once their jobs are done, without blocking
+            the event loop
+
+            Input: None
+            Output: None
+        '''
+        loop = asyncio.get_running_loop()
+        if self.ownExecutor:
+            await loop.run_in_executor(None, self.executor.shutdown)
+        await loop.run_in_executor(None, self.files.shutdown)
+
+    async def run(self, function, *args):
+        ''' Runs a function on the executor
+
+            Input: function, and its arguments, picklable for a process pool
+            Output: the function's result
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def readImage(self, imageFile):
+        ''' Reads an image file whole on a file thread
+
+            Input: imageFile <path, binary file object or bytes-like>
+            Output: data <bytes>
+        '''
+        if isinstance(imageFile, (bytes, bytearray)):
+            return imageFile
+        if isinstance(imageFile, memoryview):
+            return imageFile.tobytes()
+        return await asyncio.get_running_loop().run_in_executor(self.files, readFile, imageFile)
+
+    async def aencode(self, imageFile, outputFile, message, bitsPerChannel=1, useAlpha=False,
+                      convertPalette=False, profile="balanced", passphrase=None, codec=None):
+        ''' Encodes a message into an image. The image is read and the result
+            written on file threads, and the embed and save run on the pool.
+
+            Input: image file <path, binary file object or PNG bytes>, output
+                   file <path, binary file object or None>, message <str or
+                   bytes>, and the options of encodeMessage
+            Output: encoded PNG <bytes> without an output file, else a report
+                    {"bytes": bytes written, "seconds": time encoding took}
+            Raises: UnsupportedFormatError, CapacityError, OSError
+        '''
+        async with self.slots:
+            data = await self.readImage(imageFile)
+            start = time.perf_counter()
+            png = await self.run(encodeData, data, message, bitsPerChannel, useAlpha,
+                                 convertPalette, profile, passphrase, codec)
+            if outputFile is None:
+                return png
+            await asyncio.get_running_loop().run_in_executor(self.files, writeFile, outputFile,
+                                                             png)
+            return {"bytes": len(png), "seconds": time.perf_counter() - start}
+
+    async def aextract(self, imageFile, passphrase=None, backend="numpy"):
+        ''' Extracts the payload of an image. A path is read by the pool
+            worker, so only the rows the payload occupies are read at all.
+
+            Input: image file <path, binary file object or PNG bytes>,
+                   passphrase <str> for scattered payloads, extraction backend
+            Output: payload <bytes>
+            Raises: UnsupportedFormatError, MessageNotFoundError, OSError
+        '''
+        async with self.slots:
+            source = imageFile if isinstance(imageFile, str) else await self.readImage(imageFile)
+            return await self.run(extractSource, source, passphrase, backend)
+
+    async def ainspect(self, imageFile):
+        ''' Reports what an image can carry, as inspectImage does. A path is
+            read by the pool worker, which reads only the first rows.
+
+            Input: image file <path, binary file object or PNG bytes>
+            Output: report <dict>
+            Raises: UnsupportedFormatError, OSError
+        '''
+        async with self.slots:
+            source = imageFile if isinstance(imageFile, str) else await self.readImage(imageFile)
+            return await self.run(inspectSource, source)
+
+    async def amap(self, function, inputs):
+        ''' Runs a coroutine function over many inputs, yielding each result
+            as it completes. Inputs are only taken as earlier ones finish, at
+            most limit in flight, so they may be endless. Errors are yielded
+            with their input instead of raised, and the rest carry on.
+
+            Input: function <coroutine function, e.g. aextract>, inputs
+                   <iterable or async iterable> of a tuple of positional
+                   arguments, a dict of keyword arguments, or one argument
+            Output: async generator of (input, result, error), result None
+                    if the input raised error
+        '''
+        iterator = inputs.__aiter__() if hasattr(inputs, "__aiter__") else iter(inputs)
+        running = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(running) < self.limit:
+                    try:
+                        if hasattr(iterator, "__anext__"):
+                            item = await iterator.__anext__()
+                        else:
+                            item = next(iterator)
+                    except (StopIteration, StopAsyncIteration):
+                        exhausted = True
+                        break
+                    running[asyncio.ensure_future(callWith(function, item))] = item
+
+                if not running:
+                    return
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    item = running.pop(task)
+                    error = task.exception()
+                    yield item, None if error else task.result(), error
+        finally:
+            for task in running:
+                task.cancel()
+
+
+def callWith(function, item):
+    ''' Calls a function with an input of amap
+
+        Input: function, item <tuple of positional arguments, dict of keyword
+               arguments, or one argument>
+        Output: the function's result
+    '''
+    if isinstance(item, tuple):
+        return function(*item)
+    if isinstance(item, dict):
+        return function(**item)
+    return function(item)
+
+
+def readFile(imageFile):
+    ''' Reads a file whole
+
+        Input: imageFile <path or binary file object>
+        Output: data <bytes>
+    '''
+    if isinstance(imageFile, str):
+        with open(imageFile, "rb") as stream:
+            return stream.read()
+    return imageFile.read()
+
+
+def writeFile(outputFile, data):
+    ''' Writes data to a file
+
+        Input: outputFile <path or binary file object>, data <bytes>
+        Output: None
+    '''
+    if isinstance(outputFile, str):
+        with open(outputFile, "wb") as stream:
+            stream.write(data)
+    else:
+        outputFile.write(data)
+
+
+def encodeData(data, message, bitsPerChannel, useAlpha, convertPalette, profile, passphrase,
+               codec):
+    ''' Encodes a message into a PNG held in memory, in a pool worker
+
+        Input: PNG <bytes>, message <str or bytes>, and the options of
+               encodeMessage
+        Output: encoded PNG <bytes>
+    '''
+    return StegoImage.fromBytes(data, convertPalette).embed(message, bitsPerChannel, useAlpha,
+                                                            passphrase, codec, profile)
+
+
+def extractSource(source, passphrase, backend):
+    ''' Extracts a payload, in a pool worker
+
+        Input: source <path or PNG bytes>, passphrase <str or None>,
+               extraction backend
+        Output: payload <bytes>
+    '''
+    if isinstance(source, str):
+        return StegoImage.fromFile(source).extract(passphrase, backend)
+    return StegoImage.fromBytes(source).extract(passphrase, backend)
+
+
+def inspectSource(source):
+    ''' Inspects an image, in a pool worker
+
+        Input: source <path or PNG bytes>
+        Output: report <dict>
+    '''
+    return inspectImage(source if isinstance(source, str) else io.BytesIO(source))
+
+
+def runner():
+    ''' The runner of the module functions for the running event loop,
+        created on first use
+
+        Input: None
+        Output: runner <AsyncStego>
+    '''
+    loop = asyncio.get_running_loop()
+    if loop not in runners:
+        runners[loop] = AsyncStego()
+    return runners[loop]
+
+
+async def aencode(imageFile, outputFile, message, **options):
+    ''' AsyncStego.aencode, on the event loop's shared runner '''
+    return await runner().aencode(imageFile, outputFile, message, **options)
+
+
+async def aextract(imageFile, passphrase=None, backend="numpy"):
+    ''' AsyncStego.aextract, on the event loop's shared runner '''
+    return await runner().aextract(imageFile, passphrase, backend)
+
+
+async def ainspect(imageFile):
+    ''' AsyncStego.ainspect, on the event loop's shared runner '''
+    return await runner().ainspect(imageFile)
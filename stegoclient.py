@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+import base64
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+################################################################################
+# Client for the steganography daemon
+#
+#   Takes the encode and decode arguments of steganography.py, but hands the
+#   work to a running daemon (steganography.py serve) instead of starting
+#   Python, NumPy and Pillow for every call. Only the standard library is
+#   imported here. Subcommands such as inspect and scan aren't forwarded,
+#   run them with steganography.py.
+#
+#       ./stegoclient.py images/castle.png -m "Message" -o output.png
+#       ./stegoclient.py output.png -d
+#
+#   The socket is taken from --socket, then $STEGO_SOCKET, then the default.
+#   When the daemon's queue is full it answers "busy", and the request is
+#   retried with a growing delay.
+################################################################################
+SOCKET_PATH = os.environ.get("STEGO_SOCKET", os.path.join(tempfile.gettempdir(), "steganography.sock"))
+
+# Retries of a busy daemon, and the first delay between them in seconds
+BUSY_RETRIES = 8
+BUSY_DELAY = 0.05
+
+
+def main():
+    argv = sys.argv[1:]
+    socketPath = SOCKET_PATH
+    if argv[:1] == ["--socket"] and len(argv) > 1:
+        socketPath, argv = argv[1], argv[2:]
+
+    job = {"op": "cli", "argv": argv, "cwd": os.getcwd()}
+    if readsStdin(argv):
+        job["stdin"] = base64.b64encode(sys.stdin.buffer.read()).decode(encoding="ascii")
+
+    try:
+        response = request(job, socketPath)
+    except OSError as err:
+        print("Can't reach the daemon at \"{}\" ({}), start it with: steganography.py serve".format(
+              socketPath, err), file=sys.stderr)
+        exit(1)
+
+    if response["status"] != "ok":
+        print(response["error"], file=sys.stderr)
+        exit(1)
+    sys.stdout.buffer.write(base64.b64decode(response["stdout"]))
+    sys.stderr.buffer.write(base64.b64decode(response["stderr"]))
+    exit(response["exit_status"])
+
+
+def readsStdin(argv):
+    ''' Whether a command line encodes a payload read from stdin
+
+        Input: argv <list>
+        Output: flag
+    '''
+    if "-d" in argv or "--decode" in argv:
+        return False
+    for index, arg in enumerate(argv):
+        if arg in ("-p", "--payload-file") and argv[index + 1:index + 2] == ["-"]:
+            return True
+        if arg == "--payload-file=-":
+            return True
+    return False
+
+
+def request(job, socketPath=SOCKET_PATH):
+    ''' Sends one job to the daemon and waits for its response, retrying
+        while the daemon is too busy to queue it
+
+        Input: job <dict>, socket path
+        Output: response <dict>
+        Raises: OSError if the daemon can't be reached
+    '''
+    delay = BUSY_DELAY
+    for attempt in range(BUSY_RETRIES + 1):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socketPath)
+            stream = connection.makefile("rwb")
+            stream.write(json.dumps(job).encode(encoding="utf-8") + b"\n")
+            stream.flush()
+            response = json.loads(stream.readline())
+        if response["status"] != "busy" or attempt == BUSY_RETRIES:
+            return response
+        time.sleep(delay)
+        delay *= 2
+
+
+if __name__ == "__main__":
+    main()